@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import serial
+import time
+
+from autotermheater import AutotermUtils, DiagnosticSnapshot, FrameDecoder, HistorySnapshot, SettingsSnapshot, \
+    StatusSnapshot
+
+
+class AutotermTransport:
+    # Non-blocking serial port driven by the asyncio event loop, no thread is needed
+    def __init__(self, port, baudrate=2400, logger=None, queue_size=100):
+        self.port = port
+        self.baudrate = baudrate
+        self.logger = logger or logging.getLogger(__name__)
+        self.queue_size = queue_size
+        self.decoder = FrameDecoder(self.logger)
+        self._ser = None
+        self._loop = None
+        self._listeners = []
+        self._queues = []
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._ser = serial.Serial(self.port, self.baudrate, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                                  stopbits=serial.STOPBITS_ONE, timeout=0, write_timeout=0.5)
+        self._ser.reset_input_buffer()
+        self._loop.add_reader(self._ser.fileno(), self._on_readable)
+        self.logger.info('Serial connection to {} established'.format(self.port))
+        return self
+
+    def close(self):
+        if self._ser:
+            self._loop.remove_reader(self._ser.fileno())
+            self._ser.close()
+            self._ser = None
+        for queue in self._queues:
+            if queue.full():
+                # Slow consumer, the end marker replaces the oldest message
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, frame):
+        self._ser.write(frame)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def _on_readable(self):
+        try:
+            data = self._ser.read(self._ser.in_waiting or 1)
+        except (OSError, serial.serialutil.SerialException):
+            self.logger.error('Cannot read from serial port {}!'.format(self.port))
+            self.close()
+            return
+        for message in self.decoder.feed(data):
+            for callback in self._listeners:
+                callback(message)
+            for queue in self._queues:
+                if queue.full():
+                    # Slow consumer, drop the oldest message
+                    queue.get_nowait()
+                queue.put_nowait(message)
+
+    async def __aiter__(self):
+        # Every iterator gets its own queue, so several consumers can read the same stream
+        queue = asyncio.Queue(self.queue_size)
+        self._queues.append(queue)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self._queues.remove(queue)
+
+
+class AsyncAutotermHeater(AutotermUtils):
+    def __init__(self, log_path, serial_port, baudrate=2400, timeout=2.0, retries=2, log_level=logging.DEBUG):
+        super().__init__(log_path, log_level)
+        self.transport = AutotermTransport(serial_port, baudrate, self.logger)
+        self.timeout = timeout
+        self.retries = retries
+        self._pending = {}
+        self._lock = None
+        self._heater_timer = None
+
+    async def connect(self):
+        self._lock = asyncio.Lock()
+        await self.transport.open()
+        self.transport.add_listener(self._on_message)
+        return self
+
+    def close(self):
+        if self._heater_timer:
+            self._heater_timer.cancel()
+        self.transport.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _on_message(self, message):
+        if message.device != 0x04:
+            return
+        future = self._pending.pop(message.msg_id2, None)
+        if future and not future.done():
+            future.set_result(message)
+
+    def _build(self, msg_id2, payload):
+        message = self.build(0x03, msg_id2, payload=payload)
+        if message == 0:
+            raise ValueError('Cannot build message {:02x}'.format(msg_id2))
+        return message
+
+    def send(self, msg_id2, payload=b''):
+        # Sends a message without waiting for a response
+        message = self._build(msg_id2, payload)
+        self.transport.write(message)
+        self.logger.info('Program sends message to heater ({})'.format(message.hex()))
+
+    async def request(self, msg_id2, payload=b''):
+        # Sends a message to the heater and waits for its response with the same command ID
+        message = self._build(msg_id2, payload)
+        async with self._lock:
+            for attempt in range(self.retries + 1):
+                future = asyncio.get_running_loop().create_future()
+                self._pending[msg_id2] = future
+                self.transport.write(message)
+                self.logger.info('Program sends message to heater ({})'.format(message.hex()))
+                try:
+                    return await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    self._pending.pop(msg_id2, None)
+                    self.logger.error('Heater did not respond to message ({})'.format(message.hex()))
+            raise asyncio.TimeoutError('Heater did not respond to message {}'.format(message.hex()))
+
+    def _set_timer(self, timer):
+        if self._heater_timer:
+            self._heater_timer.cancel()
+            self._heater_timer = None
+        if timer:
+            self._heater_timer = asyncio.get_running_loop().call_later(
+                timer * 60, lambda: asyncio.ensure_future(self.shutdown()))
+
+    # Heater and ventilation controlling
+    async def turn_on_heater(self, mode, setpoint=0x0f, ventilation=0x00, power=0x00, timer=None):
+        self._set_timer(timer)
+        payload = b'\xff\xff' + bytes((mode, setpoint, ventilation, power))
+        return SettingsSnapshot.decode((await self.request(0x01, payload)).payload, time.time())
+
+    async def change_settings(self, mode, setpoint=0x0f, ventilation=0x00, power=0x00, timer=None):
+        self._set_timer(timer)
+        payload = b'\xff\xff' + bytes((mode, setpoint, ventilation, power))
+        return SettingsSnapshot.decode((await self.request(0x02, payload)).payload, time.time())
+
+    async def turn_on_ventilation(self, power, timer=None):
+        self._set_timer(timer)
+        payload = b'\xff\xff' + bytes((power, 0x0f))
+        return (await self.request(0x23, payload)).payload
+
+    async def shutdown(self):
+        self._set_timer(None)
+        await self.request(0x03)
+
+    # Heater info
+    async def request_software_version(self):
+        return tuple((await self.request(0x06)).payload)
+
+    async def request_serial_number(self):
+        payload = (await self.request(0x04)).payload
+        return int.from_bytes(payload[0:2], 'big'), int.from_bytes(payload[2:5], 'big')
+
+    async def request_history(self):
+        return HistorySnapshot.decode((await self.request(0x0b)).payload, time.time())
+
+    # Heater settings and status
+    async def request_settings(self):
+        return SettingsSnapshot.decode((await self.request(0x02)).payload, time.time())
+
+    async def request_status(self):
+        return StatusSnapshot.decode((await self.request(0x0f)).payload, time.time())
+
+    asks_for_status = request_status
+
+    async def report_controller_temperature(self, temperature):
+        return (await self.request(0x11, temperature.to_bytes(1, byteorder='big'))).payload[0]
+
+    # Diagnostic
+    async def diagnostic_on(self):
+        await self.request(0x07, b'\x01')
+
+    async def diagnostic_off(self):
+        await self.request(0x07, b'\x00')
+
+    def unblock(self):
+        self.send(0x0d)
+
+    async def diagnostics(self):
+        # Stream of diagnostic messages sent by the heater once diagnostic mode is on
+        async for message in self.transport:
+            if message.device == 0x02 and message.msg_id2 == 0x01 and len(message.payload) == 72:
+                yield DiagnosticSnapshot.decode(message.payload, time.time())
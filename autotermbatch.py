@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Decoding of many stored messages at once into NumPy structured arrays, e.g. for offline analysis of captures.
+# Values are kept raw: voltage is in 0.1 V, fuel pump in 0.1 Hz and flame temperatures in Kelvin.
+
+import numpy as np
+
+from autotermheater import Message
+
+
+def _dtype(fields, itemsize):
+    names, formats, offsets = zip(*fields)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+
+
+_status_fields = [('status1', 'u1', 0), ('status2', 'u1', 1), ('errors', 'u1', 2), ('heater_temperature', 'i1', 3),
+                  ('external_temperature', 'i1', 4), ('battery_voltage', '>u2', 5), ('flame_temperature', '>u2', 7)]
+
+status_dtype = _dtype(_status_fields, 10)
+status_extended_dtype = _dtype(_status_fields + [('fan_setpoint', 'u1', 11), ('fan_actual', 'u1', 12),
+                                                 ('fuel_pump', 'u1', 14), ('water_pump', 'u1', 18)], 19)
+settings_dtype = _dtype([('timer', '>u2', 0), ('mode', 'u1', 2), ('setpoint', 'u1', 3), ('ventilation', 'u1', 4),
+                         ('power_level', 'u1', 5)], 6)
+history_fields = [('run_hours', '>u2', 0), ('starts', '>u2', 2), ('error1', 'u1', 4), ('error2', 'u1', 5),
+                  ('error3', 'u1', 6)]
+history_dtype = _dtype(history_fields, 7)
+history_extended_dtype = _dtype(history_fields, 9)
+# 24 bit counters are kept as three bytes, see uint24()
+diagnostic_dtype = _dtype([('status1', 'u1', 0), ('status2', 'u1', 1), ('counter1', ('u1', 3), 5),
+                           ('counter2', ('u1', 3), 8), ('defined_rev', 'u1', 11), ('measured_rev', 'u1', 12),
+                           ('fuel_pump1', 'u1', 14), ('fuel_pump2', 'u1', 16), ('chamber_temperature', '>u2', 18),
+                           ('flame_temperature', '>u2', 20), ('external_temperature', 'i1', 24),
+                           ('heater_temperature', 'i1', 25), ('battery_voltage', '>u2', 26)], 72)
+
+# (device, command ID, payload length): (name, dtype)
+layouts = {
+    (0x04, 0x01, 6): ('settings', settings_dtype),
+    (0x04, 0x02, 6): ('settings', settings_dtype),
+    (0x04, 0x0b, 7): ('history', history_dtype),
+    (0x04, 0x0b, 9): ('history_extended', history_extended_dtype),
+    (0x04, 0x0f, 10): ('status', status_dtype),
+    (0x04, 0x0f, 19): ('status_extended', status_extended_dtype),
+    (0x02, 0x01, 72): ('diagnostic', diagnostic_dtype),
+}
+
+
+def uint24(column):
+    column = column.astype(np.uint32)
+    return (column[:, 0] << 16) | (column[:, 1] << 8) | column[:, 2]
+
+
+def decode_batch(frames, timestamps=None):
+    # Frames are raw messages (bytes) or Message objects. Returns name: structured array, and name: timestamps
+    # array if timestamps of the frames are given. Frames of unknown layouts and truncated frames are skipped.
+    payloads = {}
+    times = {}
+    for index, frame in enumerate(frames):
+        raw = frame.raw if isinstance(frame, Message) else frame
+        if len(raw) < 7 or len(raw) != raw[2] + 7:
+            continue
+        layout = layouts.get((raw[1], raw[4], raw[2]))
+        if layout is None:
+            continue
+        payloads.setdefault(layout[0], []).append(raw[5:-2])
+        if timestamps is not None:
+            times.setdefault(layout[0], []).append(timestamps[index])
+
+    dtypes = dict(layouts.values())
+    # All payloads of one kind are joined into one buffer and reinterpreted without copying field by field
+    arrays = {name: np.frombuffer(b''.join(parts), dtypes[name]) for name, parts in payloads.items()}
+    if timestamps is None:
+        return arrays
+    return arrays, {name: np.asarray(values) for name, values in times.items()}
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Append-only binary capture of bus traffic.
+#
+# File layout (little endian):
+#   header   magic b'ATCAP\x00\x01\x00', wall clock ns and monotonic ns when the file was created
+#   records  monotonic timestamp ns (uint64), direction (uint8), length (uint16), raw bytes
+#   index    one entry per block of records: first timestamp, offset, record count, device mask, command mask
+#   trailer  index offset (uint64), number of index entries (uint64), magic b'ATCAPIDX'
+# The index and trailer are written when the file is closed. A file without them (e.g. after power loss)
+# is still readable, the index is rebuilt by scanning the records.
+
+import argparse
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+# Direction of a record, bytes received on port 1 or 2, or sent by the program to the port
+PORT1 = 0x01
+PORT2 = 0x02
+SENT = 0x80
+
+direction_text = {PORT1: '1 >> 2', PORT2: '2 >> 1', SENT | PORT1: 'P >> 1', SENT | PORT2: 'P >> 2'}
+
+_magic = b'ATCAP\x00\x01\x00'
+_index_magic = b'ATCAPIDX'
+_header = struct.Struct('<8sQQ')
+_record = struct.Struct('<QBH')
+_index_entry = struct.Struct('<QQIB32s')
+_trailer = struct.Struct('<QQ8s')
+
+
+class _Block:
+    # Index entry of a block of records, masks allow to skip blocks without the wanted messages
+    __slots__ = ('timestamp', 'offset', 'count', 'devices', 'commands')
+
+    def __init__(self, timestamp, offset, count=0, devices=0, commands=0):
+        self.timestamp = timestamp
+        self.offset = offset
+        self.count = count
+        self.devices = devices
+        self.commands = commands
+
+    def add(self, data):
+        self.count += 1
+        if len(data) >= 5 and data[0] == 0xaa:
+            self.devices |= 1 << (data[1] & 0x07)
+            self.commands |= 1 << data[4]
+
+    def pack(self):
+        return _index_entry.pack(self.timestamp, self.offset, self.count, self.devices,
+                                 self.commands.to_bytes(32, 'little'))
+
+    @classmethod
+    def unpack(cls, data, offset):
+        timestamp, position, count, devices, commands = _index_entry.unpack_from(data, offset)
+        return cls(timestamp, position, count, devices, int.from_bytes(commands, 'little'))
+
+    def may_contain(self, device, msg_id2):
+        if device is not None and not self.devices & (1 << (device & 0x07)):
+            return False
+        if msg_id2 is not None and not self.commands & (1 << msg_id2):
+            return False
+        return True
+
+
+def _scan(data, start, end, block_size):
+    # Rebuilds the index of a file without trailer
+    blocks = []
+    offset = start
+    while offset + _record.size <= end:
+        timestamp, direction, length = _record.unpack_from(data, offset)
+        if offset + _record.size + length > end:
+            break
+        if not blocks or blocks[-1].count >= block_size:
+            blocks.append(_Block(timestamp, offset))
+        blocks[-1].add(data[offset + _record.size:offset + _record.size + 5])
+        offset += _record.size + length
+    return blocks, offset
+
+
+class CaptureWriter:
+    def __init__(self, path, block_size=256):
+        self.path = path
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = []
+        self.records = 0
+
+        # Timestamps given to write() are monotonic time of this process
+        self.wall_ns = time.time_ns()
+        self.monotonic_ns = time.monotonic_ns()
+        self._clock_offset = 0  # Added to timestamps to get the monotonic clock of the file
+        if os.path.exists(path) and os.path.getsize(path) >= _header.size:
+            # Continue existing capture, its index is loaded and written again on close
+            with CaptureReader(path) as reader:
+                file_wall_ns, file_monotonic_ns = reader.wall_ns, reader.monotonic_ns
+                self._blocks = reader.blocks
+                end = reader.records_end
+                last = self._blocks[-1].timestamp if self._blocks else 0
+                for timestamp, direction, data in reader.records(last):
+                    last = timestamp
+            # The capture may come from before a restart or reboot with another monotonic clock. Timestamps are
+            # converted through the wall clock, and never before the last record, so the records stay sorted.
+            self._clock_offset = max(file_monotonic_ns + self.wall_ns - file_wall_ns - self.monotonic_ns,
+                                     last - self.monotonic_ns)
+            self._file = open(path, 'r+b')
+            self._file.truncate(end)
+            self._file.seek(end)
+            self._offset = end
+            self.records = sum(block.count for block in self._blocks)
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(_header.pack(_magic, self.wall_ns, self.monotonic_ns))
+            self._offset = _header.size
+
+    def write(self, direction, data, timestamp_ns=None):
+        if timestamp_ns is None:
+            timestamp_ns = time.monotonic_ns()
+        timestamp_ns += self._clock_offset
+        with self._lock:
+            if self._file is None:
+                return
+            blocks = self._blocks
+            if not blocks or blocks[-1].count >= self.block_size:
+                blocks.append(_Block(timestamp_ns, self._offset))
+            blocks[-1].add(data)
+            self._file.write(_record.pack(timestamp_ns, direction, len(data)))
+            self._file.write(data)
+            self._offset += _record.size + len(data)
+            self.records += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            for block in self._blocks:
+                self._file.write(block.pack())
+            self._file.write(_trailer.pack(self._offset, len(self._blocks), _index_magic))
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class CaptureReader:
+    def __init__(self, path, block_size=256):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._data
+
+        magic, self.wall_ns, self.monotonic_ns = _header.unpack_from(data, 0)
+        if magic != _magic:
+            raise ValueError('{} is not a capture file'.format(path))
+
+        self.blocks = None
+        if len(data) >= _header.size + _trailer.size:
+            index_offset, count, magic = _trailer.unpack_from(data, len(data) - _trailer.size)
+            if magic == _index_magic and index_offset + count * _index_entry.size + _trailer.size == len(data):
+                self.blocks = [_Block.unpack(data, index_offset + i * _index_entry.size) for i in range(count)]
+                self.records_end = index_offset
+        if self.blocks is None:
+            self.blocks, self.records_end = _scan(data, _header.size, len(data), block_size)
+        self._timestamps = [block.timestamp for block in self.blocks]
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return sum(block.count for block in self.blocks)
+
+    def wall_time(self, timestamp_ns):
+        # Converts monotonic timestamp of a record to seconds since epoch
+        return (self.wall_ns + timestamp_ns - self.monotonic_ns) / 1e9
+
+    def records(self, start_ns=None, end_ns=None, device=None, msg_id2=None, direction=None):
+        # Yields (timestamp ns, direction, raw bytes), only blocks which can contain matching records are read
+        data = self._data
+        first = 0
+        if start_ns is not None:
+            first = max(0, bisect.bisect_right(self._timestamps, start_ns) - 1)
+        for index in range(first, len(self.blocks)):
+            block = self.blocks[index]
+            if end_ns is not None and block.timestamp > end_ns:
+                return
+            if not block.may_contain(device, msg_id2):
+                continue
+            offset = block.offset
+            for i in range(block.count):
+                timestamp, record_direction, length = _record.unpack_from(data, offset)
+                start = offset + _record.size
+                offset = start + length
+                if start_ns is not None and timestamp < start_ns:
+                    continue
+                if end_ns is not None and timestamp > end_ns:
+                    return
+                if direction is not None and record_direction != direction:
+                    continue
+                if device is not None or msg_id2 is not None:
+                    if length < 5 or data[start] != 0xaa:
+                        continue
+                    if device is not None and data[start + 1] != device:
+                        continue
+                    if msg_id2 is not None and data[start + 4] != msg_id2:
+                        continue
+                yield timestamp, record_direction, data[start:offset]
+
+
+def import_text_log(path, writer, gap=1.0):
+    # Imports hand-written captures (message_captures/, messages/). Lines look like
+    # '  8.9 C >> H [2400]: aa 03 00 00 06 5e bc', '| **`T+2s`** | **C » H** | `AA 03 00 00 04 9F 3D` |'
+    # or 'H >> PC  aa 02 48 00 01 | 0001... | 51 06'. Lines without time are 'gap' seconds apart.
+    line_pattern = re.compile(r'^(?P<prefix>.*?)\b(?P<source>PC|C|H)\s*(?:>>|»)\s*(?:PC|C|H|P)\b\**(?P<rest>.*)$')
+    delay_pattern = re.compile(r'#\s*(\d+(?:\.\d+)?)\s*s delay')
+    time_pattern = re.compile(r'T\+(\d+(?:\.\d+)?)s|^\s*(\d+(?:\.\d+)?)\s*$')
+    hex_pattern = re.compile(r'(?:[0-9a-fA-F]{2})+')
+
+    base = writer.monotonic_ns
+    last = None
+    last_relative = None
+    imported = 0
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            match = delay_pattern.search(line)
+            if match:
+                gap = float(match.group(1))
+                continue
+            match = line_pattern.match(line)
+            if not match:
+                continue
+
+            data = bytearray()
+            for token in re.sub(r'[|`*:]', ' ', match.group('rest')).split():
+                if re.fullmatch(r'\[\d+\]', token):
+                    continue
+                if not hex_pattern.fullmatch(token):
+                    break
+                data += bytes.fromhex(token)
+            if not data:
+                continue
+
+            match_time = time_pattern.search(match.group('prefix').replace('*', '').replace('`', '').strip('| '))
+            if match_time:
+                relative = int(float(match_time.group(1) or match_time.group(2)) * 1e9)
+                if last_relative is not None and relative < last_relative:
+                    # Time of a new section starts again from zero
+                    base = last + int(gap * 1e9)
+                last_relative = relative
+                timestamp = base + relative
+            else:
+                timestamp = base if last is None else last + int(gap * 1e9)
+            last = timestamp
+
+            writer.write(PORT1 if match.group('source') in ('C', 'PC') else PORT2, bytes(data), timestamp)
+            imported += 1
+    return imported
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Binary captures of heater bus traffic')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_import = commands.add_parser('import', help='convert text captures to a binary capture')
+    parser_import.add_argument('output')
+    parser_import.add_argument('inputs', nargs='+')
+    parser_dump = commands.add_parser('dump', help='print records of a binary capture')
+    parser_dump.add_argument('capture')
+    parser_dump.add_argument('--device', type=lambda value: int(value, 0))
+    parser_dump.add_argument('--id', dest='msg_id2', type=lambda value: int(value, 0))
+    parser_dump.add_argument('--start', type=float, help='seconds from the first record')
+    parser_dump.add_argument('--end', type=float, help='seconds from the first record')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        with CaptureWriter(args.output) as writer:
+            for path in args.inputs:
+                print('{}: {} records'.format(path, import_text_log(path, writer)))
+    else:
+        with CaptureReader(args.capture) as reader:
+            first = reader.blocks[0].timestamp if reader.blocks else 0
+            start = None if args.start is None else first + int(args.start * 1e9)
+            end = None if args.end is None else first + int(args.end * 1e9)
+            for timestamp, direction, data in reader.records(start, end, args.device, args.msg_id2):
+                print('{:12.3f} {}: {}'.format((timestamp - first) / 1e9, direction_text.get(direction, direction),
+                                               data.hex(' ')))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Several heaters driven by one thread. All serial ports of all heaters are watched by one selector and every
+# heater keeps its own state, command queue and pending requests. Only heaters with new bytes, a queued message
+# or an expired timer are processed, the nearest deadline is taken from a heap.
+
+import collections
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import threading
+import time
+
+from autotermheater import AutotermHeater, AutotermUtils
+import autotermgateway
+import autotermmetrics
+import autotermshm
+import autotermstore
+
+
+class HeaterFleet(AutotermUtils):
+    def __init__(self, log_path, log_level=logging.DEBUG, async_log=False):
+        super().__init__(log_path, log_level, 'fleet', async_log)
+        self.log_path = log_path
+        self.log_level = log_level
+        self.async_log = async_log
+        self._heaters = collections.OrderedDict()
+        self._selector = selectors.DefaultSelector()
+        self._registered = {}  # Heater name: file descriptors registered in the selector
+        self._deadlines = []  # Heap of (deadline, sequence number, heater)
+        self._next_deadline = {}  # Heater name: its valid entry in the heap
+        self._sequence = itertools.count()
+        self._changes = collections.deque()  # Heaters added or removed, applied by the worker thread
+        self._max_wait = 1.0
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, (None, None))
+        self._working = False
+        self._worker = None
+        self._metrics = False
+        self._metrics_server = None
+        self._gateway = None
+        self._store = None
+        self._publishers = None  # Heater name: SnapshotPublisher while shared memory is on
+
+    def add(self, name, serial_port1=None, baudrate1=2400, serial_port2=None, baudrate2=2400, serial_num=None,
+            log_path=None, cut_through=False):
+        # Ports of the heater are opened in the background, it is served by the fleet's worker thread
+        if name in self._heaters:
+            raise ValueError('Heater {} is already in the fleet'.format(name))
+        heater = AutotermHeater(log_path or self.log_path, serial_port1, baudrate1, serial_port2, baudrate2, serial_num,
+                                self.log_level, name=name, worker=False, cut_through=cut_through,
+                                async_log=self.async_log)
+        heater._working = True
+        if self._metrics:
+            heater.start_metrics()
+        if self._gateway:
+            self._gateway.add(heater)
+        if self._store:
+            self._store.add(heater)
+        if self._publishers is not None:
+            self._publish(heater)
+        self._heaters[name] = heater
+        self._changes.append(('add', heater))
+        self._wake()
+        return heater
+
+    def remove(self, name):
+        heater = self._heaters.pop(name)
+        heater._working = False
+        if self._gateway:
+            self._gateway.remove(heater)
+        if self._store:
+            self._store.remove(heater)
+        if self._publishers is not None and name in self._publishers:
+            self._publishers.pop(name).close()
+        self._changes.append(('remove', heater))
+        self._wake()
+        return heater
+
+    def __getitem__(self, name):
+        return self._heaters[name]
+
+    def __contains__(self, name):
+        return name in self._heaters
+
+    def __iter__(self):
+        return iter(list(self._heaters.values()))
+
+    def __len__(self):
+        return len(self._heaters)
+
+    def snapshot(self):
+        # Last StatusSnapshot of every heater, None for heaters which have not reported yet
+        return {name: heater.get_status_snapshot() for name, heater in list(self._heaters.items())}
+
+    def start_metrics(self, port=9464, address='127.0.0.1'):
+        # Metrics of all heaters on one endpoint, heaters are distinguished by the heater label
+        self._metrics = True
+        for heater in self:
+            heater.start_metrics()
+        self._metrics_server = autotermmetrics.MetricsServer(lambda: [heater._metrics for heater in self], port,
+                                                             address).start()
+        return self._metrics_server
+
+    def stop_metrics(self):
+        self._metrics = False
+        if self._metrics_server:
+            self._metrics_server.stop()
+            self._metrics_server = None
+        for heater in self:
+            heater.stop_metrics()
+
+    def start_store(self, path, **options):
+        # One database for all heaters, values are stored by heater name
+        self.stop_store()
+        self._store = autotermstore.TelemetryStore(path, **options)
+        for heater in self:
+            self._store.add(heater)
+        return self._store
+
+    def stop_store(self):
+        if self._store:
+            self._store.close()
+            self._store = None
+
+    def start_shared_memory(self):
+        # Every heater gets its own block autoterm_<name> with notifications on socket_path(block name)
+        self.stop_shared_memory()
+        self._publishers = {}
+        for heater in self:
+            self._publish(heater)
+        return self._publishers
+
+    def stop_shared_memory(self):
+        if self._publishers is not None:
+            for publisher in self._publishers.values():
+                publisher.close()
+            self._publishers = None
+
+    def _publish(self, heater):
+        publisher = self._publishers[heater.name] = autotermshm.SnapshotPublisher('autoterm_{}'.format(heater.name))
+        publisher.add(heater)
+
+    def start_gateway(self, port=8080, address='127.0.0.1'):
+        # One gateway for all heaters, commands select the heater by its name
+        self.stop_gateway()
+        self._gateway = autotermgateway.Gateway(list(self), port, address).start()
+        return self._gateway
+
+    def stop_gateway(self):
+        if self._gateway:
+            self._gateway.stop()
+            self._gateway = None
+
+    def start(self):
+        self._working = True
+        self._worker = threading.Thread(target=self._worker_thread, daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._working = False
+        self._wake()
+        if self._worker:
+            self._worker.join(10.0)
+            self._worker = None
+
+    def close(self):
+        self.stop()
+        self.stop_metrics()
+        self.stop_gateway()
+        self.stop_store()
+        self.stop_shared_memory()
+        heaters = [self.remove(name) for name in list(self._heaters)]
+        # The worker has ended, its queued removals disconnect the heaters here
+        self._apply_changes()
+        for heater in heaters:
+            heater._selector.close()
+            os.close(heater._wake_r)
+            os.close(heater._wake_w)
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\x00')
+        except BlockingIOError:
+            pass
+
+    def _register(self, heater):
+        descriptors = [heater._wake_r]
+        self._selector.register(heater._wake_r, selectors.EVENT_READ, (heater, None))
+        for link in heater._links:
+            self._selector.register(link[0].fileno(), selectors.EVENT_READ, (heater, link))
+            descriptors.append(link[0].fileno())
+        self._registered[heater.name] = descriptors
+        self._schedule(heater, time.time())
+
+    def _unregister(self, heater):
+        for fd in self._registered.pop(heater.name, ()):
+            try:
+                self._selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+        self._next_deadline.pop(heater.name, None)
+
+    def _schedule(self, heater, deadline):
+        entry = (deadline, next(self._sequence), heater)
+        self._next_deadline[heater.name] = entry
+        heapq.heappush(self._deadlines, entry)
+
+    def _reconnect(self, heater):
+        # Runs in its own thread, connecting may take several seconds
+        heater._reconnect()
+        self._changes.append(('add', heater))
+        self._wake()
+
+    def _apply_changes(self):
+        while self._changes:
+            action, heater = self._changes.popleft()
+            self._unregister(heater)
+            if action == 'add' and self._heaters.get(heater.name) is heater:
+                if heater._connected:
+                    self._register(heater)
+                else:
+                    threading.Thread(target=self._reconnect, args=(heater,), daemon=True).start()
+            else:
+                heater._disconnect()
+
+    def _worker_thread(self):
+        self.logger.info('Fleet worker started')
+        deadlines = self._deadlines
+
+        while self._working:
+            self._apply_changes()
+
+            timeout = self._max_wait
+            if deadlines:
+                timeout = min(timeout, max(0, deadlines[0][0] - time.time()))
+
+            touched = {}
+            for key, events in self._selector.select(timeout):
+                heater, link = key.data
+                if heater is None:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                elif link is None:
+                    heater._clear_wake()
+                    touched[heater.name] = heater
+                elif heater._working:
+                    heater._process_link(*link)
+                    touched[heater.name] = heater
+
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                entry = heapq.heappop(deadlines)
+                heater = entry[2]
+                # Entries replaced by a newer deadline are skipped
+                if self._next_deadline.get(heater.name) is entry:
+                    touched[heater.name] = heater
+
+            for heater in touched.values():
+                if not heater._working:
+                    continue
+                if not heater._connected:
+                    self.logger.error('Heater {} was disconnected, reconnecting'.format(heater.name))
+                    self._unregister(heater)
+                    threading.Thread(target=self._reconnect, args=(heater,), daemon=True).start()
+                    continue
+                heater._process_expired()
+                self._schedule(heater, time.time() + heater._next_timeout())
+
+            # Keep the heap from growing with superseded entries
+            if len(deadlines) > 4 * len(self._next_deadline) + 64:
+                self._deadlines[:] = list(self._next_deadline.values())
+                heapq.heapify(self._deadlines)
@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# HTTP and WebSocket gateway to one or more heaters, e.g. for a building management system.
+#   GET  /telemetry            all values of all heaters as JSON, with ETag (If-None-Match is answered with 304)
+#   GET  /stream               WebSocket, pushes only changed values when a status, settings or diagnostic
+#                              message is processed
+#   POST /command/<command>    turn_on_heater, change_settings, turn_on_ventilation, shutdown or unblock, JSON body
+#                              with the arguments and "heater" (name, only needed with more heaters)
+# Every change is serialized once, all clients get the same bytes. Timestamps are left out of the values,
+# so the ETag changes only when a value changes.
+
+import base64
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import os
+import select
+import struct
+import threading
+import time
+
+# Command: (required arguments, optional arguments), all arguments are integers
+commands = {'turn_on_heater': (('mode',), ('setpoint', 'ventilation', 'power', 'timer')),
+            'change_settings': (('mode',), ('setpoint', 'ventilation', 'power', 'timer')),
+            'turn_on_ventilation': (('power',), ('timer',)),
+            'shutdown': ((), ()),
+            'unblock': ((), ())}
+
+_websocket_guid = b'258EAFA5-E914-47DA-95CA-C5AB0DC11B85'
+_sections = {'StatusSnapshot': 'status', 'SettingsSnapshot': 'settings', 'DiagnosticSnapshot': 'diagnostic'}
+
+
+def websocket_frame(payload, opcode=0x1):
+    # Unmasked frame from the server, text by default
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def read_websocket_frame(file):
+    # Returns (opcode, payload) of a masked frame from the client, None when the connection was closed
+    header = file.read(2)
+    if len(header) < 2:
+        return None
+    opcode = header[0] & 0x0f
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', file.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', file.read(8))[0]
+    mask = file.read(4) if header[1] & 0x80 else b'\x00' * 4
+    payload = file.read(length)
+    return opcode, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+
+def _input_pending(connection, file, poller):
+    # Bytes from the client in the socket, or already read into the buffer of file with a previous frame
+    if poller.poll(0):
+        return True
+    timeout = connection.gettimeout()
+    connection.settimeout(0)
+    try:
+        return bool(file.peek(1))
+    finally:
+        connection.settimeout(timeout)
+
+
+class Gateway:
+    def __init__(self, heaters=(), port=8080, address='127.0.0.1', command_timeout=5.0):
+        self.command_timeout = command_timeout
+        self._heaters = {}
+        self._connection_callbacks = {}  # Heater name: its connection callback
+        self._condition = threading.Condition()
+        self._state = {}  # Heater name: section: values
+        self._version = 0
+        self._nonce = os.urandom(4).hex()  # Part of the ETag, versions start again with every process
+        self._delta = None  # WebSocket frame with the change which made the current version
+        self._full = None  # (version, JSON, WebSocket frame), created with the first request
+        self._clients = 0
+        self._running = True
+        for heater in heaters:
+            self.add(heater)
+        gateway = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/telemetry':
+                    version, body, frame = gateway._full_snapshot()
+                    etag = '"{}-{}"'.format(gateway._nonce, version)
+                    if etag in self.headers.get('If-None-Match', ''):
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self._send(200, body, etag)
+                elif path == '/stream' and self.headers.get('Upgrade', '').lower() == 'websocket':
+                    self._stream()
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                parts = self.path.split('?')[0].strip('/').split('/')
+                if len(parts) != 2 or parts[0] != 'command' or parts[1] not in commands:
+                    self.send_error(404)
+                    return
+                try:
+                    arguments = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    status, result = gateway.command(parts[1], arguments)
+                except (ValueError, TypeError, KeyError, OverflowError) as error:
+                    status, result = 400, {'error': str(error)}
+                self._send(status, json.dumps(result).encode())
+
+            def _send(self, status, body, etag=None):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self):
+                key = self.headers.get('Sec-WebSocket-Key', '').encode()
+                self.send_response(101)
+                self.send_header('Upgrade', 'websocket')
+                self.send_header('Connection', 'Upgrade')
+                self.send_header('Sec-WebSocket-Accept',
+                                 base64.b64encode(hashlib.sha1(key + _websocket_guid).digest()).decode())
+                self.end_headers()
+                self.close_connection = True
+                # A client which does not read is disconnected instead of blocking others
+                self.connection.settimeout(10.0)
+                try:
+                    gateway._serve_stream(self.connection, self.rfile)
+                except OSError:
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((address, port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for heater in list(self._heaters.values()):
+            self.remove(heater)
+
+    def add(self, heater):
+        name = heater.name or 'heater'
+        self._heaters[name] = heater
+        heater.register_snapshot_callback(self._on_snapshot)
+        callback = self._connection_callbacks[name] = lambda state: self._update(name, 'connection', {'state': state})
+        heater.register_connection_callback(callback)
+        self._update(name, 'connection', {'state': heater.get_connection_state()})
+        for snapshot in (heater.get_status_snapshot(), heater.get_settings_snapshot(),
+                         heater.get_diagnostic_snapshot()):
+            if snapshot:
+                self._on_snapshot(heater, snapshot)
+
+    def remove(self, heater):
+        name = heater.name or 'heater'
+        if self._heaters.get(name) is not heater:
+            return
+        del self._heaters[name]
+        heater.unregister_snapshot_callback(self._on_snapshot)
+        heater.unregister_connection_callback(self._connection_callbacks.pop(name))
+        with self._condition:
+            if self._state.pop(name, None) is not None:
+                self._publish({name: None})
+
+    def command(self, command, arguments):
+        # Returns HTTP status and JSON result, waits for the heater response at most command_timeout.
+        # Raises ValueError for arguments which the command does not take.
+        if not isinstance(arguments, dict):
+            raise ValueError('Arguments must be a JSON object')
+        arguments = dict(arguments)
+        name = arguments.pop('heater', None)
+        required, optional = commands[command]
+        for key, value in arguments.items():
+            if key not in required and key not in optional:
+                raise ValueError('Unknown argument {} of {}'.format(key, command))
+            if type(value) is not int:
+                raise ValueError('Argument {} must be an integer'.format(key))
+        for key in required:
+            if key not in arguments:
+                raise ValueError('Missing argument {} of {}'.format(key, command))
+        if name is None and len(self._heaters) == 1:
+            name = next(iter(self._heaters))
+        heater = self._heaters.get(name)
+        if heater is None:
+            return 404, {'error': 'Unknown heater {}'.format(name)}
+        future = getattr(heater, command)(**arguments)
+        if future is None:
+            return 202, {'heater': name, 'command': command}
+        try:
+            response = future.result(self.command_timeout)
+        except (TimeoutError, concurrent.futures.TimeoutError) as error:
+            return 504, {'heater': name, 'command': command, 'error': str(error)}
+        except concurrent.futures.CancelledError:
+            # Request was dropped from the full queue
+            return 503, {'heater': name, 'command': command, 'error': 'Request was dropped'}
+        return 200, {'heater': name, 'command': command, 'response': response.payload.hex()}
+
+    def _on_snapshot(self, heater, snapshot):
+        # Called from the worker thread of the heater
+        values = snapshot._asdict()
+        del values['timestamp']
+        if _sections[type(snapshot).__name__] == 'status':
+            values['text'] = snapshot.text
+        self._update(heater.name or 'heater', _sections[type(snapshot).__name__], values)
+
+    def _update(self, name, section, values):
+        with self._condition:
+            sections = self._state.setdefault(name, {})
+            previous = sections.get(section, {})
+            changed = {key: value for key, value in values.items()
+                       if key not in previous or previous[key] != value}
+            if not changed:
+                return
+            sections[section] = values
+            self._publish({name: {section: changed}})
+
+    def _publish(self, heaters):
+        # Holds the condition, the delta is serialized only if somebody listens
+        self._version += 1
+        self._delta = None
+        if self._clients:
+            self._delta = websocket_frame(json.dumps(
+                {'version': self._version, 'timestamp': time.time(), 'heaters': heaters}).encode())
+        self._condition.notify_all()
+
+    def _full_snapshot(self):
+        with self._condition:
+            if self._full is None or self._full[0] != self._version:
+                body = json.dumps({'version': self._version, 'heaters': self._state}).encode()
+                self._full = (self._version, body, None)
+            return self._full
+
+    def _full_frame(self):
+        with self._condition:
+            version, body, frame = self._full_snapshot()
+            if frame is None:
+                frame = websocket_frame(body)
+                self._full = (version, body, frame)
+            return version, frame
+
+    def _serve_stream(self, connection, file):
+        # The first message is the full snapshot, a client which missed a change gets the full snapshot again
+        with self._condition:
+            self._clients += 1
+        try:
+            sent, frame = self._full_frame()
+            connection.sendall(frame)
+            # poll() has no limit of file descriptor numbers like select()
+            poller = select.poll()
+            poller.register(connection, select.POLLIN)
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._version != sent or not self._running, 1.0)
+                    if not self._running:
+                        return
+                    if self._version == sent:
+                        frame = None
+                    elif self._version == sent + 1 and self._delta is not None:
+                        sent, frame = self._version, self._delta
+                    else:
+                        sent, frame = self._full_frame()
+                if frame:
+                    connection.sendall(frame)
+                while _input_pending(connection, file, poller):
+                    received = read_websocket_frame(file)
+                    if received is None or received[0] == 0x8:
+                        connection.sendall(websocket_frame(b'', 0x8))
+                        return
+                    if received[0] == 0x9:
+                        connection.sendall(websocket_frame(received[1], 0xa))
+        finally:
+            with self._condition:
+                self._clients -= 1
@@ -1,12 +1,26 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import collections
+import concurrent.futures
+import json
 import logging
+import os
+import selectors
 import serial
 import serial.tools.list_ports as list_ports
+import struct
 import threading
 import time
 
+import autotermcapture
+import autotermgateway
+import autotermlog
+import autotermmetrics
+import autotermstore
+import autotermtelemetry
+import autotermtiming
+
 ################
 versionMajor = 0
 versionMinor = 1
@@ -16,65 +30,402 @@ versionPatch = 2
 status_text = {0: 'heater off', 1: 'starting', 2: 'warming up', 3: 'running', 4: 'shutting down'}
 
 
+def _make_crc16_table():
+    # CRC-16/Modbus (reflected polynomial 0xa001), one entry per possible byte value
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            if (crc & 0x0001) != 0:
+                crc >>= 1
+                crc ^= 0xa001
+            else:
+                crc >>= 1
+        table.append(crc)
+    # Tuple indexing is faster than list or array indexing in CPython
+    return tuple(table)
+
+
+crc16_table = _make_crc16_table()
+
+
+def crc16_update(crc, data):
+    table = crc16_table
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+
+class Crc16:
+    # Incremental CRC, can be fed with chunks of a frame as they arrive
+    def __init__(self, data=b''):
+        self.crc = crc16_update(0xffff, data)
+
+    def update(self, data):
+        self.crc = crc16_update(self.crc, data)
+        return self
+
+    def copy(self):
+        other = Crc16()
+        other.crc = self.crc
+        return other
+
+    def reset(self):
+        self.crc = 0xffff
+
+    def digest(self):
+        return self.crc.to_bytes(2, byteorder='big')
+
+
+valid_devices = (0x00, 0x02, 0x03, 0x04)
+
+
+class LazyHex:
+    # Logging argument, hex() is called only if the message is really logged
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex()
+
+
 class Message:
-    def __init__(self, preamble, device, length, msg_id1, msg_id2, payload=b''):
+    def __init__(self, preamble, device, length, msg_id1, msg_id2, payload=b'', raw=b'', timestamp_ns=None):
         self.preamble = preamble
         self.device = device
         self.length = length
         self.msg_id1 = msg_id1
         self.msg_id2 = msg_id2
         self.payload = payload
+        # Whole frame including preamble and crc
+        self.raw = raw
+        # Monotonic time when the last byte was on the line, estimated from the bytes received after it
+        self.timestamp_ns = timestamp_ns
+
+
+class FrameDecoder:
+    # Incremental decoder, accepts chunks of arbitrary size and returns complete valid messages.
+    # Bytes which are not part of any valid message are passed to on_garbage (e.g. 1b 1b from the controller).
+    min_packet_size = 7
+
+    def __init__(self, logger=None, on_garbage=None):
+        self.logger = logger
+        self.on_garbage = on_garbage
+        self._buffer = bytearray()
+        self.last_feed_ns = time.monotonic_ns()
+        self.last_feed = self.last_feed_ns / 1e9
+        self.frame_start = self.last_feed  # When the first byte of the incomplete message was received
+        self.byte_ns = 0  # Wire time of one byte, set by the owner of the port
+
+        # Statistics
+        self.frames = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+        self.discarded = 0
+
+    def reset(self):
+        self._buffer.clear()
+
+    def pending(self):
+        return len(self._buffer)
+
+    def _discard(self, start, end):
+        if end > start:
+            self.discarded += end - start
+            if self.on_garbage:
+                self.on_garbage(bytes(self._buffer[start:end]))
+
+    def flush(self):
+        # Called when the line is idle, an incomplete message will never be finished.
+        # Its preamble is treated as garbage and the rest of the buffer is searched for valid messages again.
+        if not self._buffer:
+            return []
+        self.resyncs += 1
+        self._discard(0, 1)
+        del self._buffer[:1]
+        return self.feed(b'')
+
+    def feed(self, data):
+        buffer = self._buffer
+        if data:
+            self.last_feed_ns = time.monotonic_ns()
+            self.last_feed = self.last_feed_ns / 1e9
+            if not buffer:
+                self.frame_start = self.last_feed
+        buffer += data
+        messages = []
+        start = 0
+        size = len(buffer)
+
+        while start < size:
+            if buffer[start] != 0xaa:
+                # Resync on the next preamble
+                pos = buffer.find(b'\xaa', start)
+                if pos < 0:
+                    pos = size
+                self._discard(start, pos)
+                self.resyncs += 1
+                start = pos
+                continue
+            if size - start < self.min_packet_size:
+                break
+            if buffer[start + 1] not in valid_devices:
+                self._discard(start, start + 1)
+                start += 1
+                continue
+            end = start + buffer[start + 2] + self.min_packet_size
+            if end > size:
+                break
+            with memoryview(buffer) as view:
+                crc = crc16_update(0xffff, view[start:end - 2])
+            if crc != (buffer[end - 2] << 8) | buffer[end - 1]:
+                self.crc_errors += 1
+                if self.logger:
+                    self.logger.error('Decoder: invalid crc of package! ({})'.format(buffer[start:end].hex()))
+                # The preamble could have been a data byte, search again from the next byte
+                self._discard(start, start + 1)
+                start += 1
+                continue
+            raw = bytes(buffer[start:end])
+            messages.append(Message(raw[0], raw[1], raw[2], raw[3], raw[4], raw[5:-2], raw,
+                                    self.last_feed_ns - (size - end) * self.byte_ns))
+            self.frames += 1
+            start = end
+
+        # Drop consumed bytes, the remaining part of the buffer is an incomplete message
+        if start:
+            del buffer[:start]
+            self.frame_start = self.last_feed
+        return messages
+
+
+class SettingsSnapshot(collections.namedtuple('SettingsSnapshot', 'timestamp timer mode setpoint ventilation '
+                                                                  'power_level')):
+    # Decoded 6 byte payload of 0x01 and 0x02 messages from the heater
+    __slots__ = ()
+    _struct = struct.Struct('>H4B')
+
+    @classmethod
+    def decode(cls, payload, timestamp):
+        return cls(timestamp, *cls._struct.unpack_from(payload))
+
+
+class StatusSnapshot(collections.namedtuple('StatusSnapshot', 'timestamp status1 status2 errors heater_temperature '
+                                                              'external_temperature battery_voltage flame_temperature '
+                                                              'fan_setpoint fan_actual fuel_pump water_pump',
+                                            defaults=(None, None, None, None))):
+    # Decoded 0x0f message from the heater, fan and pump values are present only in the 19 byte version
+    __slots__ = ()
+    _struct = struct.Struct('>3B2bHH')
+    _struct_extended = struct.Struct('>3B2bHH2xBBxB3xB')
+
+    @classmethod
+    def decode(cls, payload, timestamp):
+        if len(payload) >= cls._struct_extended.size:
+            status1, status2, errors, heater_temperature, external_temperature, battery_voltage, flame_temperature, \
+                fan_setpoint, fan_actual, fuel_pump, water_pump = cls._struct_extended.unpack_from(payload)
+            return cls(timestamp, status1, status2, errors, heater_temperature, external_temperature,
+                       battery_voltage / 10, flame_temperature, fan_setpoint, fan_actual, fuel_pump / 10, water_pump)
+        status1, status2, errors, heater_temperature, external_temperature, battery_voltage, flame_temperature = \
+            cls._struct.unpack_from(payload)
+        return cls(timestamp, status1, status2, errors, heater_temperature, external_temperature, battery_voltage / 10,
+                   flame_temperature)
+
+    @property
+    def text(self):
+        return status_text.get(self.status1, 'unknown status')
+
+
+class HistorySnapshot(collections.namedtuple('HistorySnapshot', 'timestamp run_hours starts error1 error2 error3')):
+    # Decoded 7 or 9 byte 0x0b message from the heater
+    __slots__ = ()
+    _struct = struct.Struct('>HH3B')
+
+    @classmethod
+    def decode(cls, payload, timestamp):
+        return cls(timestamp, *cls._struct.unpack_from(payload))
+
+
+class DiagnosticSnapshot(collections.namedtuple('DiagnosticSnapshot', 'timestamp status1 status2 counter1 counter2 '
+                                                                      'defined_rev measured_rev fuel_pump1 fuel_pump2 '
+                                                                      'chamber_temperature flame_temperature '
+                                                                      'external_temperature heater_temperature '
+                                                                      'battery_voltage')):
+    # Decoded 72 byte diagnostic message from the heater, 24 bit counters are split to 8 + 16 bits
+    __slots__ = ()
+    _struct = struct.Struct('>BB3xBHBHBBxBxBxHH2xbbH')
+
+    @classmethod
+    def decode(cls, payload, timestamp):
+        status1, status2, counter1_high, counter1, counter2_high, counter2, defined_rev, measured_rev, fuel_pump1, \
+            fuel_pump2, chamber_temperature, flame_temperature, external_temperature, heater_temperature, \
+            battery_voltage = cls._struct.unpack_from(payload)
+        return cls(timestamp, status1, status2, (counter1_high << 16) | counter1, (counter2_high << 16) | counter2,
+                   defined_rev, measured_rev, fuel_pump1, fuel_pump2, chamber_temperature, flame_temperature,
+                   external_temperature, heater_temperature, battery_voltage / 10)
+
+
+class CommandQueue:
+    # Messages waiting to be sent to the heater, items are [message, future, attempts, not_before].
+    # Each priority class is a bounded deque, a newer message of the same kind replaces the queued one.
+    STOP, CONTROL, POLL, TEMPERATURE = range(4)
+
+    def __init__(self, maxlen=16):
+        self.maxlen = maxlen
+        self._queues = tuple(collections.deque() for i in range(4))
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    @classmethod
+    def priority(cls, message):
+        msg_id2 = message[4]
+        if msg_id2 == 0x03:
+            return cls.STOP
+        if msg_id2 == 0x11:
+            return cls.TEMPERATURE
+        if msg_id2 in (0x04, 0x06, 0x0b, 0x0f) or (msg_id2 == 0x02 and message[2] == 0):
+            return cls.POLL
+        return cls.CONTROL
+
+    @staticmethod
+    def expects_reply(message):
+        # Messages of the diagnostic software (device 0x02), e.g. its keepalive aa 02 00 00 00, get no response
+        return message[1] != 0x02
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def put(self, item, coalesce=True):
+        message = item[0]
+        queue = self._queues[self.priority(message)]
+        with self._lock:
+            if coalesce:
+                for old in [old for old in queue if old[0][4] == message[4] and old[0][2] == message[2]]:
+                    queue.remove(old)
+                    _chain_future(item[1], old[1])
+                    self.coalesced += 1
+            if len(queue) >= self.maxlen:
+                queue.popleft()[1].cancel()
+                self.dropped += 1
+            queue.append(item)
+            self.queued += 1
+
+    def put_front(self, item):
+        with self._lock:
+            self._queues[self.priority(item[0])].appendleft(item)
+
+    def peek(self):
+        with self._lock:
+            for queue in self._queues:
+                if queue:
+                    return queue[0]
+        return None
+
+    def pop(self, condition=None):
+        # Removes the first message of the highest priority class if it fulfils the condition
+        with self._lock:
+            for queue in self._queues:
+                if queue:
+                    if condition and not condition(queue[0]):
+                        return None
+                    return queue.popleft()
+        return None
+
+    def contains(self, msg_id2):
+        with self._lock:
+            return any(item[0][4] == msg_id2 for queue in self._queues for item in queue)
+
+    def take_polls(self, msg_id2):
+        # Removes and returns queued requests of the poll class with the command ID
+        with self._lock:
+            queue = self._queues[self.POLL]
+            items = [item for item in queue if item[0][4] == msg_id2]
+            for item in items:
+                queue.remove(item)
+            return items
+
+    def stats(self):
+        return {'depth': len(self), 'queued': self.queued, 'coalesced': self.coalesced, 'dropped': self.dropped,
+                'priorities': [len(queue) for queue in self._queues]}
+
+
+def _chain_future(source, target):
+    # Result of the source future is passed to the target future
+    def copy_result(future):
+        if target.done():
+            return
+        if future.cancelled():
+            target.cancel()
+        elif future.exception():
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+
+    source.add_done_callback(copy_result)
 
 
 class AutotermUtils:
-    def __init__(self, log_path, log_level=logging.DEBUG):
-        self.logger = logging.getLogger(__name__)
+    def __init__(self, log_path, log_level=logging.DEBUG, name=None, async_log=False):
+        # Heaters with a name log to their own child logger, e.g. autotermheater.garage
+        self.logger = logging.getLogger(__name__ if name is None else '{}.{}'.format(__name__, name))
         self.logger.setLevel(log_level)
-        handler = logging.FileHandler(log_path)
+        self.log_handler = None
+        for handler in self.logger.handlers:
+            # Another object with the same logger already writes to the file
+            if getattr(handler, 'baseFilename', None) == os.path.abspath(log_path):
+                self.log_handler = handler
+                return
+        # With async_log the file is written by a background thread, see autotermlog
+        if async_log:
+            handler = autotermlog.AsyncFileHandler.shared(log_path)
+        else:
+            handler = logging.FileHandler(log_path)
         formatter = logging.Formatter(fmt='%(asctime)s  %(name)s %(levelname)s: %(message)s',
                                       datefmt='%d.%m.%Y %H:%M:%S')
         handler.setFormatter(formatter)
         handler.setLevel(logging.DEBUG)
         self.logger.addHandler(handler)
+        self.log_handler = handler
+
+    def get_log_stats(self):
+        # Written, dropped and summarized records of the background writer, None for the plain file handler
+        if isinstance(self.log_handler, autotermlog.AsyncFileHandler):
+            return self.log_handler.stats()
+        return None
 
     @staticmethod
     def crc16(package: bytes):
-        crc = 0xffff
-        for byte in package:
-            crc ^= byte
-            for i in range(8):
-                if (crc & 0x0001) != 0:
-                    crc >>= 1
-                    crc ^= 0xa001
-                else:
-                    crc >>= 1
-        return crc.to_bytes(2, byteorder='big')
+        return crc16_update(0xffff, package).to_bytes(2, byteorder='big')
 
     def parse(self, package: bytes, min_packet_size=7):
         if len(package) < min_packet_size:
             self.logger.error('Parse: invalid length of package! ({})'.format(package.hex()))
             return 0
-        while package[0] != 0xaa:
-            if len(package) < min_packet_size:
-                self.logger.error('Parse: invalid package! ({})'.format(package.hex()))
-                return 0
-            package = package[1:]
-        if package[0] != 0xaa:
-            self.logger.error('Parse: invalid bit 0 of package! ({})'.format(package.hex()))
+        start = package.find(b'\xaa')
+        if start < 0 or len(package) - start < min_packet_size:
+            self.logger.error('Parse: invalid package! ({})'.format(package.hex()))
             return 0
+        if start:
+            package = package[start:]
         if len(package) != int(package[2]) + min_packet_size:
             self.logger.error('Parse: invalid length of package! ({})'.format(package.hex()))
             return 0
-        if package[1] not in [0x00, 0x02, 0x03, 0x04]:
+        if package[1] not in valid_devices:
             self.logger.error('Parse: invalid bit 1 of package! ({})'.format(package.hex()))
             return 0
         if package[-2:] != self.crc16(package[:-2]):
             self.logger.error('Parse: invalid crc of package! ({})'.format(package.hex()))
             return 0
-        return Message(package[0], package[1], package[2], package[3], package[4], package[5:-2])
+        return Message(package[0], package[1], package[2], package[3], package[4], package[5:-2], bytes(package))
 
     def build(self, device, msg_id2, msg_id1=0x00, payload=b''):
-        if device not in [0x00, 0x02, 0x03, 0x04]:
+        if device not in valid_devices:
             self.logger.error('Built: invalid device! ({})'.format(device))
             return 0
         if msg_id1 not in range(256):
@@ -91,32 +442,78 @@ class AutotermUtils:
 
 
 class AutotermHeater(AutotermUtils):
+    # Baud rate 'auto' probes the heater like the controllers do during initialization (controller_initialization.md),
+    # 'sniff' only listens to the traffic of a connected control panel. Detected rates are cached per adapter.
+    autobaud_rates = (2400, 1200, 9600, 4800)
+    autobaud_probes = ((2400, 0x1c), (1200, 0x1e), (2400, 0x04), (9600, 0x04), (9600, 0x06), (4800, 0x04),
+                       (1200, 0x04))
+    autobaud_listen = 1.2  # Seconds spent listening at one baud rate, control panels send a message every second
+    autobaud_cache = os.path.join(os.path.expanduser('~'), '.autotermheater_baudrates.json')
+    # Reconnection attempts start quickly and slow down up to the maximum delay
+    reconnect_delay_min = 0.01
+    reconnect_delay_max = 2.0
+    # Links of USB serial adapters, the port list is refreshed when its content changes
+    ports_directory = '/dev/serial/by-id'
+    # Seconds between status and settings requests for each heater status (status1), None before the first status.
+    # Requests are not sent while the control panel asks itself, its exchanges are used instead.
+    poll_intervals = {None: (2, 5), 0: (20, 60), 1: (1, 10), 2: (1, 10), 3: (5, 30), 4: (2, 30)}
+    poll_boost = (10, 1)  # After a control message status is requested every second for 10 s
+    bus_budget = 0.3  # Part of the bus time which own requests may use together with the other traffic
+    bus_window = 10  # Seconds over which the other traffic is measured
+    # With a control panel own requests are sent between its exchanges with the heater, see autotermtiming
+    gap_scheduling = True
+
     def __init__(self, log_path, serial_port1=None, baudrate1=2400, serial_port2=None, baudrate2=2400, serial_num=None,
-                 log_level=logging.DEBUG):
-        super().__init__(log_path, log_level)
+                 log_level=logging.DEBUG, name=None, worker=True, cut_through=False, async_log=False):
+        super().__init__(log_path, log_level, name, async_log)
+        self.name = name
+        # In passthrough mode bytes are forwarded to the other port as soon as they are read, messages are decoded
+        # from the same bytes afterwards. Otherwise a message is forwarded when it was completely received.
+        self.cut_through = cut_through
         self.port1 = serial_port1
         self.baudrate1 = baudrate1
         self.port2 = serial_port2
         self.baudrate2 = baudrate2
         self.serial_num = serial_num
 
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(log_level)
-        handler = logging.FileHandler(log_path)
-        formatter = logging.Formatter(fmt='%(asctime)s  %(name)s %(levelname)s: %(message)s',
-                                      datefmt='%d.%m.%Y %H:%M:%S')
-        handler.setFormatter(formatter)
-        handler.setLevel(logging.DEBUG)
-        self.logger.addHandler(handler)
-
         self.logger.info('AutotermHeater v {}.{}.{} is starting.'.format(versionMajor, versionMinor, versionPatch))
 
+        self._ser1 = None
+        self._ser2 = None
+        self._capture = None
+        self._telemetry = None
+        self._metrics = None
+        self._metrics_server = None
+        self._gateway = None
+        self._store = None
+        self._hub = None  # LinkHub sharing the link with other programs
+        self._ser_heater = None
+        self._ser_controller = None
+        self._links = []
+        self._ports = None  # Cached list of serial ports with the content of ports_directory
+        self._frame_timeout = 0.5  # Incomplete message is dropped after this idle time
+        self._max_wait = 1.0  # Longest time the worker thread sleeps without checking timers
+        # Pipe used to wake up the worker thread waiting in select()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+        # Ports are opened by the worker thread, the constructor does not wait for them
         self._connected = False
-        while not self._connected:
-            self._connect()
-
+        self._connection_state = 'connecting'
+        self._connected_event = threading.Event()
+        self._connection_callbacks = []
+        self._snapshot_callbacks = []
+        self._connect_failures = 0
+        self._reconnect_delay = self.reconnect_delay_min
+        self._reconnect_time = 0
         self._working = False
-        self._start_working()
+
+        self._worker = None
+        # Without own worker thread the heater is driven by a HeaterFleet
+        self._start_working(worker)
 
     def _write_message(self, ser_port, message):
         try:
@@ -126,21 +523,120 @@ class AutotermHeater(AutotermUtils):
             self._connected = False
             self.logger.error('Cannot write to serial port {}!'.format(ser_port.port))
 
-    def _message_waiting(self, ser_port):
+    def _read_message(self, ser_port):
         try:
-            return ser_port.in_waiting
-        except OSError:
+            # Port is readable, read(1) reports a disconnected adapter if nothing is waiting
+            return ser_port.read(ser_port.in_waiting or 1)
+        except (OSError, serial.serialutil.SerialException):
             self._connected = False
-            self.logger.error('Cannot check serial port {} for incoming messages!'.format(ser_port.port))
-            return 0
+            self.logger.error('Cannot read from serial port {}!'.format(ser_port.port))
+            return b''
+
+    def _capture_write(self, ser_port, data, sent=False):
+        capture = self._capture
+        if capture:
+            capture.write((autotermcapture.PORT1 if ser_port is self._ser1 else autotermcapture.PORT2) |
+                          (autotermcapture.SENT if sent else 0), data)
+
+    def start_capture(self, path):
+        # Records all bus traffic to a binary capture file, see autotermcapture
+        self.stop_capture()
+        self._capture = autotermcapture.CaptureWriter(path)
+
+    def stop_capture(self):
+        capture = self._capture
+        self._capture = None
+        if capture:
+            capture.close()
+
+    def start_telemetry(self, history=None):
+        # Keeps history of status and diagnostic values in fixed-size buffers, see autotermtelemetry
+        self._telemetry = history or autotermtelemetry.TelemetryHistory()
+        return self._telemetry
+
+    def stop_telemetry(self):
+        self._telemetry = None
+
+    def get_telemetry(self, channel, start=None, end=None, resolution=autotermtelemetry.RAW):
+        # Values of the channel between start and end (seconds since epoch) as arrays
+        if self._telemetry is None:
+            return None
+        return self._telemetry.range(channel, start, end, resolution)
+
+    def start_metrics(self, port=None, address='127.0.0.1'):
+        # Counters of the worker loop, served in Prometheus format on http://address:port/metrics if port is given
+        self.stop_metrics()
+        self._metrics = autotermmetrics.HeaterMetrics(self)
+        if port is not None:
+            self._metrics_server = autotermmetrics.MetricsServer([self._metrics], port, address).start()
+        return self._metrics
+
+    def stop_metrics(self):
+        if self._metrics_server:
+            self._metrics_server.stop()
+            self._metrics_server = None
+        self._metrics = None
+
+    def start_store(self, path, **options):
+        # Status, settings and diagnostic values are saved to an SQLite database, see autotermstore
+        self.stop_store()
+        self._store = autotermstore.TelemetryStore(path, **options)
+        self._store.add(self)
+        return self._store
+
+    def stop_store(self):
+        if self._store:
+            self._store.close()
+            self._store = None
+
+    def start_gateway(self, port=8080, address='127.0.0.1'):
+        # Telemetry and commands over HTTP and WebSocket on http://address:port, see autotermgateway
+        self.stop_gateway()
+        self._gateway = autotermgateway.Gateway([self], port, address).start()
+        return self._gateway
+
+    def stop_gateway(self):
+        if self._gateway:
+            self._gateway.stop()
+            self._gateway = None
+
+    def _forward_garbage(self, ser_port, direction, data):
+        # Bytes outside of valid messages (e.g. 1b 1b initialization from the controller) are forwarded unchanged
+        self._capture_write(self._ser2 if ser_port is self._ser1 else self._ser1, data)
+        if ser_port:
+            if not self.cut_through:
+                self._write_message(ser_port, data)
+            self.logger.debug('Unknown bytes forwarded (%s: %s)', direction, LazyHex(data))
+        else:
+            self.logger.warning('Unknown bytes detected, disposed ({}: {})'.format(direction, data.hex()))
+
+    def _comports(self):
+        # Port list is enumerated again only when USB serial adapters were plugged in or removed
+        try:
+            signature = tuple(sorted(os.listdir(self.ports_directory)))
+        except OSError:
+            signature = ()
+        if self._ports is None or self._ports[0] != signature:
+            self._ports = (signature, list_ports.comports())
+        return self._ports[1]
+
+    def _open_port(self, device, baudrate):
+        ser_port = serial.Serial(device, self._initial_baudrate(device, baudrate), bytesize=serial.EIGHTBITS,
+                                 parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.5,
+                                 write_timeout=0.5)
+        ser_port.reset_input_buffer()
+        self._autobaud(ser_port, baudrate)
+        self.logger.info('Serial connection to ' + device + ' established')
+        return ser_port
 
     def _connect(self):
+        # One attempt to open the ports, returns True when connected
         if self.serial_num:
             # Search for USB devices based on serial number
-            ports = [port.device for port in list_ports.comports() if port.serial_number == self.serial_num]
+            ports = [port.device for port in self._comports() if port.serial_number == self.serial_num]
             if len(ports) == 0:
-                self.logger.error('No serial adapters were found!')
-                time.sleep(10)
+                self._connect_error('No serial adapters were found!')
+                return False
             elif len(ports) == 1:
                 self.port1 = ports[0]
                 self.port2 = None
@@ -150,62 +646,233 @@ class AutotermHeater(AutotermUtils):
                 self.port2 = ports[1]
                 self.logger.info('Two serial adapters were found')
             else:
-                self.logger.error('More than two serial adapters were found!')
-                time.sleep(10)
+                self._connect_error('More than two serial adapters were found!')
+                return False
+        if not self.port1:
+            self._connect_error('No serial port is set!')
+            return False
 
         # Try to connect to one or both adapters
-        if self.port1:
+        try:
+            self._ser1 = self._open_port(self.port1, self.baudrate1)
+            if self.port2:
+                self._ser2 = self._open_port(self.port2, self.baudrate2)
+        except (OSError, serial.serialutil.SerialException):
+            self._connect_error('Cannot connect to serial port!')
+            self._close_ports()
+            return False
+
+        # Set while a message from the controller waits for the heater's response
+        self._write_lock_timer = None
+        # Baud rate may have changed after reconnection
+        self._write_lock_delay = self._frame_time(self._response_length) + self._response_slack
+
+        self._ser_heater = None
+        self._ser_controller = None
+
+        # Incoming bytes of each port are decoded into messages and forwarded to the other port
+        self._links = []
+        if self._ser1:
+            self._links.append((self._ser1, self._ser2, FrameDecoder(self.logger, lambda data: self._forward_garbage(
+                self._ser2, '1 >> 2', data)), '1 >> 2'))
+        if self._ser2:
+            self._links.append((self._ser2, self._ser1, FrameDecoder(self.logger, lambda data: self._forward_garbage(
+                self._ser1, '2 >> 1', data)), '2 >> 1'))
+        for link in self._links:
+            link[2].byte_ns = 10 * 10 ** 9 // link[0].baudrate
+            self._selector.register(link[0].fileno(), selectors.EVENT_READ, link)
+
+        self._connected = True
+        self._connect_failures = 0
+        self._reconnect_delay = self.reconnect_delay_min
+        self._set_connection_state('connected')
+        return True
+
+    def _connect_error(self, text):
+        # Only the first failure is logged as error, the following attempts come quickly one after another
+        if not self._connect_failures:
+            self.logger.error(text)
+        else:
+            self.logger.debug(text)
+        self._connect_failures += 1
+        self._set_connection_state('connecting')
+
+    def _try_connect(self):
+        # Next attempt is planned with exponential backoff
+        if self._connect():
+            return True
+        self._reconnect_time = time.monotonic() + self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, self.reconnect_delay_max)
+        return False
+
+    def _set_connection_state(self, state):
+        if state == self._connection_state:
+            return
+        self._connection_state = state
+        if state == 'connected':
+            self._connected_event.set()
+        else:
+            self._connected_event.clear()
+        for callback in list(self._connection_callbacks):
             try:
-                self._ser1 = serial.Serial(self.port1, self.baudrate1, bytesize=serial.EIGHTBITS,
-                                           parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.5,
-                                           write_timeout=0.5)
-                self._ser1.reset_input_buffer()
+                callback(state)
+            except Exception:
+                self.logger.exception('Connection callback failed')
 
-                self._connected = True
+    def get_connection_state(self):
+        # 'connecting', 'connected' or 'disconnected' (after the connection was lost, before the next attempt)
+        return self._connection_state
 
-                self.logger.info('Serial connection to ' + self.port1 + ' established')
+    def is_connected(self):
+        return self._connected
 
-            except serial.serialutil.SerialException:
-                self.logger.critical('Cannot connect to serial port!')
-                time.sleep(10)
+    def wait_connected(self, timeout=None):
+        return self._connected_event.wait(timeout)
 
-        if self.port2:
-            try:
-                self._ser2 = serial.Serial(self.port2, self.baudrate2, bytesize=serial.EIGHTBITS,
-                                           parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.5,
-                                           write_timeout=0.5)
-                self._ser2.reset_input_buffer()
+    def register_connection_callback(self, callback):
+        # Callback is called from the worker thread with the new connection state
+        self._connection_callbacks.append(callback)
 
-                self.logger.info('Serial connection to ' + self.port2 + ' established')
+    def unregister_connection_callback(self, callback):
+        self._connection_callbacks.remove(callback)
 
-            except serial.serialutil.SerialException:
-                self.logger.error('Cannot connect to serial port!')
-                time.sleep(10)
+    def register_snapshot_callback(self, callback):
+        # Callback is called from the worker thread with the heater and each new StatusSnapshot, SettingsSnapshot
+        # and DiagnosticSnapshot, it should return quickly
+        self._snapshot_callbacks.append(callback)
 
-        self._write_lock_timer = None
-        self._write_lock_delay = 10
+    def unregister_snapshot_callback(self, callback):
+        self._snapshot_callbacks.remove(callback)
 
+    def _notify_snapshot(self, snapshot):
+        for callback in self._snapshot_callbacks:
+            try:
+                callback(self, snapshot)
+            except Exception:
+                self.logger.exception('Snapshot callback failed')
+
+    def _adapter_key(self, device):
+        # USB adapters are identified by serial number and USB location, other ports by path
+        for port in self._comports():
+            if port.device == device and port.serial_number:
+                return '{}@{}'.format(port.serial_number, port.location or '')
+        return device
+
+    def _load_baudrates(self):
+        try:
+            with open(self.autobaud_cache, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_baudrate(self, device, baudrate):
+        cache = self._load_baudrates()
+        cache[self._adapter_key(device)] = baudrate
+        try:
+            with open(self.autobaud_cache, 'w', encoding='utf-8') as file:
+                json.dump(cache, file)
+        except OSError:
+            self.logger.warning('Cannot write baud rate cache {}'.format(self.autobaud_cache))
+
+    def _initial_baudrate(self, device, baudrate):
+        if baudrate in ('auto', 'sniff'):
+            return self._load_baudrates().get(self._adapter_key(device), self.autobaud_rates[0])
+        return baudrate
+
+    def _detect_baudrate(self, ser_port, attempts, listen):
+        # Returns the first baud rate at which a valid message was received, attempts are (baud rate, probe ID)
+        timeout = ser_port.timeout
+        ser_port.timeout = 0.05
+        try:
+            for baudrate, msg_id2 in attempts:
+                ser_port.baudrate = baudrate
+                ser_port.reset_input_buffer()
+                decoder = FrameDecoder()
+                wait = listen
+                if msg_id2 is not None:
+                    probe = self.build(0x03, msg_id2)
+                    ser_port.write(probe)
+                    # Probe and the longest response on the wire and time for the heater to respond
+                    wait = (len(probe) + 26) * 10 / baudrate + 0.25
+                end = time.monotonic() + wait
+                while time.monotonic() < end:
+                    if decoder.feed(ser_port.read(ser_port.in_waiting or 1)):
+                        return baudrate
+        finally:
+            ser_port.timeout = timeout
+        return None
+
+    def _autobaud(self, ser_port, mode):
+        if mode not in ('auto', 'sniff'):
+            return
+        cached = self._load_baudrates().get(self._adapter_key(ser_port.port))
+        if mode == 'sniff':
+            attempts = [(baudrate, None) for baudrate in self.autobaud_rates]
+        else:
+            attempts = list(self.autobaud_probes)
+        if cached:
+            # Try the cached rate first, then the whole sweep
+            attempts.insert(0, (cached, None if mode == 'sniff' else 0x04))
+        baudrate = self._detect_baudrate(ser_port, attempts, self.autobaud_listen)
+        if baudrate is None:
+            baudrate = cached or self.autobaud_rates[0]
+            self.logger.warning('Baud rate of {} was not detected, using {}'.format(ser_port.port, baudrate))
+        else:
+            self.logger.info('Baud rate of {} detected: {}'.format(ser_port.port, baudrate))
+            if baudrate != cached:
+                self._save_baudrate(ser_port.port, baudrate)
+        ser_port.baudrate = baudrate
+        ser_port.reset_input_buffer()
+
+    def _close_ports(self):
+        for link in self._links:
+            try:
+                self._selector.unregister(link[0].fileno())
+            except (KeyError, ValueError, OSError):
+                pass
+        self._links = []
+        for ser_port in (self._ser1, self._ser2):
+            if ser_port:
+                try:
+                    ser_port.close()
+                except (OSError, serial.serialutil.SerialException):
+                    pass
+        self._ser1 = None
+        self._ser2 = None
         self._ser_heater = None
         self._ser_controller = None
 
     def _disconnect(self):
-        if self._ser1:
-            self._ser1.close()
-        if self._ser2:
-            self._ser2.close()
+        self._close_ports()
         self._connected = False
+        if self._connection_state == 'connected':
+            self._set_connection_state('disconnected')
 
     def _reconnect(self):
+        # Blocking reconnection, used when the heater is driven by a HeaterFleet
         self._disconnect()
-        while not self._connected:
-            self._connect()
+        if self._metrics:
+            self._metrics.reconnects += 1
+        self._reconnect_delay = self.reconnect_delay_min
+        while self._working and not self._try_connect():
+            time.sleep(max(0, self._reconnect_time - time.monotonic()))
 
-    def _start_working(self):
+    def _start_working(self, worker=True):
 
         self._working = True
 
         # Buffer for messages
-        self._send_to_heater = []
+        self._send_to_heater = CommandQueue()
+        # Messages sent to the heater waiting for response, items are command ID: [message, future, attempts, deadline]
+        self._pending = {}
+        self._max_pending = 4  # Number of messages with different command IDs sent without waiting for response
+        self._timing = autotermtiming.BusTiming()
+        self._send_at = 0  # Own messages are held back until the panel's next exchange is over
+        self._retries = 2
+        self._retry_backoff = 0.05  # Doubles with every retry
+        self._response_length = 26  # Longest expected response (19 byte status)
+        self._response_slack = 0.25  # Time the heater needs to prepare its response
+        self._write_lock_delay = self._frame_time(self._response_length) + self._response_slack
 
         self._heater_timer = None
         self._shutdown_request = False
@@ -216,327 +883,553 @@ class AutotermHeater(AutotermUtils):
         # Following values are stored in tuples with timestamp
         self._heater_software_version = (None, None, None, None, None)
         self._heater_serial_number = (None, None, None)
+        # Last HistorySnapshot
+        self._history = None
 
         # Heater settings values
         self._settings_timer = time.time()
-        self._settings_delay = 5  # Sets how often raspberry asks for settings
-        # Following values are stored in tuples with timestamp
-        self._heater_mode = (None, None)
-        self._heater_setpoint = (None, None)
-        self._heater_ventilation = (None, None)
-        self._heater_power_level = (None, None)
+        self._settings_delay = None  # Fixed interval of settings requests, None adapts it (see poll_intervals)
+        # Last SettingsSnapshot, replaced as a whole so readers always see values from one message
+        self._settings = None
 
         # Heater status values
         self._status_timer = time.time()
-        self._status_delay = 5  # Sets how often raspberry asks for status
-        # Following values are stored in tuples with timestamp
-        self._heater_status1 = (None, None)
-        self._heater_status2 = (None, None)
-        self._heater_errors = (None, None)
-        self._heater_temperature = (None, None)
-        self._external_temperature = (None, None)
-        self._battery_voltage = (None, None)
-        self._flame_temperature = (None, None)
+        self._status_delay = None  # Fixed interval of status requests, None adapts it (see poll_intervals)
+        # Last StatusSnapshot
+        self._status = None
+
+        # Polling statistics and bytes of other devices in the current bus window
+        self._poll_boost_until = 0
+        self._bus_bytes = 0
+        self._bus_window_start = time.time()
+        self._bus_load = 0.0
+        self._polls_sent = 0
+        self._polls_snooped = 0
 
         # Controller temperature value
         # Following values are stored in tuples with timestamp
         self._controller_temperature = (None, None)
 
         # Diagnostic values
-        # Following values are stored in tuples with timestamp
-        self._d_status1 = (None, None)
-        self._d_status2 = (None, None)
-        self._d_counter1 = (None, None)
-        self._d_counter2 = (None, None)
-        self._d_defined_rev = (None, None)
-        self._d_measured_rev = (None, None)
-        self._d_fuel_pump1 = (None, None)
-        self._d_fuel_pump2 = (None, None)
-        self._d_chamber_temperature = (None, None)
-        self._d_flame_temperature = (None, None)
-        self._d_external_temperature = (None, None)
-        self._d_heater_temperature = (None, None)
-        self._d_battery_voltage = (None, None)
+        # Last DiagnosticSnapshot
+        self._diagnostic = None
+
+        self._register_default_handlers()
 
         # Create and start worker thread
-        self._worker_thread = threading.Thread(target=self._worker_thread, daemon=True)
-        self._worker_thread.start()
+        if worker:
+            self._worker = threading.Thread(target=self._worker_thread, daemon=True)
+            self._worker.start()
 
     def _stop_working(self):
         self._working = False
-        self._worker_thread.join(10.0)
-
-    def _process_message(self, message, ser_message):
-        new_message = self.parse(message)
-
-        if new_message == 0:
-            return 0
+        self._wake()
+        if self._worker:
+            self._worker.join(10.0)
+
+    def register_handler(self, device, msg_id2, handler, payload_len=None):
+        # Handler is called with each message with matching device, command ID and payload length.
+        # Handler registered with payload_len None is used for any other payload length.
+        self._handlers[(device, msg_id2, payload_len)] = handler
+
+    def _register_default_handlers(self):
+        self._handlers = {}
+        for device, msg_id2, payload_len, handler in (
+                # Diagnostic messages
+                (0x02, 0x00, None, self._log_handler('PC sends initialization diagnostic message')),
+                (0x02, 0x01, 72, self._on_diagnostic),
+                (0x02, 0x01, None, self._log_handler('Heater sends diagnostic message, wrong payload length',
+                                                     logging.WARNING)),
+                # Messages from controller
+                (0x03, 0x01, None, self._on_controller_turns_heater_on),
+                (0x03, 0x02, 0, self._on_controller_asks_for_settings),
+                (0x03, 0x02, None, self._on_controller_sets_settings),
+                (0x03, 0x03, None, self._on_controller_turns_heater_off),
+                (0x03, 0x04, None, self._log_handler('Controller asks for serial number', payload=False)),
+                (0x03, 0x06, None, self._log_handler('Controller asks for software version', payload=False)),
+                (0x03, 0x0b, None, self._log_handler('Controller asks for history', payload=False)),
+                (0x03, 0x0f, None, self._on_controller_asks_for_status),
+                (0x03, 0x11, 1, self._on_controller_temperature),
+                (0x03, 0x11, None, self._log_handler('Controller reports temperature, wrong payload length',
+                                                     logging.WARNING)),
+                (0x03, 0x1c, None, self._log_handler('Controller sends initialization message', payload=False)),
+                (0x03, 0x23, None, self._log_handler('Controller turns ventilation on with settings')),
+                # Messages from heater
+                (0x04, 0x01, 6, self._on_heater_settings),
+                (0x04, 0x01, None, self._on_heater_settings_wrong_length),
+                (0x04, 0x02, 6, self._on_heater_settings),
+                (0x04, 0x02, None, self._on_heater_settings_wrong_length),
+                (0x04, 0x03, None, self._log_handler('Heater confirms turn off request', payload=False)),
+                (0x04, 0x04, 5, self._on_heater_serial_number),
+                (0x04, 0x04, None, self._log_handler('Heater reports serial number, wrong payload length',
+                                                     logging.WARNING)),
+                (0x04, 0x06, 5, self._on_heater_software_version),
+                (0x04, 0x06, None, self._log_handler('Heater reports software version, wrong payload length',
+                                                     logging.WARNING)),
+                (0x04, 0x07, 1, self._on_heater_diagnostic_mode),
+                (0x04, 0x07, None, self._log_handler('Heater confirms turning diagnostic on/off, wrong payload length',
+                                                     logging.WARNING)),
+                (0x04, 0x0b, 7, self._on_heater_history),
+                (0x04, 0x0b, 9, self._on_heater_history),
+                (0x04, 0x0b, None, self._log_handler('Heater reports history, wrong payload length', logging.WARNING)),
+                (0x04, 0x0f, 10, self._on_heater_status),
+                (0x04, 0x0f, 19, self._on_heater_status),
+                (0x04, 0x0f, None, self._on_heater_status_wrong_length),
+                (0x04, 0x11, 1, self._log_handler('Heater confirms controller temperature')),
+                (0x04, 0x11, None, self._log_handler('Heater confirms controller temperature, wrong payload length',
+                                                     logging.WARNING)),
+                (0x04, 0x1c, None, self._log_handler('Heater responds to initialization message', payload=False)),
+                (0x04, 0x23, None, self._log_handler('Heater confirms turning ventilation on'))):
+            self.register_handler(device, msg_id2, handler, payload_len)
+
+    def _log_handler(self, text, level=logging.INFO, payload=True):
+        if payload:
+            text += ' (%s)'
+            return lambda message: self.logger.log(level, text, LazyHex(message.payload))
+        return lambda message: self.logger.log(level, text)
+
+    def _process_message(self, new_message, ser_message):
+        device = new_message.device
 
         # Heater and controller port assignment
-        if not self._ser_controller and new_message.device == 0x03:
+        if not self._ser_controller and device == 0x03:
             self._ser_controller = ser_message
-        if not self._ser_heater and new_message.device == 0x04:
+        if not self._ser_heater and device == 0x04:
             self._ser_heater = ser_message
 
-        # Initialization message received
-        if new_message.device == 0x00:
-            self.logger.info('Initialization message ({})'.format(message.hex()))
-
-        # Diagnostic message received
-        elif new_message.device == 0x02:
-            if new_message.msg_id2 == 0x00:
-                self.logger.info('PC sends initialization diagnostic message')
-            # Diagnostic message from heater received
-            elif new_message.msg_id2 == 0x01:
-                if len(new_message.payload) == 72:
-                    self._d_status1 = (new_message.payload[0], time.time())
-                    self._d_status2 = (new_message.payload[1], time.time())
-                    self._d_counter1 = (int.from_bytes(new_message.payload[5:8], 'big'), time.time())
-                    self._d_counter2 = (int.from_bytes(new_message.payload[8:11], 'big'), time.time())
-                    self._d_defined_rev = (new_message.payload[11], time.time())
-                    self._d_measured_rev = (new_message.payload[12], time.time())
-                    self._d_fuel_pump1 = (new_message.payload[14], time.time())
-                    self._d_fuel_pump2 = (new_message.payload[16], time.time())
-                    self._d_chamber_temperature = (int.from_bytes(new_message.payload[18:20], 'big'), time.time())
-                    self._d_flame_temperature = (int.from_bytes(new_message.payload[20:22], 'big'), time.time())
-                    self._d_external_temperature = (new_message.payload[24], time.time())
-                    self._d_heater_temperature = (new_message.payload[25], time.time())
-                    self._d_battery_voltage = (new_message.payload[27] / 10, time.time())
-                    self.logger.info('Heater sends diagnostic message ({})'.format(new_message.payload.hex()))
-                else:
-                    self.logger.warning(
-                        'Heater sends diagnostic message, wrong payload length ({})'.format(new_message.payload.hex()))
-
         # New message is from controller
-        elif new_message.device == 0x03:
+        if device == 0x03:
             # Do not send messages, waiting for response from the heater
             self._write_lock_timer = time.time() + self._write_lock_delay
-            # 01 - Controller turns heater on
-            if new_message.msg_id2 == 0x01:
-                self._heater_timer = None
-                self.logger.info('Controller turns heater on with settings {}'.format(new_message.payload[2:].hex()))
-            # 02 - Controller asks for settings
-            elif new_message.msg_id2 == 0x02:
-                if new_message.length == 0:
-                    self.logger.info('Controller asks for settings')
-                else:
-                    self._heater_timer = None
-                    self.logger.info('Controller set new settings ({})'.format(new_message.payload[2:].hex()))
-            # 03 - Controller turns off the heater
-            elif new_message.msg_id2 == 0x03:
-                self._heater_timer = None
-                self.logger.info('Controller turns off the heater')
-            # 04 - Controller asks for serial number
-            elif new_message.msg_id2 == 0x04:
-                self.logger.info('Controller asks for serial number')
-            # 06 - Controller asks for software version
-            elif new_message.msg_id2 == 0x06:
-                self.logger.info('Controller asks for software version')
-            # 07 - Controller asks for status
-            elif new_message.msg_id2 == 0x0f:
-                self.logger.info('Controller asks for status')
-            # 11 - Controller reports temperature
-            elif new_message.msg_id2 == 0x11:
-                if len(new_message.payload) == 1:
-                    self._controller_temperature = (new_message.payload[0], time.time())
-                    self.logger.info('Controller reports temperature {} °C'.format(new_message.payload[0]))
-                else:
-                    self.logger.warning(
-                        'Controller reports temperature, wrong payload length ({})'.format(new_message.payload.hex()))
-            # 1c - Controller sends initialization message
-            elif new_message.msg_id2 == 0x1c:
-                self.logger.info('Controller sends initialization message')
-            # 23 - Controller turns ventilation
-            elif new_message.msg_id2 == 0x23:
-                self.logger.info(
-                    'Controller turns ventilation on with settings {}'.format(new_message.payload[2:].hex()))
-            # Unknown message
-            else:
-                self.logger.warning('Unknown message from controller: {}'.format(message.hex()))
-
-        # New message is from heater
-        elif new_message.device == 0x04:
+            self._bus_bytes += len(new_message.raw)
+            if CommandQueue.priority(new_message.raw) <= CommandQueue.CONTROL:
+                self._poll_boost_until = time.time() + self.poll_boost[0]
+        # New message is from heater, it answers unblock (0x0d) and initialization (0x1c, 0x1e) with device 0x00
+        elif device in (0x04, 0x00):
             # Response from heater received, can send other messages
-            self._write_lock_timer = None
-            # 01 - Heater confirms starting up
-            if new_message.msg_id2 == 0x01:
-                if len(new_message.payload) == 6:
-                    self._heater_mode = (new_message.payload[2], time.time())
-                    self._heater_setpoint = (new_message.payload[3], time.time())
-                    self._heater_ventilation = (new_message.payload[4], time.time())
-                    self._heater_power_level = (new_message.payload[5], time.time())
-                    self.logger.info('Heater confirms starting up ({})'.format(new_message.payload.hex()))
-                else:
-                    self.logger.warning(
-                        'Heater confirms starting up, wrong payload length ({})'.format(new_message.payload.hex()))
-                # Reset settings timer
-                self._settings_timer = time.time()
-            # 02 - Heater reports settings
-            elif new_message.msg_id2 == 0x02:
-                if len(new_message.payload) == 6:
-                    self._heater_mode = (new_message.payload[2], time.time())
-                    self._heater_setpoint = (new_message.payload[3], time.time())
-                    self._heater_ventilation = (new_message.payload[4], time.time())
-                    self._heater_power_level = (new_message.payload[5], time.time())
-                    self.logger.info('Heater reports settings ({})'.format(new_message.payload.hex()))
-                else:
-                    self.logger.warning(
-                        'Heater reports settings, wrong payload length ({})'.format(new_message.payload.hex()))
-                # Reset settings timer
-                self._settings_timer = time.time()
-            # 03 - Heater confirms turn off request
-            elif new_message.msg_id2 == 0x03:
-                self.logger.info('Heater confirms turn off request')
-            # 04 - Heater reports serial number
-            elif new_message.msg_id2 == 0x04:
-                if len(new_message.payload) == 5:
-                    self._heater_serial_number = (
-                        int.from_bytes(new_message.payload[0:2], 'big'),
-                        int.from_bytes(new_message.payload[2:5], 'big'),
-                        time.time())
-                    self.logger.info('Heater reports serial number ({})'.format(new_message.payload.hex()))
-                else:
-                    self.logger.warning(
-                        'Heater reports serial number, wrong payload length ({})'.format(new_message.payload.hex()))
-            # 06 - Heater reports software version
-            elif new_message.msg_id2 == 0x06:
-                if len(new_message.payload) == 5:
-                    self._heater_software_version = (
-                        new_message.payload[0], new_message.payload[1], new_message.payload[2], new_message.payload[3],
-                        time.time())
-                    self.logger.info('Heater reports software version ({})'.format(new_message.payload.hex()))
-                else:
-                    self.logger.warning(
-                        'Heater reports software version, wrong payload length ({})'.format(new_message.payload.hex()))
-            # 07 - Heater confirms turning on/off diagnostic mode
-            elif new_message.msg_id2 == 0x07:
-                if len(new_message.payload) == 1:
-                    if new_message.payload[0] == 0:
-                        self.logger.info('Heater confirms turning diagnostic mode off')
-                    elif new_message.payload == 1:
-                        self.logger.info('Heater confirms turning diagnostic mode on')
-                    else:
-                        self.logger.warning(
-                            'Heater confirms turning diagnostic on/off, wrong payload value ({})'.format(
-                                new_message.payload.hex()))
-                else:
-                    self.logger.warning('Heater confirms turning diagnostic on/off, wrong payload length ({})'.format(
-                        new_message.payload.hex()))
-            # 0f - Heater reports status
-            elif new_message.msg_id2 == 0x0f:
-                if len(new_message.payload) == 10:
-                    self._heater_status1 = (new_message.payload[0], time.time())
-                    self._heater_status2 = (new_message.payload[1], time.time())
-                    self._heater_errors = (new_message.payload[2], time.time())
-                    self._heater_temperature = (new_message.payload[3], time.time())
-                    self._external_temperature = (new_message.payload[4], time.time())
-                    self._battery_voltage = (new_message.payload[6] / 10, time.time())
-                    self._flame_temperature = (int.from_bytes(new_message.payload[7:9], 'big'), time.time())
-                    self.logger.info('Heater reports status ({})'.format(new_message.payload.hex()))
-                else:
-                    self.logger.warning(
-                        'Heater reports status, wrong payload length ({})'.format(new_message.payload.hex()))
-                # Reset status timer
-                self._status_timer = time.time()
-            # 11 - Heater confirms controller temperature
-            elif new_message.msg_id2 == 0x11:
-                if len(new_message.payload) == 1:
-                    self.logger.info('Heater confirms controller temperature {} °C'.format(new_message.payload[0]))
-                else:
-                    self.logger.warning('Heater confirms controller temperature, wrong payload length ({})'.format(
-                        new_message.payload.hex()))
-            # 1c - Heater responds to initialization message
-            elif new_message.msg_id2 == 0x1c:
-                self.logger.info('Heater responds to initialization message')
-            # 23 - Heater confirms turning ventilation on
-            elif new_message.msg_id2 == 0x23:
-                self.logger.info('Heater confirms turning ventilation on ({})'.format(new_message.payload.hex()))
-            # Unknown message
+            request = self._pending.pop(new_message.msg_id2, None)
+            if request:
+                if self._metrics:
+                    self._metrics.observe_latency(new_message.msg_id2, time.monotonic() - request[4])
+                # Caller may have cancelled the future
+                if not request[1].done():
+                    request[1].set_result(new_message)
+                if not self._pending:
+                    self._timing.own_until_ns = 0
             else:
-                self.logger.warning('Unknown message from heater ({})'.format(message.hex()))
-        # Unknown device id
+                self._write_lock_timer = None
+                self._bus_bytes += len(new_message.raw)
+                # Response to the control panel answers the same own requests still waiting in the queue
+                for item in self._send_to_heater.take_polls(new_message.msg_id2):
+                    self._polls_snooped += 1
+                    if not item[1].done():
+                        item[1].set_result(new_message)
         else:
-            self.logger.warning('Unknown device id in message ({})'.format(message.hex()))
+            self._bus_bytes += len(new_message.raw)
+
+        handlers = self._handlers
+        handler = handlers.get((device, new_message.msg_id2, len(new_message.payload))) or \
+            handlers.get((device, new_message.msg_id2, None))
+        if handler:
+            handler(new_message)
+        elif device == 0x00:
+            self.logger.info('Initialization message (%s)', LazyHex(new_message.raw))
+        elif device == 0x02:
+            self.logger.debug('Unknown diagnostic message (%s)', LazyHex(new_message.raw))
+        elif device == 0x03:
+            self.logger.warning('Unknown message from controller: %s', LazyHex(new_message.raw))
+        elif device == 0x04:
+            self.logger.warning('Unknown message from heater (%s)', LazyHex(new_message.raw))
+        else:
+            self.logger.warning('Unknown device id in message (%s)', LazyHex(new_message.raw))
         # Message processed
         return 1
 
+    # Handlers of messages
+    def _on_diagnostic(self, message):
+        self._diagnostic = DiagnosticSnapshot.decode(message.payload, time.time())
+        if self._telemetry:
+            self._telemetry.record_diagnostic(self._diagnostic)
+        if self._snapshot_callbacks:
+            self._notify_snapshot(self._diagnostic)
+        self.logger.info('Heater sends diagnostic message (%s)', LazyHex(message.payload))
+
+    def _on_controller_turns_heater_on(self, message):
+        self._heater_timer = None
+        self.logger.info('Controller turns heater on with settings %s', LazyHex(message.payload[2:]))
+
+    def _on_controller_sets_settings(self, message):
+        self._heater_timer = None
+        self.logger.info('Controller set new settings (%s)', LazyHex(message.payload[2:]))
+
+    def _on_controller_turns_heater_off(self, message):
+        self._heater_timer = None
+        self.logger.info('Controller turns off the heater')
+
+    def _on_controller_asks_for_status(self, message):
+        # Own request is not needed, the response to the control panel is used
+        self._status_timer = time.time()
+        self.logger.info('Controller asks for status')
+
+    def _on_controller_asks_for_settings(self, message):
+        self._settings_timer = time.time()
+        self.logger.info('Controller asks for settings')
+
+    def _on_controller_temperature(self, message):
+        self._controller_temperature = (message.payload[0], time.time())
+        self.logger.info('Controller reports temperature %d °C', message.payload[0])
+
+    def _on_heater_settings(self, message):
+        self._settings = SettingsSnapshot.decode(message.payload, time.time())
+        if self._snapshot_callbacks:
+            self._notify_snapshot(self._settings)
+        if message.msg_id2 == 0x01:
+            self.logger.info('Heater confirms starting up (%s)', LazyHex(message.payload))
+        else:
+            self.logger.info('Heater reports settings (%s)', LazyHex(message.payload))
+        # Reset settings timer
+        self._settings_timer = time.time()
+
+    def _on_heater_settings_wrong_length(self, message):
+        if message.msg_id2 == 0x01:
+            self.logger.warning('Heater confirms starting up, wrong payload length (%s)', LazyHex(message.payload))
+        else:
+            self.logger.warning('Heater reports settings, wrong payload length (%s)', LazyHex(message.payload))
+        # Reset settings timer
+        self._settings_timer = time.time()
+
+    def _on_heater_serial_number(self, message):
+        self._heater_serial_number = (int.from_bytes(message.payload[0:2], 'big'),
+                                      int.from_bytes(message.payload[2:5], 'big'), time.time())
+        self.logger.info('Heater reports serial number (%s)', LazyHex(message.payload))
+
+    def _on_heater_software_version(self, message):
+        self._heater_software_version = (message.payload[0], message.payload[1], message.payload[2],
+                                         message.payload[3], time.time())
+        self.logger.info('Heater reports software version (%s)', LazyHex(message.payload))
+
+    def _on_heater_diagnostic_mode(self, message):
+        if message.payload[0] == 0:
+            self.logger.info('Heater confirms turning diagnostic mode off')
+        elif message.payload[0] == 1:
+            self.logger.info('Heater confirms turning diagnostic mode on')
+        else:
+            self.logger.warning('Heater confirms turning diagnostic on/off, wrong payload value (%s)',
+                                LazyHex(message.payload))
+
+    def _on_heater_history(self, message):
+        self._history = HistorySnapshot.decode(message.payload, time.time())
+        self.logger.info('Heater reports history (%s)', LazyHex(message.payload))
+
+    def _on_heater_status(self, message):
+        self._status = StatusSnapshot.decode(message.payload, time.time())
+        if self._telemetry:
+            self._telemetry.record_status(self._status)
+        if self._snapshot_callbacks:
+            self._notify_snapshot(self._status)
+        self.logger.info('Heater reports status (%s)', LazyHex(message.payload))
+        # Reset status timer
+        self._status_timer = time.time()
+
+    def _on_heater_status_wrong_length(self, message):
+        self.logger.warning('Heater reports status, wrong payload length (%s)', LazyHex(message.payload))
+        # Reset status timer
+        self._status_timer = time.time()
+
+    def _wake(self):
+        # Interrupts waiting of the worker thread, e.g. when a new message is queued
+        try:
+            os.write(self._wake_w, b'\x00')
+        except BlockingIOError:
+            pass
+
+    def _queue_message(self, message, callback=None, coalesce=True, retry=True):
+        # Returns future resolved with the heater's response
+        future = concurrent.futures.Future()
+        if callback:
+            future.add_done_callback(callback)
+        self._send_to_heater.put([message, future, 0 if retry else self._retries, 0], coalesce)
+        self._wake()
+        return future
+
+    def _frame_time(self, length):
+        # 10 bits per byte (start bit, 8 data bits, stop bit)
+        ser_port = self._ser_heater or self._ser1
+        return length * 10 / (ser_port.baudrate if ser_port else self._initial_baudrate(self.port1, self.baudrate1))
+
+    def _response_timeout(self, length):
+        # Time to transmit the message and bytes already in flight, receive the response and some slack
+        in_flight = sum(len(request[0]) + self._response_length for request in self._pending.values())
+        return self._frame_time(in_flight + length + self._response_length) + self._response_slack
+
+    def _is_requested(self, msg_id2):
+        if msg_id2 in self._pending:
+            return True
+        return self._send_to_heater.contains(msg_id2)
+
+    def _send_queued(self):
+        now = time.time()
+        if self.cut_through:
+            # Part of a message was already forwarded, own message would be mixed with its rest
+            for link in self._links:
+                if link[1] and link[2].pending():
+                    return
+        timing = self._timing
+        while len(self._pending) < self._max_pending and not self._write_lock_timer:
+            # Keep the order, waits for the response to a previous message with the same command ID
+            item = self._send_to_heater.pop(lambda item: item[3] <= now and item[0][4] not in self._pending)
+            if not item:
+                break
+            message, future, attempts, not_before = item
+            if future.cancelled():
+                continue
+            reply = CommandQueue.expects_reply(message)
+            duration = timing.exchange_ns(self._frame_time(len(message)),
+                                          self._frame_time(self._response_length if reply else 0))
+            if self._ser_controller and self.gap_scheduling:
+                now_ns = time.monotonic_ns()
+                send_at = timing.send_time(now_ns, duration)
+                if send_at > now_ns:
+                    # Panel's next exchange would overlap, wait until it is over
+                    self._send_to_heater.put_front(item)
+                    timing.defer(now_ns)
+                    self._send_at = now + (send_at - now_ns) / 1e9
+                    break
+            timing.inject(time.monotonic_ns(), duration)
+            deadline = now + self._response_timeout(len(message))
+            if self._ser_heater:
+                self._write_message(self._ser_heater, message)
+                self._capture_write(self._ser_heater, message, sent=True)
+                self.logger.info('Program sends message to heater (%s)', LazyHex(message))
+            else:
+                for ser_port in (self._ser1, self._ser2):
+                    if ser_port:
+                        self._write_message(ser_port, message)
+                        self._capture_write(ser_port, message, sent=True)
+                self.logger.warning('Program sends message to both adapters (%s)', LazyHex(message))
+            if reply:
+                self._pending[message[4]] = [message, future, attempts, deadline, time.monotonic()]
+            elif not future.done():
+                future.set_result(None)
+            if self._hub:
+                self._hub.publish(message)
+            if CommandQueue.priority(message) <= CommandQueue.CONTROL:
+                self._poll_boost_until = now + self.poll_boost[0]
+            if self._metrics:
+                self._metrics.frames['P >> H'][message[4]] += 1
+
+    def _check_pending(self):
+        now = time.time()
+        for msg_id2, (message, future, attempts, deadline, sent) in list(self._pending.items()):
+            if now < deadline:
+                continue
+            del self._pending[msg_id2]
+            if self._metrics:
+                if attempts < self._retries:
+                    self._metrics.retries += 1
+                else:
+                    self._metrics.request_timeouts += 1
+            if attempts < self._retries:
+                self._timing.retries += 1
+                self.logger.warning('Heater did not respond, message will be sent again ({})'.format(message.hex()))
+                self._send_to_heater.put_front([message, future, attempts + 1,
+                                                now + self._retry_backoff * 2 ** attempts])
+            else:
+                self.logger.error('Heater did not respond to message ({})'.format(message.hex()))
+                if not future.done():
+                    future.set_exception(TimeoutError('Heater did not respond to message {}'.format(message.hex())))
+
+    def _next_timeout(self):
+        # Time until the nearest deadline of the worker thread
+        now = time.time()
+        deadlines = [now + self._max_wait]
+        if self._write_lock_timer:
+            deadlines.append(self._write_lock_timer)
+        else:
+            item = self._send_to_heater.peek()
+            if item and len(self._pending) < self._max_pending:
+                deadlines.append(max(item[3], self._send_at))
+            deadlines.append(self._status_timer + self._poll_delay(0x0f))
+            deadlines.append(self._settings_timer + self._poll_delay(0x02))
+        for request in self._pending.values():
+            deadlines.append(request[3])
+        if self._heater_timer:
+            deadlines.append(self._heater_timer)
+        if self._shutdown_request:
+            deadlines.append(self._shutdown_timer + self._shutdown_delay)
+        monotonic = time.monotonic()
+        for ser_in, ser_out, decoder, direction in self._links:
+            if decoder.pending():
+                deadlines.append(now + decoder.last_feed + self._frame_timeout - monotonic)
+        return max(0, min(deadlines) - now)
+
+    def _process_link(self, ser_in, ser_out, decoder, direction, flush=False):
+        # First byte of the first message arrived earlier if a part of it is already buffered
+        frame_start = decoder.frame_start if decoder.pending() else None
+        latency = 0.0
+        if flush:
+            messages = decoder.flush()
+        else:
+            data = self._read_message(ser_in)
+            if ser_out and self.cut_through and data:
+                received = time.monotonic()
+                self._write_message(ser_out, data)
+                # Latency added by the program, the bytes were sent on as soon as they arrived
+                latency = time.monotonic() - received
+            messages = decoder.feed(data)
+            if frame_start is None:
+                frame_start = decoder.last_feed
+        metrics = self._metrics
+        if metrics:
+            counts = metrics.frames[direction]
+            for message in messages:
+                counts[message.msg_id2] += 1
+        timing = self._timing
+        hub = self._hub
+        for message in messages:
+            if hub:
+                hub.publish(message.raw)
+            timing.observe(message.device, message.timestamp_ns - len(message.raw) * decoder.byte_ns,
+                           message.timestamp_ns)
+            self._capture_write(ser_in, message.raw)
+            if ser_out:
+                if not self.cut_through:
+                    self._write_message(ser_out, message.raw)
+                    # Whole message was waited for, the latency is counted from its first byte
+                    latency = time.monotonic() - frame_start
+                    frame_start = decoder.last_feed
+                if metrics:
+                    metrics.forward_latency[direction].observe(latency)
+                self.logger.debug('Message forwarded (%s: %s, %.1f ms)', direction, LazyHex(message.raw),
+                                  latency * 1e3)
+            self._process_message(message, ser_in)
+
+    def _process_timers(self):
+        if self._write_lock_timer:
+            if time.time() >= self._write_lock_timer:
+                self.logger.error('Write lock timer has expired, the heater did not respond')
+                self._write_lock_timer = None
+                if self._metrics:
+                    self._metrics.write_lock_timeouts += 1
+
+        self._check_pending()
+        self._send_queued()
+
+        if self._heater_timer:
+            if time.time() >= self._heater_timer:
+                self.shutdown()
+
+        if self._shutdown_request:
+            if self._status and self._status.status1 == 0:
+                self._shutdown_request = False
+            elif time.time() > self._shutdown_timer + self._shutdown_delay:
+                message = self.build(0x03, 0x03)
+                if message != 0:
+                    self._queue_message(message)
+                self._shutdown_timer = time.time()
+
+        now = time.time()
+        if now >= self._bus_window_start + self.bus_window:
+            self._bus_load = self._frame_time(self._bus_bytes) / (now - self._bus_window_start)
+            self._bus_bytes = 0
+            self._bus_window_start = now
+
+        if now >= self._status_timer + self._poll_delay(0x0f) and not self._write_lock_timer:
+            if not self._is_requested(0x0f):
+                self.asks_for_status()
+                self._polls_sent += 1
+            self._status_timer = now
+
+        if now >= self._settings_timer + self._poll_delay(0x02) and not self._write_lock_timer:
+            if not self._is_requested(0x02):
+                self.asks_for_settings()
+                self._polls_sent += 1
+            self._settings_timer = now
+
+        self._send_queued()
+
+    def _poll_delay(self, msg_id2):
+        # Interval of own status (0x0f) or settings (0x02) requests
+        fixed = self._status_delay if msg_id2 == 0x0f else self._settings_delay
+        if fixed is not None:
+            return fixed
+        status_delay, settings_delay = self.poll_intervals.get(self._status.status1 if self._status else None,
+                                                               self.poll_intervals[None])
+        if msg_id2 == 0x0f:
+            delay = status_delay
+            if self._poll_boost_until > time.time():
+                delay = min(delay, self.poll_boost[1])
+        else:
+            delay = settings_delay
+        # Both kinds of requests share what the other traffic leaves of the bus budget
+        free = max(self.bus_budget - self._bus_load, 0.01) / 2
+        return max(delay, self._frame_time(7 + self._response_length) / free)
+
+    def _clear_wake(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except BlockingIOError:
+            pass
+
+    def _process_expired(self):
+        # Incomplete messages which were not finished in time
+        monotonic = time.monotonic()
+        for link in self._links:
+            if link[2].pending() and monotonic > link[2].last_feed + self._frame_timeout:
+                self._process_link(*link, flush=True)
+
+        self._process_timers()
+
     def _worker_thread(self):
         self.logger.info('Worker started')
 
         while self._working:
             if not self._connected:
-                self._reconnect()
-            else:
-                if self._message_waiting(self._ser1) > 0:
-                    message = self._ser1.read(1)
-                    if message == b'\x1b':
-                        self._write_message(self._ser2, message)
-                        self.logger.debug('Initialization message forwarded (1 >> 2: {})'.format(message.hex()))
-                        continue
-                    if message != b'\xaa':
-                        self._ser1.reset_input_buffer()
-                        self.logger.warning('Unknown message detected, disposed (1 >> 2: {})'.format(message.hex()))
-                        continue
-                    message += self._ser1.read(2)
-                    message += self._ser1.read(message[-1] + 4)
-
-                    self._write_message(self._ser2, message)
-                    self.logger.debug('Message forwarded (1 >> 2: {})'.format(message.hex()))
-                    self._process_message(message, self._ser1)
-
-                if self._message_waiting(self._ser2) > 0:
-                    message = self._ser2.read(1)
-                    if message == b'\x1b':
-                        self._write_message(self._ser1, message)
-                        self.logger.debug('Initialization message forwarded (2 >> 1: {})'.format(message.hex()))
-                        continue
-                    if message != b'\xaa':
-                        self._ser2.reset_input_buffer()
-                        self.logger.warning('Unknown message detected, disposed (2 >> 1: {})'.format(message.hex()))
-                        continue
-                    message += self._ser2.read(2)
-                    message += self._ser2.read(message[-1] + 4)
-
-                    self._write_message(self._ser1, message)
-                    self.logger.debug('Message forwarded (2 >> 1: {})'.format(message.hex()))
-                    self._process_message(message, self._ser2)
-
-                if self._write_lock_timer:
-                    if time.time() >= self._write_lock_timer:
-                        self.logger.error('Write lock timer has expired, the heater did not respond')
-                        self._write_lock_timer = None
-
-                if len(self._send_to_heater) > 0 and not self._write_lock_timer:
-                    message = self._send_to_heater.pop(0)
-                    if self._ser_heater:
-                        self._write_message(self._ser_heater, message)
-                        self.logger.info('Program sends message to heater ({})'.format(message.hex()))
-                    else:
-                        self._write_message(self._ser1, message)
-                        self._write_message(self._ser2, message)
-                        self.logger.warning('Program sends message to both adapters ({})'.format(message.hex()))
-                    self._write_lock_timer = time.time() + self._write_lock_delay
-
-                if self._heater_timer:
-                    if time.time() >= self._heater_timer:
-                        self.shutdown()
-
-                if self._shutdown_request:
-                    if self._heater_status1[0] == 0:
-                        self._shutdown_request = False
-                    elif time.time() > self._shutdown_timer + self._shutdown_delay:
-                        message = self.build(0x03, 0x03)
-                        if message != 0:
-                            self._send_to_heater.append(message)
-                        self._shutdown_timer = time.time()
-
-                if time.time() >= self._status_timer + self._status_delay and not self._write_lock_timer:
-                    self.asks_for_status()
-
-                if time.time() >= self._settings_timer + self._settings_delay and not self._write_lock_timer:
-                    self.asks_for_settings()
+                if self._links:
+                    self._disconnect()
+                    if self._metrics:
+                        self._metrics.reconnects += 1
+                    self._reconnect_delay = self.reconnect_delay_min
+                    self._reconnect_time = 0
+                if time.monotonic() < self._reconnect_time or not self._try_connect():
+                    # Only the wake pipe is registered, wait for the next attempt or stop
+                    for key, mask in self._selector.select(max(0, self._reconnect_time - time.monotonic())):
+                        self._clear_wake()
+                continue
+
+            # Sleep until a serial port becomes readable, a message is queued or the nearest timer expires
+            events = self._selector.select(self._next_timeout())
+            start = time.perf_counter()
+            for key, mask in events:
+                if key.data is None:
+                    self._clear_wake()
+                else:
+                    self._process_link(*key.data)
+
+            self._process_expired()
+            if self._metrics:
+                self._metrics.iteration.observe(time.perf_counter() - start)
 
     # Heater and ventilation controlling
+    @staticmethod
+    def _value(snapshot, name):
+        # Value with timestamp, all values of one snapshot come from the same message
+        if snapshot is None:
+            return None, None
+        return getattr(snapshot, name), snapshot.timestamp
+
+    def get_queue_stats(self):
+        return self._send_to_heater.stats()
+
+    def get_timing_stats(self):
+        # Learned timing of the control panel, deferred own messages, collisions and retries
+        return self._timing.stats()
+
+    def get_poll_stats(self):
+        # Current intervals of own requests, bus load of the other devices and requests answered by their traffic
+        return {'status_delay': self._poll_delay(0x0f), 'settings_delay': self._poll_delay(0x02),
+                'bus_load': self._bus_load, 'sent': self._polls_sent, 'snooped': self._polls_snooped}
+
     def get_heater_timer(self):
         return self._heater_timer
 
@@ -545,18 +1438,19 @@ class AutotermHeater(AutotermUtils):
 
     def shutdown(self):
         self._shutdown_request = True
+        self._wake()
 
-    def turn_on_ventilation(self, power, timer=None):
+    def turn_on_ventilation(self, power, timer=None, callback=None):
         if timer:
             self._heater_timer = time.time() + (timer * 60)
         payload = b'\xff\xff' + power.to_bytes(1, byteorder='big') + b'\x0f'
         message = self.build(0x03, 0x23, payload=payload)
         if message != 0:
-            self._send_to_heater.append(message)
-            self._send_to_heater.append(message)
             # Message is sent twice as from the controller
+            self._queue_message(message)
+            return self._queue_message(message, callback, coalesce=False)
 
-    def turn_on_heater(self, mode, setpoint=0x0f, ventilation=0x00, power=0x00, timer=None):
+    def turn_on_heater(self, mode, setpoint=0x0f, ventilation=0x00, power=0x00, timer=None, callback=None):
         if timer:
             self._heater_timer = time.time() + (timer * 60)
         payload = b'\xff\xff' + mode.to_bytes(1, byteorder='big') \
@@ -565,11 +1459,11 @@ class AutotermHeater(AutotermUtils):
                   + power.to_bytes(1, byteorder='big')
         message = self.build(0x03, 0x01, payload=payload)
         if message != 0:
-            self._send_to_heater.append(message)
-            self._send_to_heater.append(message)
             # Message is sent twice as from the controller
+            self._queue_message(message)
+            return self._queue_message(message, callback, coalesce=False)
 
-    def change_settings(self, mode, setpoint=0x0f, ventilation=0x00, power=0x00, timer=None):
+    def change_settings(self, mode, setpoint=0x0f, ventilation=0x00, power=0x00, timer=None, callback=None):
         if timer:
             self._heater_timer = time.time() + (timer * 60)
         payload = b'\xff\xff' + mode.to_bytes(1, byteorder='big') \
@@ -578,136 +1472,152 @@ class AutotermHeater(AutotermUtils):
                   + power.to_bytes(1, byteorder='big')
         message = self.build(0x03, 0x02, payload=payload)
         if message != 0:
-            self._send_to_heater.append(message)
-            self._send_to_heater.append(message)
             # Message is sent twice as from the controller
+            self._queue_message(message)
+            return self._queue_message(message, callback, coalesce=False)
 
     # Heater info
-    def ask_for_heater_software_version(self):
+    def ask_for_heater_software_version(self, callback=None):
         message = self.build(0x03, 0x06)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
 
     def get_heater_software_version(self):
         return self._heater_software_version
 
-    def ask_for_heater_serial_number(self):
+    def ask_for_heater_serial_number(self, callback=None):
         message = self.build(0x03, 0x04)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
 
     def get_heater_serial_number(self):
         return self._heater_serial_number
 
+    def ask_for_heater_history(self, callback=None):
+        message = self.build(0x03, 0x0b)
+        if message != 0:
+            return self._queue_message(message, callback)
+
+    def get_history_snapshot(self):
+        return self._history
+
     # Heater settings
-    def asks_for_settings(self):
+    def asks_for_settings(self, callback=None):
         message = self.build(0x03, 0x02)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
+
+    def get_settings_snapshot(self):
+        return self._settings
 
     def get_heater_mode(self):
-        return self._heater_mode
+        return self._value(self._settings, 'mode')
 
     def get_heater_setpoint(self):
-        return self._heater_setpoint
+        return self._value(self._settings, 'setpoint')
 
     def get_heater_ventilation(self):
-        return self._heater_ventilation
+        return self._value(self._settings, 'ventilation')
 
     def get_heater_power_level(self):
-        return self._heater_power_level
+        return self._value(self._settings, 'power_level')
 
     # Heater status
-    def asks_for_status(self):
+    def asks_for_status(self, callback=None):
         message = self.build(0x03, 0x0f)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
+
+    def get_status_snapshot(self):
+        return self._status
 
     def get_heater_status(self):
-        return self._heater_status1, self._heater_status2
+        return self._value(self._status, 'status1'), self._value(self._status, 'status2')
 
     def get_heater_status_text(self):
-        if self._heater_status1[0]:
-            if self._heater_status1[0] in status_text.keys():
-                return status_text[self._heater_status1[0]]
+        if self._status:
+            return self._status.text
         return 'unknown status'
 
     def get_heater_errors(self):
-        return self._heater_errors
+        return self._value(self._status, 'errors')
 
     def get_heater_temperature(self):
-        return self._heater_temperature
+        return self._value(self._status, 'heater_temperature')
 
     def get_external_temperature(self):
-        return self._external_temperature
+        return self._value(self._status, 'external_temperature')
 
     def get_battery_voltage(self):
-        return self._battery_voltage
+        return self._value(self._status, 'battery_voltage')
 
     def get_flame_temperature(self):
-        return self._flame_temperature
+        return self._value(self._status, 'flame_temperature')
 
     # Controller temperature
-    def report_controller_temperature(self, temperature):
+    def report_controller_temperature(self, temperature, callback=None):
         payload = temperature.to_bytes(1, byteorder='big')
         message = self.build(0x03, 0x11, payload=payload)
         if message != 0:
-            self._send_to_heater.append(message)
             self._controller_temperature = temperature
+            return self._queue_message(message, callback)
 
     def get_controller_temperature(self):
         return self._controller_temperature
 
     # Diagnostic
-    def diagnostic_on(self):
+    def diagnostic_on(self, callback=None):
         payload = b'\x01'
         message = self.build(0x03, 0x07, payload=payload)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
 
-    def diagnostic_off(self):
+    def diagnostic_off(self, callback=None):
         payload = b'\x00'
         message = self.build(0x03, 0x07, payload=payload)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
 
-    def unblock(self):
+    def unblock(self, callback=None):
         message = self.build(0x03, 0x0d)
         if message != 0:
-            self._send_to_heater.append(message)
+            return self._queue_message(message, callback)
+
+    def get_diagnostic_snapshot(self):
+        return self._diagnostic
 
     def get_d_status(self):
-        return self._d_status1, self._d_status2
+        return self._value(self._diagnostic, 'status1'), self._value(self._diagnostic, 'status2')
 
     def get_d_counter1(self):
-        return self._d_counter1
+        return self._value(self._diagnostic, 'counter1')
 
     def get_d_counter2(self):
-        return self._d_counter2
+        return self._value(self._diagnostic, 'counter2')
 
     def get_d_defined_rev(self):
-        return self._d_defined_rev
+        return self._value(self._diagnostic, 'defined_rev')
 
     def get_d_measured_rev(self):
-        return self._d_measured_rev
+        return self._value(self._diagnostic, 'measured_rev')
 
     def get_d_fuel_pump1(self):
-        return self._d_fuel_pump1
+        return self._value(self._diagnostic, 'fuel_pump1')
 
     def get_d_fuel_pump2(self):
-        return self._d_fuel_pump2
+        return self._value(self._diagnostic, 'fuel_pump2')
 
     def get_d_chamber_temperature(self):
-        return self._d_chamber_temperature
+        return self._value(self._diagnostic, 'chamber_temperature')
 
     def get_d_flame_temperature(self):
-        return self._d_flame_temperature
+        return self._value(self._diagnostic, 'flame_temperature')
 
     def get_d_external_temperature(self):
-        return self._d_external_temperature
+        return self._value(self._diagnostic, 'external_temperature')
 
     def get_d_heater_temperature(self):
-        return self._d_heater_temperature
+        return self._value(self._diagnostic, 'heater_temperature')
 
     def get_d_battery_voltage(self):
-        return self._d_battery_voltage
+        return self._value(self._diagnostic, 'battery_voltage')
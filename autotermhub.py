@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Shares the heater link of AutotermHeater with other programs, e.g. diagnostic software under Wine, a second
+# monitoring process or a sniffer. Every client gets a pty or a connection to a unix socket.
+# Frames from clients are decoded and queued to the heater like own requests, so they never interleave with the
+# program's messages and wait for the write lock and pending responses. Frames on the link are kept once in a ring
+# of the immutable bytes the decoder created, each client only keeps its position in it and every client is written
+# the same objects.
+
+import collections
+import itertools
+import os
+import selectors
+import socket
+import threading
+import tty
+
+from autotermheater import CommandQueue, FrameDecoder
+
+# Clients see only the frames a device connected directly to the heater would see, None for all frames
+heater_devices = frozenset((0x00, 0x02, 0x04))
+
+
+def open_pty():
+    # Returns master file descriptor and the path of the slave device. The slave stays open, so the pty
+    # is not hung up when a client closes and reopens the port.
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, os.ttyname(slave), slave
+
+
+class FrameRing:
+    # The oldest frames are dropped when max_frames are kept, frames are bytes and never changed after append
+    def __init__(self, max_frames=4096):
+        self.frames = collections.deque(maxlen=max_frames)  # (sequence, device, bytes)
+        self.sequence = 0  # Of the next frame
+        self.lock = threading.Lock()
+
+    def append(self, data):
+        with self.lock:
+            self.frames.append((self.sequence, data[1], data))
+            self.sequence += 1
+
+    def since(self, sequence, limit=512):
+        # At most limit frames from the sequence number which were not dropped, and the number of lost frames
+        with self.lock:
+            frames = self.frames
+            if not frames or sequence >= self.sequence:
+                return [], 0
+            first = frames[0][0]
+            index = max(0, sequence - first)
+            return list(itertools.islice(frames, index, index + limit)), max(0, first - sequence)
+
+
+class _Client:
+    __slots__ = ('fd', 'owner', 'devices', 'decoder', 'sequence', 'partial', 'lost', 'received', 'writing')
+
+    def __init__(self, fd, owner, devices, sequence):
+        self.fd = fd
+        self.owner = owner  # Socket or slave fd which is closed with the client
+        self.devices = devices
+        self.decoder = FrameDecoder()
+        self.sequence = sequence  # Next frame to write
+        self.partial = 0  # Bytes of that frame already written
+        self.lost = 0
+        self.received = 0
+        self.writing = False  # Waiting until the client can take more bytes
+
+
+class LinkHub:
+    def __init__(self, heater, max_frames=4096):
+        # The heater publishes frames to the hub while it is attached, see stop()
+        self.heater = heater
+        self.ring = FrameRing(max_frames)
+        self._clients = {}  # File descriptor: _Client
+        self._listeners = {}  # File descriptor: (socket, path, devices)
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._changes = collections.deque()  # Registrations are done by the hub thread
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        heater._hub = self
+
+    def add_pty(self, devices=heater_devices):
+        # Returns path of the pty for the client
+        master, path, slave = open_pty()
+        os.set_blocking(master, False)
+        self._changes.append(_Client(master, slave, devices, self.ring.sequence))
+        self._wake()
+        return path
+
+    def listen(self, path, devices=heater_devices):
+        # Every connection to the unix socket is a client
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(16)
+        listener.setblocking(False)
+        self._changes.append((listener, path, devices))
+        self._wake()
+
+    def publish(self, data):
+        # Called from the worker thread of the heater with every frame on the link
+        self.ring.append(data)
+        if self._clients:
+            self._wake()
+
+    def stats(self):
+        return {'clients': len(self._clients), 'frames': self.ring.sequence,
+                'lost': sum(client.lost for client in list(self._clients.values())),
+                'received': sum(client.received for client in list(self._clients.values()))}
+
+    def stop(self):
+        if self.heater._hub is self:
+            self.heater._hub = None
+        self._running = False
+        self._wake()
+        self._thread.join(5.0)
+        for client in list(self._clients.values()):
+            self._remove(client)
+        for listener, path, devices in self._listeners.values():
+            listener.close()
+            os.unlink(path)
+        self._listeners.clear()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\x00')
+        except BlockingIOError:
+            pass
+
+    def _remove(self, client):
+        self._clients.pop(client.fd, None)
+        try:
+            self._selector.unregister(client.fd)
+        except (KeyError, ValueError):
+            pass
+        if isinstance(client.owner, socket.socket):
+            client.owner.close()
+        else:
+            os.close(client.fd)
+            os.close(client.owner)
+
+    def _apply_changes(self):
+        while self._changes:
+            change = self._changes.popleft()
+            if isinstance(change, _Client):
+                self._clients[change.fd] = change
+                self._selector.register(change.fd, selectors.EVENT_READ, change)
+            else:
+                self._listeners[change[0].fileno()] = change
+                self._selector.register(change[0].fileno(), selectors.EVENT_READ, change)
+
+    def _accept(self, listener, path, devices):
+        try:
+            connection, address = listener.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        self._changes.append(_Client(connection.fileno(), connection, devices, self.ring.sequence))
+
+    def _read(self, client):
+        if self._clients.get(client.fd) is not client:
+            return
+        try:
+            data = os.read(client.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            if isinstance(client.owner, socket.socket):
+                self._remove(client)
+            return
+        heater = self.heater
+        for message in client.decoder.feed(data):
+            client.received += 1
+            # Client repeats requests itself, only polls are merged with the same queued request.
+            # Messages which get no response (keepalive of the diagnostic software) are sent without waiting.
+            heater._queue_message(message.raw, coalesce=CommandQueue.priority(message.raw) == CommandQueue.POLL,
+                                  retry=False)
+
+    def _write(self, client):
+        if self._clients.get(client.fd) is not client:
+            return
+        # Number of buffers of one writev call is limited (IOV_MAX)
+        frames, lost = self.ring.since(client.sequence, 512)
+        if lost:
+            client.lost += lost
+            client.partial = 0
+        sequence_before, partial_before = client.sequence, client.partial
+        views = []
+        for sequence, device, data in frames:
+            if client.devices is None or device in client.devices:
+                # Only the rest of a partially written frame is a view, complete frames are the shared bytes
+                views.append((sequence, memoryview(data)[partial_before:] if sequence == sequence_before and
+                              partial_before else data))
+        if frames and not views:
+            client.sequence = frames[-1][0] + 1
+            client.partial = 0
+        written = 0
+        if views:
+            try:
+                written = os.writev(client.fd, [data for sequence, data in views])
+            except BlockingIOError:
+                written = 0
+            except OSError:
+                self._remove(client)
+                return
+            # Frames are skipped until the first which was not written completely
+            client.sequence = frames[-1][0] + 1
+            client.partial = 0
+            for sequence, data in views:
+                if written < len(data):
+                    client.sequence = sequence
+                    client.partial = written + (partial_before if sequence == sequence_before else 0)
+                    break
+                written -= len(data)
+        writing = client.sequence < self.ring.sequence
+        if writing != client.writing:
+            client.writing = writing
+            self._selector.modify(client.fd, selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0),
+                                  client)
+
+    def _run(self):
+        while self._running:
+            self._apply_changes()
+            for key, mask in self._selector.select(1.0):
+                data = key.data
+                if data is None:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                elif isinstance(data, tuple):
+                    self._accept(*data)
+                elif mask & selectors.EVENT_READ:
+                    self._read(data)
+            for client in list(self._clients.values()):
+                if client.sequence < self.ring.sequence:
+                    self._write(client)
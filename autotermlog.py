@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Logging which does not block the worker thread. Records are put to a bounded queue unformatted, a background
+# thread formats them and writes them to the file in batches, so a slow SD card does not delay the serial ports.
+# Records of periodic messages (same message text, e.g. 'Heater reports status (%s)') are written once per summary
+# interval together with the number of suppressed records. Other records, e.g. commands, are always written.
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Message texts of AutotermHeater logged with every status poll, keepalive or forwarded frame
+periodic_messages = frozenset((
+    'Heater reports status (%s)',
+    'Heater reports settings (%s)',
+    'Heater sends diagnostic message (%s)',
+    'Controller asks for status',
+    'Controller asks for settings',
+    'Controller reports temperature %d °C',
+    'Heater confirms controller temperature (%s)',
+    'PC sends initialization diagnostic message (%s)',
+    'Message forwarded (%s: %s, %.1f ms)',
+    'Unknown bytes forwarded (%s: %s)',
+))
+
+
+class AsyncFileHandler(logging.handlers.QueueHandler):
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path):
+        # One handler and writer thread per file, e.g. for all heaters of a HeaterFleet
+        with cls._shared_lock:
+            handler = cls._shared.get(os.path.abspath(path))
+            if handler is None or not handler._thread.is_alive():
+                handler = cls._shared[os.path.abspath(path)] = cls(path)
+            return handler
+
+    def __init__(self, path, queue_size=10000, batch_size=500, summary_interval=60, summarized=periodic_messages):
+        super().__init__(queue.Queue(queue_size))
+        self.baseFilename = os.path.abspath(path)
+        self.batch_size = batch_size
+        # Records with these message texts are summarized up to INFO, warnings and errors are always written
+        self.summary_interval = summary_interval
+        self.summarized = summarized
+
+        # Statistics
+        self.written = 0
+        self.dropped = 0
+        self.suppressed = 0
+
+        self._reported_dropped = 0
+        self._repeated = {}  # Message text: [suppressed records, last record]
+        self._summary_time = time.monotonic()
+        self._stream = open(self.baseFilename, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def prepare(self, record):
+        # Formatting is left to the writer thread, arguments like LazyHex hold immutable bytes
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _format(self, record, lines):
+        if self.summary_interval and record.levelno <= logging.INFO and record.msg in self.summarized:
+            repeated = self._repeated.get(record.msg)
+            if repeated:
+                repeated[0] += 1
+                repeated[1] = record
+                self.suppressed += 1
+                return
+            self._repeated[record.msg] = [0, None]
+        try:
+            lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def _summaries(self, lines):
+        for text, (count, record) in self._repeated.items():
+            if count:
+                record.msg = '{} [{} similar messages in {} s, this is the last one]'.format(
+                    record.msg, count, self.summary_interval)
+                lines.append(self.format(record))
+        self._repeated.clear()
+
+    def _writer(self):
+        running = True
+        while running:
+            lines = []
+            timeout = None
+            if self.summary_interval:
+                timeout = max(0.0, self._summary_time + self.summary_interval - time.monotonic())
+            try:
+                records = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                records = []
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in records:
+                if record is None:
+                    running = False
+                    continue
+                self._format(record, lines)
+            if self.summary_interval and (not running or time.monotonic() >= self._summary_time +
+                                          self.summary_interval):
+                self._summaries(lines)
+                self._summary_time = time.monotonic()
+            if self.dropped != self._reported_dropped:
+                lines.append(self.format(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '{} log records were dropped, the queue was full'.format(
+                        self.dropped - self._reported_dropped)})))
+                self._reported_dropped = self.dropped
+
+            if lines:
+                # One write and flush per batch
+                try:
+                    self._stream.write('\n'.join(lines) + '\n')
+                    self._stream.flush()
+                    self.written += len(lines)
+                except OSError:
+                    self.dropped += len(lines)
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped,
+                'suppressed': self.suppressed}
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(10.0)
+            self._stream.close()
+        super().close()
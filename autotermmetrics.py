@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Metrics of the worker loop in Prometheus text format, served by a small HTTP server in its own thread.
+# Counters are plain lists and numbers preallocated per heater, the worker thread only increments them.
+# Values owned by other objects (queue depth, decoder statistics) are read when the metrics are scraped.
+
+import bisect
+import http.server
+import threading
+
+# Priority classes of CommandQueue
+priority_text = ('stop', 'control', 'poll', 'temperature')
+
+
+class Histogram:
+    # Cumulative buckets are computed when rendered, observe() increments one bucket
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels.rstrip(','), self.total))
+        lines.append('{}_count{{{}}} {}'.format(name, labels.rstrip(','), self.count))
+        return lines
+
+
+class HeaterMetrics:
+    latency_bounds = (0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0)
+    iteration_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+    forward_bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+    def __init__(self, heater):
+        self.heater = heater
+        # Frames per direction and command ID, sent by the program are counted as 'P >> H'
+        self.frames = {direction: [0] * 256 for direction in ('1 >> 2', '2 >> 1', 'P >> H')}
+        self.latency = [None] * 256  # Histogram per command ID, created with the first response
+        self.write_lock_timeouts = 0
+        self.request_timeouts = 0
+        self.retries = 0
+        self.reconnects = 0
+        self.iteration = Histogram(self.iteration_bounds)
+        self.forward_latency = {direction: Histogram(self.forward_bounds) for direction in ('1 >> 2', '2 >> 1')}
+
+    def observe_latency(self, msg_id2, seconds):
+        histogram = self.latency[msg_id2]
+        if histogram is None:
+            histogram = self.latency[msg_id2] = Histogram(self.latency_bounds)
+        histogram.observe(seconds)
+
+    def render(self):
+        heater = self.heater
+        labels = 'heater="{}",'.format(heater.name or '')
+        lines = []
+
+        def add(name, kind, text, samples):
+            lines.append('# HELP autoterm_{} {}'.format(name, text))
+            lines.append('# TYPE autoterm_{} {}'.format(name, kind))
+            lines.extend(samples)
+
+        add('frames_total', 'counter', 'Valid frames per direction and command ID',
+            ['autoterm_frames_total{{{}direction="{}",command="0x{:02x}"}} {}'.format(labels, direction, msg_id2, count)
+             for direction, counts in self.frames.items() for msg_id2, count in enumerate(counts) if count])
+        decoders = [(link[3], link[2]) for link in heater._links]
+        for name, text in (('frames', 'Frames decoded'), ('crc_errors', 'Frames with invalid CRC'),
+                           ('resyncs', 'Searches for the next preamble'), ('discarded', 'Bytes outside of frames')):
+            add('decoder_{}_total'.format(name), 'counter', text,
+                ['autoterm_decoder_{}_total{{{}direction="{}"}} {}'.format(name, labels, direction,
+                                                                            getattr(decoder, name))
+                 for direction, decoder in decoders])
+        add('request_latency_seconds', 'histogram', 'Time from sending a request to the heater response',
+            [line for msg_id2, histogram in enumerate(self.latency) if histogram
+             for line in histogram.render('autoterm_request_latency_seconds',
+                                          '{}command="0x{:02x}",'.format(labels, msg_id2))])
+        queue = heater._send_to_heater.stats()
+        add('queue_depth', 'gauge', 'Messages waiting to be sent to the heater',
+            ['autoterm_queue_depth{{{}priority="{}"}} {}'.format(labels, priority_text[priority], depth)
+             for priority, depth in enumerate(queue['priorities'])])
+        add('pending_requests', 'gauge', 'Requests sent to the heater waiting for response',
+            ['autoterm_pending_requests{{{}}} {}'.format(labels.rstrip(','), len(heater._pending))])
+        for name, text in (('write_lock_timeouts', 'Controller messages not answered by the heater'),
+                           ('request_timeouts', 'Requests not answered after all retries'),
+                           ('retries', 'Requests sent again'), ('reconnects', 'Reconnections of serial ports')):
+            add('{}_total'.format(name), 'counter', text,
+                ['autoterm_{}_total{{{}}} {}'.format(name, labels.rstrip(','), getattr(self, name))])
+        for name, text in (('collisions', 'Control panel messages during exchanges of own messages'),
+                           ('deferred', 'Own messages held back until the control panel exchange is over')):
+            add('{}_total'.format(name), 'counter', text,
+                ['autoterm_{}_total{{{}}} {}'.format(name, labels.rstrip(','), getattr(heater._timing, name))])
+        add('forward_latency_seconds', 'histogram', 'Delay added by forwarding a message to the other port',
+            [line for direction, histogram in self.forward_latency.items() if histogram.count
+             for line in histogram.render('autoterm_forward_latency_seconds',
+                                          '{}direction="{}",'.format(labels, direction))])
+        add('worker_iteration_seconds', 'histogram', 'Processing time of one worker loop iteration',
+            self.iteration.render('autoterm_worker_iteration_seconds', labels))
+        return lines
+
+
+class MetricsServer:
+    # sources is a list of HeaterMetrics or a function returning it (e.g. for a HeaterFleet)
+    def __init__(self, sources, port=9464, address='127.0.0.1'):
+        self.sources = sources
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((address, port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def render(self):
+        sources = self.sources() if callable(self.sources) else self.sources
+        # Samples of one metric must be together, HELP and TYPE lines are written once
+        families = {}
+        for metrics in sources:
+            if metrics is None:
+                continue
+            name = None
+            known = False
+            for line in metrics.render():
+                if line.startswith('# HELP '):
+                    name = line.split()[2]
+                    known = name in families
+                    families.setdefault(name, [])
+                if line.startswith('#') and known:
+                    continue
+                families[name].append(line)
+        return '\n'.join(line for lines in families.values() for line in lines) + '\n'
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Decoded telemetry of AutotermHeater in shared memory, for analytics processes which should not compete for the GIL
+# with the worker thread. The block has a fixed layout (little endian) and readers copy it without locks:
+#   header    magic b'ATSHM\x00\x01\x00', generation (uint64, random for each publisher), sequence (uint64),
+#             crc32 of the sections (uint32), 4 bytes padding
+#   sections  status, settings and diagnostic: version (uint64, sequence of the last update, 0 before the first one)
+#             and all fields of the snapshot as float64, NaN for None
+# The worker is the only writer, the sequence is odd while it writes (seqlock). A reader retries when the sequence
+# was odd or changed during the copy, or when the crc does not match, which also catches stores seen out of order
+# on weakly ordered CPUs (the ARM of a Raspberry Pi).
+# Subscribers get a datagram with the generation, the new sequence and the index of the updated section on a unix
+# socket after every update. A subscriber attaches again to the block with the same name when the generation
+# changes, i.e. the publisher was restarted. A publisher also clears the magic of its block when it is closed,
+# so readers without subscription notice a restart after a clean exit too.
+#   SnapshotPublisher('autoterm_heater').add(heater)        in the program driving the heater
+#   reader = SnapshotReader('autoterm_heater')              in another process
+#   while reader.wait(10.0) ...: sequence, snapshots = reader.read()
+
+import argparse
+import math
+import os
+import select
+import socket
+import struct
+import tempfile
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+from autotermheater import DiagnosticSnapshot, SettingsSnapshot, StatusSnapshot
+
+sections = (('status', StatusSnapshot), ('settings', SettingsSnapshot), ('diagnostic', DiagnosticSnapshot))
+
+# Fields which are not integers
+float_fields = frozenset(('timestamp', 'battery_voltage', 'fuel_pump'))
+
+_magic = b'ATSHM\x00\x01\x00'
+_header = struct.Struct('<8sQQI4x')
+_sequence = struct.Struct('<Q')
+_sequence_offset = 16
+_notification = struct.Struct('<QQB')
+_subscribe = b'S'
+_unsubscribe = b'U'
+_published = set()  # Names of blocks created by this process
+
+
+def _build_layout():
+    # Snapshot type: (index, offset, struct), and size of the block
+    layout = {}
+    offset = _header.size
+    for index, (name, snapshot_type) in enumerate(sections):
+        layout[snapshot_type] = (index, offset, struct.Struct('<Q{}d'.format(len(snapshot_type._fields))))
+        offset += layout[snapshot_type][2].size
+    return layout, offset
+
+
+_layout, size = _build_layout()
+
+
+def socket_path(name):
+    # Default unix socket of the notifications of a block
+    return os.path.join(tempfile.gettempdir(), name + '.sock')
+
+
+def _mark_closed(shm):
+    # Readers still mapping the block see that it was replaced
+    shm.buf[:len(_magic)] = bytes(len(_magic))
+
+
+class SnapshotPublisher:
+    def __init__(self, name='autoterm_heater', notify_path=None):
+        # notify_path is the unix socket of the notifications, socket_path(name) if None, False for none
+        self.name = name
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left by a program which was killed
+            stale = shared_memory.SharedMemory(name)
+            _mark_closed(stale)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        _published.add(name)
+        self._buffer = self._shm.buf
+        self._buffer[:size] = bytes(size)
+        self.sequence = 0
+        self.generation = int.from_bytes(os.urandom(8), 'little')
+        _header.pack_into(self._buffer, 0, _magic, self.generation, 0, zlib.crc32(self._buffer[_header.size:size]))
+        self._heaters = []
+        self._subscribers = set()
+        self._socket = None
+        self.notify_path = socket_path(name) if notify_path is None else notify_path
+        if self.notify_path:
+            if os.path.exists(self.notify_path):
+                os.unlink(self.notify_path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self.notify_path)
+            self._socket.setblocking(False)
+
+        # Statistics
+        self.published = 0
+        self.notified = 0
+        self.dropped = 0  # Notifications not sent because the subscriber's queue was full
+
+    def add(self, heater):
+        heater.register_snapshot_callback(self._on_snapshot)
+        self._heaters.append(heater)
+        for snapshot in (heater.get_status_snapshot(), heater.get_settings_snapshot(),
+                         heater.get_diagnostic_snapshot()):
+            if snapshot:
+                self.publish(snapshot)
+
+    def remove(self, heater):
+        if heater in self._heaters:
+            heater.unregister_snapshot_callback(self._on_snapshot)
+            self._heaters.remove(heater)
+
+    def _on_snapshot(self, heater, snapshot):
+        self.publish(snapshot)
+
+    def publish(self, snapshot):
+        # Called from the worker thread, the only writer of the block
+        index, offset, layout = _layout[type(snapshot)]
+        buffer = self._buffer
+        sequence = self.sequence + 1
+        _sequence.pack_into(buffer, _sequence_offset, sequence)
+        layout.pack_into(buffer, offset, sequence + 1, *(math.nan if value is None else value for value in snapshot))
+        crc = zlib.crc32(buffer[_header.size:size])
+        self.sequence = sequence + 1
+        _header.pack_into(buffer, 0, _magic, self.generation, self.sequence, crc)
+        self.published += 1
+        if self._socket:
+            self._notify(index)
+
+    def _notify(self, index):
+        sock = self._socket
+        # Subscriptions arrive on the same socket, they are handled before each notification
+        while True:
+            try:
+                data, address = sock.recvfrom(16)
+            except (BlockingIOError, InterruptedError):
+                break
+            if data == _subscribe:
+                self._subscribers.add(address)
+            elif data == _unsubscribe:
+                self._subscribers.discard(address)
+        if not self._subscribers:
+            return
+        message = _notification.pack(self.generation, self.sequence, index)
+        for address in list(self._subscribers):
+            try:
+                sock.sendto(message, address)
+                self.notified += 1
+            except BlockingIOError:
+                # The subscriber reads the newest values anyway when it gets to them
+                self.dropped += 1
+            except OSError:
+                self._subscribers.discard(address)
+
+    def stats(self):
+        return {'sequence': self.sequence, 'published': self.published, 'subscribers': len(self._subscribers),
+                'notified': self.notified, 'dropped': self.dropped}
+
+    def close(self):
+        for heater in list(self._heaters):
+            self.remove(heater)
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+            os.unlink(self.notify_path)
+        _mark_closed(self._shm)
+        self._shm.close()
+        self._shm.unlink()
+        _published.discard(self.name)
+
+
+class SnapshotReader:
+    def __init__(self, name='autoterm_heater', notify_path=None, subscribe=True):
+        self.name = name
+        self.notify_path = socket_path(name) if notify_path is None else notify_path
+        self._socket = None
+        self._shm = None
+        self._attach()
+        if subscribe:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # Abstract address chosen by the kernel
+            self._socket.bind('')
+            self._socket.setblocking(False)
+            self._subscribe()
+
+        # Statistics
+        self.reads = 0
+        self.retries = 0
+        self.attached = 1
+
+    def _attach(self):
+        try:
+            shm = shared_memory.SharedMemory(self.name, track=False)
+        except TypeError:
+            # Before Python 3.13 the resource tracker would remove the block when this process ends,
+            # unless the block was created by this process and is removed by its publisher
+            shm = shared_memory.SharedMemory(self.name)
+            if self.name not in _published:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        if bytes(shm.buf[:len(_magic)]) != _magic:
+            shm.close()
+            raise ValueError('{} is not a heater snapshot block'.format(self.name))
+        if self._shm:
+            self._shm.close()
+        self._shm = shm
+        self._buffer = shm.buf
+        self.generation = _header.unpack_from(shm.buf)[1]
+
+    def _reattach(self):
+        # Block of a publisher which ended was replaced by a new one, returns False while there is none
+        try:
+            self._attach()
+        except (FileNotFoundError, ValueError):
+            return False
+        self.attached += 1
+        if self._socket:
+            self._subscribe()
+        return True
+
+    def _subscribe(self):
+        try:
+            self._socket.sendto(_subscribe, self.notify_path)
+        except OSError:
+            # Publisher is not running, subscription is sent again by wait()
+            pass
+
+    def fileno(self):
+        # Readable when a notification arrived, e.g. for select() in the reader's own loop
+        return self._socket.fileno()
+
+    def wait(self, timeout=None):
+        # Sequence and section name of the newest update, None after timeout
+        if self._socket is None:
+            raise ValueError('Reader of {} was created without subscription'.format(self.name))
+        if not select.select([self._socket], [], [], timeout)[0]:
+            # Publisher may have been restarted and forgot the subscription
+            self._subscribe()
+            return None
+        generation = sequence = index = None
+        while True:
+            try:
+                generation, sequence, index = _notification.unpack(self._socket.recv(_notification.size))
+            except BlockingIOError:
+                break
+        if sequence is None:
+            return None
+        if generation != self.generation:
+            self._reattach()
+        return sequence, sections[index][0]
+
+    def read(self, timeout=1.0):
+        # Sequence and {section name: snapshot, None before the first update} of a consistent copy
+        end = time.monotonic() + timeout
+        while True:
+            buffer = self._buffer
+            data = bytes(buffer[:size])
+            magic, generation, sequence, crc = _header.unpack_from(data)
+            if magic != _magic:
+                self._reattach()
+            elif not sequence & 1 and zlib.crc32(memoryview(data)[_header.size:]) == crc and \
+                    _sequence.unpack_from(buffer, _sequence_offset)[0] == sequence:
+                break
+            self.retries += 1
+            if time.monotonic() > end:
+                raise TimeoutError('No consistent copy of {}'.format(self.name))
+            time.sleep(0)
+        self.reads += 1
+
+        snapshots = {}
+        for name, snapshot_type in sections:
+            index, offset, layout = _layout[snapshot_type]
+            values = layout.unpack_from(data, offset)
+            if not values[0]:
+                snapshots[name] = None
+                continue
+            snapshots[name] = snapshot_type(*(None if math.isnan(value) else value if field in float_fields
+                                              else int(value) for field, value in zip(snapshot_type._fields,
+                                                                                      values[1:])))
+        return sequence, snapshots
+
+    def close(self):
+        if self._socket:
+            try:
+                self._socket.sendto(_unsubscribe, self.notify_path)
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+        if self._shm:
+            self._shm.close()
+            self._shm = None
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Prints heater snapshots published in shared memory')
+    parser.add_argument('name', nargs='?', default='autoterm_heater')
+    args = parser.parse_args()
+    reader = SnapshotReader(args.name)
+    try:
+        while True:
+            if reader.wait(10.0) is None:
+                continue
+            sequence, snapshots = reader.read()
+            print(sequence, ', '.join('{}: {}'.format(name, snapshot._asdict())
+                                      for name, snapshot in snapshots.items() if snapshot))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    _main()
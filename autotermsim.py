@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Simulated heater and control panel on Linux pseudo-terminals, and replay of captures.
+# AutotermHeater can be pointed at the printed port, e.g. AutotermHeater(log_path, serial_port1='/dev/pts/5').
+
+import argparse
+import os
+import select
+import tempfile
+import termios
+import threading
+import time
+
+from autotermheater import AutotermUtils, FrameDecoder
+from autotermhub import open_pty
+import autotermcapture
+
+
+class _Device(threading.Thread):
+    # Common part of simulated devices, answers messages from its pty and runs a periodic tick
+    device = 0x04
+    tick = 1.0
+
+    def __init__(self, baudrate=2400, speed=1.0, log_path=os.devnull):
+        super().__init__(daemon=True)
+        self.master, self.port, self._slave = open_pty()
+        self.baudrate = baudrate
+        # Bytes sent at a different baud rate than the client's port is set to are received as garbage
+        self._speed = getattr(termios, 'B{}'.format(baudrate), None) if baudrate else None
+        self.speed = speed
+        self.utils = AutotermUtils(log_path)
+        self.decoder = FrameDecoder()
+        self.received = 0
+        self.sent = 0
+        # Half-duplex line: messages which arrive while the device is answering are lost
+        self.half_duplex = False
+        self.collisions = 0
+        self._running = True
+
+    def stop(self):
+        self._running = False
+        self.join(2.0)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _line_matches(self):
+        return self._speed is None or termios.tcgetattr(self.master)[4] == self._speed
+
+    def send(self, msg_id2, payload=b'', device=None):
+        message = self.utils.build(self.device if device is None else device, msg_id2, payload=payload)
+        # Wire time of the message at the simulated baud rate
+        if self.baudrate:
+            time.sleep(len(message) * 10 / self.baudrate)
+        if not self._line_matches():
+            message = bytes(byte ^ 0x5a for byte in message)
+        os.write(self.master, message)
+        self.sent += 1
+
+    def run(self):
+        next_tick = time.monotonic()
+        while self._running:
+            timeout = max(0.0, next_tick - time.monotonic())
+            if select.select([self.master], [], [], min(timeout, 0.1))[0]:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    # No client has the port open
+                    time.sleep(0.05)
+                    continue
+                if not self._line_matches():
+                    continue
+                answered = False
+                for message in self.decoder.feed(data):
+                    if answered:
+                        self.collisions += 1
+                        continue
+                    self.received += 1
+                    sent = self.sent
+                    self.on_message(message)
+                    answered = self.half_duplex and self.sent != sent
+                if answered and select.select([self.master], [], [], 0)[0]:
+                    os.read(self.master, 4096)
+                    self.decoder.reset()
+                    self.collisions += 1
+            if time.monotonic() >= next_tick:
+                self.on_tick()
+                next_tick += self.tick / self.speed
+
+    def on_message(self, message):
+        pass
+
+    def on_tick(self):
+        pass
+
+
+class SimulatedHeater(_Device):
+    # State machine following serial_communication_protocol.md, times are scaled by speed.
+    # (major, minor state, seconds in the state before the next one)
+    start_sequence = [((2, 1), 20), ((2, 2), 20), ((2, 3), 20), ((2, 4), 30), ((3, 0), None)]
+    cooldown_time = 120
+
+    def __init__(self, baudrate=2400, speed=1.0, log_path=os.devnull, serial_number=(4766, 5504),
+                 software_version=(3, 1, 14, 2, 3)):
+        super().__init__(baudrate, speed, log_path)
+        self.serial_number = serial_number
+        self.software_version = software_version
+        self.state = (0, 1)
+        self.state_time = 0.0
+        self.errors = 0
+        self.timer = 120
+        self.mode = 2
+        self.setpoint = 15
+        self.ventilation = 0
+        self.power_level = 1
+        self.heater_temperature = 21
+        self.external_temperature = 127
+        self.battery_voltage = 131
+        self.flame_temperature = 302
+        self.controller_temperature = None
+        self.diagnostic = False
+        self.ignore = set()  # Command IDs the heater does not answer, e.g. to test retries
+        self.response_delay = 0.0  # Seconds before the heater answers
+
+    def _settings_payload(self):
+        return self.timer.to_bytes(2, 'big') + bytes((self.mode, self.setpoint, self.ventilation, self.power_level))
+
+    def _apply_settings(self, payload):
+        # 0xff keeps the current value
+        if payload[0:2] != b'\xff\xff':
+            self.timer = int.from_bytes(payload[0:2], 'big')
+        if len(payload) >= 6:
+            for name, value in zip(('mode', 'setpoint', 'ventilation', 'power_level'), payload[2:6]):
+                if value != 0xff:
+                    setattr(self, name, value)
+
+    def _set_state(self, state):
+        self.state = state
+        self.state_time = 0.0
+
+    def status_payload(self):
+        return bytes((self.state[0], self.state[1], self.errors, self.heater_temperature & 0xff,
+                      self.external_temperature & 0xff)) + self.battery_voltage.to_bytes(2, 'big') \
+            + self.flame_temperature.to_bytes(2, 'big') + b'\x00'
+
+    def diagnostic_payload(self):
+        payload = bytearray(72)
+        payload[0:2] = bytes(self.state)
+        payload[5:8] = int(self.state_time).to_bytes(3, 'big')
+        payload[8:11] = int(self.state_time).to_bytes(3, 'big')
+        running = self.state[0] in (2, 3)
+        payload[11] = payload[12] = 60 if running else 0
+        payload[17] = 120 if self.state == (3, 0) else 0
+        payload[18:20] = self.flame_temperature.to_bytes(2, 'big')
+        payload[20:22] = self.flame_temperature.to_bytes(2, 'big')
+        payload[24] = self.external_temperature & 0xff
+        payload[25] = self.heater_temperature & 0xff
+        payload[26:28] = self.battery_voltage.to_bytes(2, 'big')
+        payload[28] = self.errors
+        return bytes(payload)
+
+    def on_message(self, message):
+        if message.device != 0x03 or message.msg_id2 in self.ignore:
+            return
+        if self.response_delay:
+            time.sleep(self.response_delay)
+        msg_id2 = message.msg_id2
+        payload = message.payload
+        if msg_id2 == 0x01:
+            self._apply_settings(payload)
+            if self.state[0] in (0, 4):
+                self._set_state(self.start_sequence[0][0])
+            self.send(0x01, self._settings_payload())
+        elif msg_id2 == 0x02:
+            if payload:
+                self._apply_settings(payload)
+            self.send(0x02, self._settings_payload())
+        elif msg_id2 == 0x03:
+            if self.state == (3, 0x23) or self.state[0] == 0:
+                self._set_state((0, 1))
+            elif self.state[0] in (2, 3):
+                self._set_state((4, 0))
+            self.send(0x03)
+        elif msg_id2 == 0x04:
+            self.send(0x04, self.serial_number[0].to_bytes(2, 'big') + self.serial_number[1].to_bytes(3, 'big'))
+        elif msg_id2 == 0x06:
+            self.send(0x06, bytes(self.software_version))
+        elif msg_id2 == 0x07:
+            self.diagnostic = bool(payload and payload[0])
+            self.send(0x07, payload[:1])
+        elif msg_id2 == 0x0d:
+            self.errors = 0
+            # Heater answers the unblock message with device 0x00, see messages/messages_diagnostic.md
+            self.send(0x0d, device=0x00)
+        elif msg_id2 == 0x0f:
+            self.send(0x0f, self.status_payload())
+        elif msg_id2 == 0x11:
+            self.controller_temperature = payload[0] if payload else None
+            self.send(0x11, payload[:1])
+        elif msg_id2 in (0x1c, 0x1e):
+            # Initialization messages of the control panel
+            self.send(msg_id2, device=0x00)
+        elif msg_id2 == 0x23 and len(payload) >= 3:
+            # Shorter messages are ignored like unknown ones
+            if payload[0:2] != b'\xff\xff':
+                self.timer = int.from_bytes(payload[0:2], 'big')
+            self.power_level = payload[2]
+            self._set_state((3, 0x23))
+            self.send(0x23, payload[0:3] + b'\x00')
+
+    def on_tick(self):
+        self.state_time += self.tick
+        major = self.state[0]
+        # Flame temperature follows the combustion
+        if major in (2, 3) and self.state != (3, 0x23):
+            self.flame_temperature = min(self.flame_temperature + 5, 523)
+        elif self.flame_temperature > 302:
+            self.flame_temperature -= 2
+        for index, (state, duration) in enumerate(self.start_sequence):
+            if state == self.state and duration is not None and self.state_time >= duration:
+                self._set_state(self.start_sequence[index + 1][0])
+                break
+        if self.state == (4, 0) and self.state_time >= self.cooldown_time:
+            self._set_state((0, 1))
+        if self.diagnostic:
+            self.send(0x01, self.diagnostic_payload(), device=0x02)
+
+
+class SimulatedPanel(_Device):
+    # Control panel with the handshake and ~3 s polling loop of the Comfort panel
+    device = 0x03
+
+    def __init__(self, baudrate=2400, speed=1.0, log_path=os.devnull, temperature=20):
+        super().__init__(baudrate, speed, log_path)
+        self.temperature = temperature
+        self.responses = 0
+        self._sequence = [(0x06, b''), (0x04, b'')]
+        self._cycle = [(0x02, b''), (0x0f, b''), (0x11, None)]
+        self._index = 0
+
+    def on_message(self, message):
+        if message.device in (0x00, 0x04):
+            self.responses += 1
+
+    def on_tick(self):
+        if self._sequence:
+            msg_id2, payload = self._sequence.pop(0)
+        else:
+            msg_id2, payload = self._cycle[self._index % len(self._cycle)]
+            self._index += 1
+        if payload is None:
+            payload = bytes((self.temperature & 0xff,))
+        self.send(msg_id2, payload)
+
+
+def replay(capture, fd, speed=1.0, direction=None, loop=False):
+    # Writes records of a capture to the file descriptor with the original timing divided by speed.
+    # Text captures (message_captures/) are converted first.
+    if not capture.endswith('.atc'):
+        converted = tempfile.NamedTemporaryFile(suffix='.atc')
+        with autotermcapture.CaptureWriter(converted.name) as writer:
+            autotermcapture.import_text_log(capture, writer)
+        capture = converted.name
+    written = 0
+    with autotermcapture.CaptureReader(capture) as reader:
+        while True:
+            start = None
+            began = time.monotonic()
+            for timestamp, record_direction, data in reader.records():
+                if direction is not None and record_direction & 0x7f != direction:
+                    continue
+                if start is None:
+                    start = timestamp
+                delay = began + (timestamp - start) / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                os.write(fd, data)
+                written += 1
+            if not loop:
+                return written
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Simulated heater, control panel and capture replay on ptys')
+    parser.add_argument('mode', choices=('heater', 'panel', 'replay'))
+    parser.add_argument('capture', nargs='?', help='capture to replay')
+    parser.add_argument('-b', '--baudrate', type=int, default=2400, help='simulated wire speed (0 = unlimited)')
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help='N-times faster state changes or replay')
+    parser.add_argument('-d', '--direction', type=int, choices=(1, 2), help='replay only records from this port')
+    parser.add_argument('--loop', action='store_true', help='replay the capture again and again')
+    args = parser.parse_args()
+
+    if args.mode == 'replay':
+        master, port, slave = open_pty()
+        print('Replaying {} on {}, press Enter to start'.format(args.capture, port))
+        input()
+        print('{} records written'.format(replay(args.capture, master, args.speed, args.direction, args.loop)))
+        return
+
+    device = (SimulatedHeater if args.mode == 'heater' else SimulatedPanel)(args.baudrate, args.speed)
+    device.start()
+    print('Simulated {} on {}'.format(args.mode, device.port))
+    try:
+        while True:
+            time.sleep(5)
+            print('received {}, sent {}'.format(device.received, device.sent))
+    except KeyboardInterrupt:
+        device.stop()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Persistent telemetry in SQLite, fed with the snapshots decoded by AutotermHeater. A background thread writes
+# batches in one transaction (WAL mode), so the SD card is written every flush_interval seconds and not with every
+# message. Raw values are kept for raw_days, minute aggregates for minute_days and hour aggregates for hour_days.
+# Tables are keyed by (channel, time) without rowid, a query of one channel and time range is an index range scan.
+#
+#   channels  id, heater, name
+#   raw       channel, timestamp, value            a value is stored when it changes, or after keepalive seconds
+#   minute    channel, bucket, minimum, maximum, total, count
+#   hour      channel, bucket, minimum, maximum, total, count
+
+import queue
+import sqlite3
+import threading
+import time
+
+import autotermtelemetry
+
+RAW = autotermtelemetry.RAW
+MINUTE = autotermtelemetry.MINUTE
+HOUR = autotermtelemetry.HOUR
+
+# Stored values of each snapshot type and prefixes of their channel names
+snapshot_channels = {
+    'StatusSnapshot': ('', ('status1', 'status2', 'errors') + autotermtelemetry.status_channels),
+    'SettingsSnapshot': ('s_', ('timer', 'mode', 'setpoint', 'ventilation', 'power_level')),
+    'DiagnosticSnapshot': ('d_', autotermtelemetry.diagnostic_channels),
+}
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, heater TEXT NOT NULL, name TEXT NOT NULL,
+                                     UNIQUE (heater, name));
+CREATE TABLE IF NOT EXISTS raw (channel INTEGER NOT NULL, timestamp REAL NOT NULL, value REAL,
+                                PRIMARY KEY (channel, timestamp)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS minute (channel INTEGER NOT NULL, bucket INTEGER NOT NULL, minimum REAL, maximum REAL,
+                                   total REAL, count INTEGER, PRIMARY KEY (channel, bucket)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hour (channel INTEGER NOT NULL, bucket INTEGER NOT NULL, minimum REAL, maximum REAL,
+                                 total REAL, count INTEGER, PRIMARY KEY (channel, bucket)) WITHOUT ROWID;
+'''
+
+_insert_raw = 'INSERT OR REPLACE INTO raw (channel, timestamp, value) VALUES (?, ?, ?)'
+# Aggregates of a batch are merged with the rows already stored for the same bucket
+_upsert_aggregate = '''INSERT INTO {0} (channel, bucket, minimum, maximum, total, count) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (channel, bucket) DO UPDATE SET minimum = min(minimum, excluded.minimum),
+    maximum = max(maximum, excluded.maximum), total = total + excluded.total, count = count + excluded.count'''
+
+
+class TelemetryStore:
+    def __init__(self, path, flush_interval=30, batch_size=5000, keepalive=60, raw_days=7, minute_days=90,
+                 hour_days=None, queue_size=10000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.keepalive = keepalive
+        self.retention = ((RAW, raw_days), (MINUTE, minute_days), (HOUR, hour_days))
+        self._queue = queue.Queue(queue_size)
+        self._local = threading.local()  # Read connection of each querying thread
+        self._heaters = []
+
+        # Statistics
+        self.received = 0
+        self.dropped = 0
+        self.written = 0
+        self.transactions = 0
+
+        connection = self._connect()
+        connection.executescript(_schema)
+        connection.close()
+        self._flushed = threading.Condition()
+        self._flush_requested = False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # Committed transactions may be lost with power, but the database stays consistent
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def add(self, heater):
+        heater.register_snapshot_callback(self._on_snapshot)
+        self._heaters.append(heater)
+
+    def remove(self, heater):
+        if heater in self._heaters:
+            heater.unregister_snapshot_callback(self._on_snapshot)
+            self._heaters.remove(heater)
+
+    def _on_snapshot(self, heater, snapshot):
+        # Called from the worker thread, the snapshot is only queued
+        self.received += 1
+        try:
+            self._queue.put_nowait((heater.name or 'heater', snapshot))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=10.0):
+        # Writes queued snapshots now, e.g. before a query of the newest values
+        with self._flushed:
+            self._flush_requested = True
+            self._queue.put(None)
+            self._flushed.wait_for(lambda: not self._flush_requested, timeout)
+
+    def close(self):
+        for heater in list(self._heaters):
+            self.remove(heater)
+        if self._thread.is_alive():
+            self._queue.put(False)
+            self._thread.join(30.0)
+
+    def range(self, channel, start=None, end=None, resolution=RAW, heater='heater'):
+        # Raw: [(timestamp, value)], aggregates: [(bucket start, minimum, maximum, mean)], start <= time < end
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        if resolution == RAW:
+            query = 'SELECT timestamp, value FROM raw WHERE channel = ? AND timestamp >= ? AND timestamp < ? ' \
+                    'ORDER BY timestamp'
+        elif resolution in (MINUTE, HOUR):
+            query = 'SELECT bucket, minimum, maximum, total / count FROM {} WHERE channel = ? AND bucket >= ? ' \
+                    'AND bucket < ? ORDER BY bucket'.format('minute' if resolution == MINUTE else 'hour')
+        else:
+            raise ValueError('Unknown resolution {}'.format(resolution))
+        row = connection.execute('SELECT id FROM channels WHERE heater = ? AND name = ?', (heater, channel)).fetchone()
+        if row is None:
+            return []
+        return connection.execute(query, (row[0], start, end)).fetchall()
+
+    def stats(self):
+        return {'received': self.received, 'dropped': self.dropped, 'queued': self._queue.qsize(),
+                'written': self.written, 'transactions': self.transactions}
+
+    def _writer(self):
+        connection = self._connect()
+        channels = dict(((heater, name), channel) for channel, heater, name in
+                        connection.execute('SELECT id, heater, name FROM channels'))
+        last = {}  # Channel: (timestamp, value) of the last stored raw value
+        raw = []
+        minutes = {}  # (channel, bucket): [minimum, maximum, total, count] of the batch
+        hours = {}
+        next_flush = time.monotonic() + self.flush_interval
+        next_cleanup = 0
+        running = True
+
+        while running:
+            try:
+                item = self._queue.get(timeout=max(0.0, next_flush - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is False:
+                running = False
+            elif item:
+                name, snapshot = item
+                prefix, names = snapshot_channels[type(snapshot).__name__]
+                timestamp = snapshot.timestamp
+                for value_name in names:
+                    value = getattr(snapshot, value_name)
+                    if value is None:
+                        continue
+                    key = (name, prefix + value_name)
+                    channel = channels.get(key)
+                    if channel is None:
+                        channel = channels[key] = connection.execute(
+                            'INSERT INTO channels (heater, name) VALUES (?, ?)', key).lastrowid
+                    previous = last.get(channel)
+                    if previous is None or previous[1] != value or timestamp - previous[0] >= self.keepalive:
+                        raw.append((channel, timestamp, value))
+                        last[channel] = (timestamp, value)
+                    for aggregates, size in ((minutes, 60), (hours, 3600)):
+                        bucket = int(timestamp // size * size)
+                        aggregate = aggregates.get((channel, bucket))
+                        if aggregate is None:
+                            aggregates[(channel, bucket)] = [value, value, value, 1]
+                        else:
+                            aggregate[0] = min(aggregate[0], value)
+                            aggregate[1] = max(aggregate[1], value)
+                            aggregate[2] += value
+                            aggregate[3] += 1
+                if len(raw) < self.batch_size and time.monotonic() < next_flush and not self._flush_requested:
+                    continue
+
+            if raw or minutes or not running or self._flush_requested:
+                # One transaction for the whole batch
+                with connection:
+                    connection.executemany(_insert_raw, raw)
+                    connection.executemany(_upsert_aggregate.format('minute'),
+                                           [key + tuple(value) for key, value in minutes.items()])
+                    connection.executemany(_upsert_aggregate.format('hour'),
+                                           [key + tuple(value) for key, value in hours.items()])
+                    if time.monotonic() >= next_cleanup:
+                        self._cleanup(connection)
+                        next_cleanup = time.monotonic() + 3600
+                self.written += len(raw)
+                self.transactions += 1
+                raw = []
+                minutes = {}
+                hours = {}
+            next_flush = time.monotonic() + self.flush_interval
+            if self._flush_requested:
+                with self._flushed:
+                    self._flush_requested = False
+                    self._flushed.notify_all()
+        connection.close()
+
+    def _cleanup(self, connection):
+        # Retention tiers, rows older than the days of their tier are deleted
+        now = time.time()
+        for resolution, days in self.retention:
+            if days is None:
+                continue
+            table, column = {RAW: ('raw', 'timestamp'), MINUTE: ('minute', 'bucket'), HOUR: ('hour', 'bucket')}[
+                resolution]
+            # Range delete within each channel uses the primary key
+            connection.execute('DELETE FROM {0} WHERE channel IN (SELECT id FROM channels) AND {1} < ?'.format(
+                table, column), (now - days * 86400,))
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# History of heater values in fixed-size ring buffers, the memory does not grow however long the program runs.
+# Every channel keeps raw samples and minute and hour aggregates (min, max, mean). Buffers are array.array, a range
+# is returned as arrays which can be wrapped without copying, e.g. numpy.frombuffer(values, numpy.float32).
+
+import array
+import bisect
+import threading
+
+# Values of StatusSnapshot and DiagnosticSnapshot which are recorded, diagnostic channels are prefixed with d_
+status_channels = ('heater_temperature', 'external_temperature', 'battery_voltage', 'flame_temperature',
+                   'fan_setpoint', 'fan_actual', 'fuel_pump', 'water_pump')
+diagnostic_channels = ('counter1', 'counter2', 'defined_rev', 'measured_rev', 'fuel_pump1', 'fuel_pump2',
+                       'chamber_temperature', 'flame_temperature', 'external_temperature', 'heater_temperature',
+                       'battery_voltage')
+
+RAW = 'raw'
+MINUTE = '1m'
+HOUR = '1h'
+
+
+class RingBuffer:
+    # Timestamps (float64) and one or more value columns (float32), the oldest sample is overwritten when full.
+    # Timestamps must not decrease, so each of the two filled parts of the buffer is sorted.
+    def __init__(self, capacity, columns=1):
+        self.capacity = capacity
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.columns = tuple(array.array('f', bytes(4 * capacity)) for i in range(columns))
+        self._head = 0  # Index of the next write
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, *values):
+        head = self._head
+        self.timestamps[head] = timestamp
+        for column, value in zip(self.columns, values):
+            column[head] = value
+        self._head = (head + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def _segments(self):
+        # Physical (start, end) parts of the buffer from the oldest to the newest sample
+        if self._count < self.capacity:
+            return ((0, self._head),)
+        return ((self._head, self.capacity), (0, self._head))
+
+    def range(self, start=None, end=None):
+        # Samples with start <= timestamp < end as (timestamps, column, ...), binary search in each part
+        timestamps = self.timestamps
+        parts = []
+        for low, high in self._segments():
+            first = low if start is None else bisect.bisect_left(timestamps, start, low, high)
+            last = high if end is None else bisect.bisect_left(timestamps, end, first, high)
+            if first < last:
+                parts.append((first, last))
+        result = [array.array('d'), *(array.array('f') for column in self.columns)]
+        for first, last in parts:
+            result[0].extend(timestamps[first:last])
+            for values, column in zip(result[1:], self.columns):
+                values.extend(column[first:last])
+        return tuple(result)
+
+    def last(self):
+        if not self._count:
+            return None
+        index = self._head - 1
+        return (self.timestamps[index], *(column[index] for column in self.columns))
+
+
+class _Aggregate:
+    # Running min, max and mean of the current bucket
+    __slots__ = ('bucket', 'minimum', 'maximum', 'total', 'count')
+
+    def __init__(self):
+        self.bucket = None
+
+    def add(self, bucket, minimum, maximum, total, count):
+        if self.bucket != bucket:
+            self.bucket = bucket
+            self.minimum, self.maximum, self.total, self.count = minimum, maximum, total, count
+        else:
+            self.minimum = min(self.minimum, minimum)
+            self.maximum = max(self.maximum, maximum)
+            self.total += total
+            self.count += count
+
+
+class Channel:
+    def __init__(self, raw_capacity=17280, minute_capacity=10080, hour_capacity=8760):
+        # Defaults keep a day of status messages (every 5 s), a week of minutes and a year of hours
+        self.raw = RingBuffer(raw_capacity)
+        self.minute = RingBuffer(minute_capacity, 3)
+        self.hour = RingBuffer(hour_capacity, 3)
+        self._minute = _Aggregate()
+        self._hour = _Aggregate()
+        self._last = float('-inf')
+
+    def append(self, timestamp, value):
+        # Wall clock may step back (NTP sync), such samples get the time of the last one to keep buffers sorted
+        if timestamp < self._last:
+            timestamp = self._last
+        self._last = timestamp
+        self.raw.append(timestamp, value)
+        minute = timestamp // 60 * 60
+        current = self._minute
+        if current.bucket is not None and current.bucket != minute:
+            self._close_minute()
+        current.add(minute, value, value, value, 1)
+
+    def _close_minute(self):
+        current = self._minute
+        self.minute.append(current.bucket, current.minimum, current.maximum, current.total / current.count)
+        hour = current.bucket // 3600 * 3600
+        if self._hour.bucket is not None and self._hour.bucket != hour:
+            hourly = self._hour
+            self.hour.append(hourly.bucket, hourly.minimum, hourly.maximum, hourly.total / hourly.count)
+        self._hour.add(hour, current.minimum, current.maximum, current.total, current.count)
+
+    def range(self, start=None, end=None, resolution=RAW):
+        # Raw: (timestamps, values), aggregates: (bucket starts, minimums, maximums, means).
+        # Buckets which are still being filled are included, so the newest data is never missing.
+        if resolution == RAW:
+            return self.raw.range(start, end)
+        minute = self._minute
+        if resolution == MINUTE:
+            buffer = self.minute
+            current = [minute] if minute.bucket is not None else []
+        elif resolution == HOUR:
+            buffer = self.hour
+            current = [self._hour] if self._hour.bucket is not None else []
+            if minute.bucket is not None:
+                # The open minute belongs to the open hour or starts the next one
+                hour = minute.bucket // 3600 * 3600
+                if not current or current[-1].bucket != hour:
+                    current.append(_Aggregate())
+                else:
+                    current[-1] = _Aggregate()
+                    current[-1].add(hour, self._hour.minimum, self._hour.maximum, self._hour.total, self._hour.count)
+                current[-1].add(hour, minute.minimum, minute.maximum, minute.total, minute.count)
+        else:
+            raise ValueError('Unknown resolution {}'.format(resolution))
+        result = buffer.range(start, end)
+        for aggregate in current:
+            if (start is None or aggregate.bucket >= start) and (end is None or aggregate.bucket < end):
+                for values, value in zip(result, (aggregate.bucket, aggregate.minimum, aggregate.maximum,
+                                                  aggregate.total / aggregate.count)):
+                    values.append(value)
+        return result
+
+
+class TelemetryHistory:
+    def __init__(self, raw_capacity=17280, minute_capacity=10080, hour_capacity=8760):
+        self._lock = threading.Lock()
+        self.channels = {name: Channel(raw_capacity, minute_capacity, hour_capacity)
+                         for name in status_channels + tuple('d_' + name for name in diagnostic_channels)}
+
+    def _record(self, snapshot, names, prefix):
+        with self._lock:
+            for name in names:
+                value = getattr(snapshot, name)
+                if value is not None:
+                    self.channels[prefix + name].append(snapshot.timestamp, value)
+
+    def record_status(self, snapshot):
+        self._record(snapshot, status_channels, '')
+
+    def record_diagnostic(self, snapshot):
+        self._record(snapshot, diagnostic_channels, 'd_')
+
+    def range(self, name, start=None, end=None, resolution=RAW):
+        with self._lock:
+            return self.channels[name].range(start, end, resolution)
+
+    def last(self, name):
+        with self._lock:
+            return self.channels[name].raw.last()
+
+    def memory(self):
+        # Bytes used by all buffers, it does not change after creation
+        return sum(len(buffer.timestamps) * 8 + sum(len(column) * 4 for column in buffer.columns)
+                   for channel in self.channels.values() for buffer in (channel.raw, channel.minute, channel.hour))
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Timing of the traffic between the control panel and the heater in passthrough mode. The period of the panel's
+# messages and the duration of its exchanges with the heater are learned from the frames, own requests are sent
+# only when their exchange ends before the panel's next message is expected. All times are monotonic nanoseconds.
+
+import collections
+
+
+class BusTiming:
+    def __init__(self, window=32, guard=0.02):
+        self.guard_ns = int(guard * 1e9)  # Idle time kept around the panel's exchanges
+        # Last samples
+        self.periods = collections.deque(maxlen=window)  # Between starts of consecutive panel messages
+        self.response_delays = collections.deque(maxlen=window)  # From the end of a panel message to the response
+        self.exchanges = collections.deque(maxlen=window)  # From the start of a panel message to the response end
+        self.gaps = collections.deque(maxlen=window)  # Idle time between consecutive frames
+        self.last_device = None
+        self.last_end_ns = None
+        self.panel_start_ns = None
+        self.panel_end_ns = None
+        self.own_until_ns = 0  # Expected end of the exchanges of own requests
+        self._deferred_since = None
+        self._model = None
+
+        # Statistics
+        self.frames = 0
+        self.injected = 0
+        self.deferred = 0
+        self.collisions = 0
+        self.retries = 0
+
+    def observe(self, device, start_ns, end_ns):
+        self.frames += 1
+        if self.last_end_ns is not None and start_ns > self.last_end_ns:
+            self.gaps.append(start_ns - self.last_end_ns)
+        if device == 0x03:
+            # Panels repeat their messages every second or so, longer pauses are not a period
+            if self.panel_start_ns is not None and start_ns - self.panel_start_ns < 10 ** 10:
+                self.periods.append(start_ns - self.panel_start_ns)
+            self.panel_start_ns = start_ns
+            self.panel_end_ns = end_ns
+            if start_ns < self.own_until_ns:
+                self.collisions += 1
+            self._model = None
+        elif device == 0x04 and self.last_device == 0x03:
+            self.response_delays.append(max(0, start_ns - self.panel_end_ns))
+            self.exchanges.append(end_ns - self.panel_start_ns)
+            self._model = None
+        self.last_device = device
+        self.last_end_ns = end_ns
+
+    @staticmethod
+    def _median(samples):
+        return sorted(samples)[len(samples) // 2] if samples else None
+
+    def model(self):
+        # (period, jitter, exchange, response delay) in ns, None while there are not enough samples
+        if self._model is None:
+            period = jitter = None
+            if len(self.periods) >= 4:
+                periods = sorted(self.periods)
+                period = periods[len(periods) // 2]
+                jitter = periods[len(periods) * 9 // 10] - periods[len(periods) // 10]
+            self._model = (period, jitter, self._median(self.exchanges), self._median(self.response_delays))
+        return self._model
+
+    def exchange_ns(self, request_time, response_time):
+        # Expected duration of an own exchange, frame times are in seconds
+        response_delay = self.model()[3]
+        return int((request_time + response_time) * 1e9) + (self.guard_ns if response_delay is None
+                                                            else response_delay)
+
+    def send_time(self, now_ns, duration_ns):
+        # Earliest time when an exchange of the duration does not overlap the panel's next exchange
+        period, jitter, exchange, response_delay = self.model()
+        if period is None:
+            return now_ns
+        start = max(now_ns, self.own_until_ns)
+        since = start - self.panel_start_ns
+        if since > 3 * period:
+            # Panel went quiet
+            return now_ns
+        if self._deferred_since is not None and now_ns - self._deferred_since > 2 * period:
+            # Exchange never fits between the panel's messages, it is sent anyway
+            return now_ns
+        next_start = self.panel_start_ns + period * (since // period + 1)
+        if start + duration_ns + self.guard_ns + min(jitter, period // 4) <= next_start:
+            return now_ns
+        return next_start + (exchange or 0) + self.guard_ns
+
+    def defer(self, now_ns):
+        if self._deferred_since is None:
+            self._deferred_since = now_ns
+            self.deferred += 1
+
+    def inject(self, now_ns, duration_ns):
+        self.injected += 1
+        self.own_until_ns = max(now_ns, self.own_until_ns) + duration_ns
+        self._deferred_since = None
+
+    def stats(self):
+        period, jitter, exchange, response_delay = self.model()
+
+        def ms(value):
+            return None if value is None else value / 1e6
+        return {'frames': self.frames, 'panel_period_ms': ms(period), 'panel_jitter_ms': ms(jitter),
+                'exchange_ms': ms(exchange), 'response_delay_ms': ms(response_delay),
+                'gap_ms': ms(self._median(self.gaps)), 'injected': self.injected, 'deferred': self.deferred,
+                'collisions': self.collisions, 'retries': self.retries,
+                'collision_rate': self.collisions / self.injected if self.injected else 0.0,
+                'retry_rate': self.retries / self.injected if self.injected else 0.0}
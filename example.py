@@ -4,7 +4,9 @@ from autotermheater import AutotermHeater
 heater_log_path = '/home/pi/AutotermHeaterController/appdata/logs/PlanarHeater.log'
 
 heater = AutotermHeater(serial_num='A50285BI', log_path=heater_log_path, log_level=logging.INFO)
+heater.register_connection_callback(lambda state: print('Connection state: {}'.format(state)))
 
+heater.wait_connected()
 print('Connection with heater successfully initialized.')
 
 while True:
@@ -0,0 +1,745 @@
+import argparse
+import base64
+import glob
+import logging
+import os
+import random
+import re
+import select
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from autotermheater import AutotermHeater, AutotermUtils, Crc16, FrameDecoder, StatusSnapshot  # noqa: E402
+from autotermfleet import HeaterFleet  # noqa: E402
+from autotermgateway import Gateway, read_websocket_frame  # noqa: E402
+from autotermcapture import CaptureReader, PORT1, PORT2  # noqa: E402
+from autotermhub import LinkHub  # noqa: E402
+from autotermshm import SnapshotPublisher, SnapshotReader  # noqa: E402
+from autotermsim import SimulatedHeater, SimulatedPanel  # noqa: E402
+from autotermstore import TelemetryStore  # noqa: E402
+from message_passthrough import Sniffer  # noqa: E402
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Frames taken from message_captures/, the last one is a 72 byte diagnostic message from the heater
+frames = [
+    bytes.fromhex('aa0300000f587c'),
+    bytes.fromhex('aa040600020078020f0001fa3c'),
+    bytes.fromhex('aa040a000f000100157f0083012e006060'),
+    bytes.fromhex('aa02480001000100000000049200000400000000000000012a012b00027f19007a00350244032803ff02620'
+                  '1f8016b003d003403ff0000200000040f05000000000000000003ff0000620000005106'),
+]
+
+
+def load_captures():
+    # Valid messages found in the hand-written captures and message descriptions
+    decoder = FrameDecoder()
+    messages = []
+    for path in sorted(glob.glob(os.path.join(repository, 'message_captures', '**', '*.*'), recursive=True) +
+                       glob.glob(os.path.join(repository, 'messages', '*.md'))):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                match = re.search(r'\baa[ |`0-9a-f]*', line, re.IGNORECASE)
+                if match:
+                    digits = re.sub(r'[ |`]', '', match.group())
+                    messages += decoder.feed(bytes.fromhex(digits[:len(digits) // 2 * 2]))
+    return messages
+
+
+def crc16_bitwise(package):
+    # Original bit-by-bit implementation, kept as a reference
+    crc = 0xffff
+    for byte in package:
+        crc ^= byte
+        for i in range(8):
+            if (crc & 0x0001) != 0:
+                crc >>= 1
+                crc ^= 0xa001
+            else:
+                crc >>= 1
+    return crc.to_bytes(2, byteorder='big')
+
+
+def measure(function, data, duration):
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        for i in range(100):
+            function(data)
+        count += 100
+    elapsed = time.perf_counter() - start
+    return count * len(data) / elapsed / 1e6, count / elapsed
+
+
+def bench_crc(duration):
+    def streaming(data):
+        crc = Crc16()
+        for i in range(0, len(data), 8):
+            crc.update(data[i:i + 8])
+        return crc.digest()
+
+    for frame in frames:
+        assert frame[-2:] == AutotermUtils.crc16(frame[:-2])
+        assert crc16_bitwise(frame) == AutotermUtils.crc16(frame) == streaming(frame)
+
+    print('CRC-16/Modbus')
+    for size in (7, 79, 4096):
+        data = (b''.join(frames) * (size // 7 + 1))[:size]
+        for name, function in (('bitwise', crc16_bitwise), ('table', AutotermUtils.crc16),
+                               ('streaming', streaming)):
+            mbps, rate = measure(function, data, duration)
+            print('  {:>5} B  {:<10} {:8.2f} MB/s  {:10.0f} calls/s'.format(size, name, mbps, rate))
+
+
+def pty_pair():
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, os.ttyname(slave)
+
+
+def wait_for(fd, expected, timeout=2.0):
+    data = b''
+    end = time.perf_counter() + timeout
+    while expected not in data:
+        remaining = end - time.perf_counter()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            return False
+        data += os.read(fd, 4096)
+    return True
+
+
+def bench_loop(duration):
+    # Worker thread in passthrough mode between two pseudo-terminals
+    master1, port1 = pty_pair()
+    master2, port2 = pty_pair()
+    log = tempfile.NamedTemporaryFile(suffix='.log')
+    heater = AutotermHeater(log.name, serial_port1=port1, serial_port2=port2, log_level=logging.WARNING)
+    heater.wait_connected(2.0)
+    time.sleep(0.5)
+
+    cpu = time.process_time()
+    time.sleep(duration)
+    cpu = time.process_time() - cpu
+
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        os.write(master1, frames[0])
+        if wait_for(master2, frames[0]):
+            latencies.append(time.perf_counter() - start)
+        time.sleep(0.05)
+    heater._stop_working()
+
+    latencies.sort()
+    print('Worker loop')
+    print('  idle CPU            {:6.1f} %'.format(cpu / duration * 100))
+    print('  forward latency     median {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms ({} frames)'.format(
+        statistics.median(latencies) * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3, latencies[-1] * 1e3,
+        len(latencies)))
+
+
+def bench_dispatch(duration):
+    # Messages from the captures processed by a heater object with stopped worker thread
+    messages = load_captures()
+    master, port = pty_pair()
+    log = tempfile.NamedTemporaryFile(suffix='.log')
+    heater = AutotermHeater(log.name, serial_port1=port, log_level=logging.CRITICAL)
+    heater.wait_connected(2.0)
+    heater._stop_working()
+    ser_port = heater._ser1
+
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        for message in messages:
+            heater._process_message(message, ser_port)
+        count += len(messages)
+    elapsed = time.perf_counter() - start
+
+    print('Message processing')
+    print('  {} captured messages, {:.0f} messages/s'.format(len(messages), count / elapsed))
+
+
+def bench_requests(duration):
+    # Status requests answered by the simulated heater without wire delay
+    simulator = SimulatedHeater(baudrate=0)
+    simulator.start()
+    log = tempfile.NamedTemporaryFile(suffix='.log')
+    heater = AutotermHeater(log.name, serial_port1=simulator.port, log_level=logging.WARNING)
+    heater.wait_connected(2.0)
+    time.sleep(0.5)
+
+    latencies = []
+    cpu = time.process_time()
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        sent = time.perf_counter()
+        heater.asks_for_status().result(2.0)
+        latencies.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    heater._stop_working()
+    simulator.stop()
+
+    latencies.sort()
+    print('Requests to simulated heater')
+    print('  {:.0f} requests/s, CPU {:.1f} %'.format(len(latencies) / elapsed, cpu / elapsed * 100))
+    print('  round trip          median {:.2f} ms, p99 {:.2f} ms'.format(
+        statistics.median(latencies) * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3))
+
+
+def bench_fleet(duration):
+    # Heaters with own worker threads compared to one HeaterFleet, status is requested from all heaters at once
+    log = tempfile.NamedTemporaryFile(suffix='.log')
+    print('Fleet of simulated heaters')
+    for count in (1, 8, 32):
+        simulators = [SimulatedHeater(baudrate=0) for i in range(count)]
+        for simulator in simulators:
+            simulator.start()
+        for mode in ('threads', 'fleet'):
+            fleet = None
+            if mode == 'fleet':
+                fleet = HeaterFleet(log.name, logging.WARNING).start()
+                heaters = [fleet.add(str(i), serial_port1=simulator.port) for i, simulator in enumerate(simulators)]
+            else:
+                heaters = [AutotermHeater(log.name, serial_port1=simulator.port, log_level=logging.WARNING)
+                           for simulator in simulators]
+            time.sleep(0.5)
+            threads = threading.active_count()
+
+            rounds = 0
+            cpu = time.process_time()
+            start = time.perf_counter()
+            end = start + duration
+            while time.perf_counter() < end:
+                for future in [heater.asks_for_status() for heater in heaters]:
+                    future.result(2.0)
+                rounds += 1
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+
+            if fleet:
+                fleet.close()
+            else:
+                for heater in heaters:
+                    heater._stop_working()
+                    heater._disconnect()
+            print('  {:3} heaters {:<8} {:8.0f} requests/s, CPU {:5.1f} %, {} threads'.format(
+                count, mode, rounds * count / elapsed, cpu / elapsed * 100, threads))
+        for simulator in simulators:
+            simulator.stop()
+
+
+def bench_metrics(duration):
+    # Cost of the instrumentation on the message path, same captured messages with and without metrics
+    messages = load_captures()
+    master1, port1 = pty_pair()
+    master2, port2 = pty_pair()
+    log = tempfile.NamedTemporaryFile(suffix='.log')
+    heater = AutotermHeater(log.name, serial_port1=port1, serial_port2=port2, log_level=logging.CRITICAL)
+    heater.wait_connected(2.0)
+    heater._stop_working()
+    link = heater._links[0]
+    decoder = link[2]
+    data = b''.join(message.raw for message in messages)
+
+    print('Metrics overhead')
+    results = {}
+    for mode in ('off', 'on', 'off', 'on'):
+        if mode == 'on':
+            heater.start_metrics()
+        else:
+            heater.stop_metrics()
+        heater._read_message = lambda ser_port: data
+        count = 0
+        start = time.perf_counter()
+        end = start + duration
+        while time.perf_counter() < end:
+            heater._process_link(*link)
+            os.read(master2, 65536)
+            count += len(messages)
+        results.setdefault(mode, []).append(count / (time.perf_counter() - start))
+    scrape = time.perf_counter()
+    lines = heater._metrics.render()
+    scrape = time.perf_counter() - scrape
+    for mode, rates in results.items():
+        print('  metrics {:<4} {:10.0f} messages/s'.format(mode, max(rates)))
+    print('  overhead     {:10.1f} %'.format((1 - max(results['on']) / max(results['off'])) * 100))
+    print('  scrape       {:10.2f} ms ({} lines, {} decoded frames)'.format(scrape * 1e3, len(lines), decoder.frames))
+
+
+def bench_forward(duration):
+    # Passthrough of a status message written byte by byte at the wire speed. On a real line the other port can
+    # only start sending when the first byte is forwarded, so the first byte delay is the latency added per frame.
+    frame = frames[2]
+    print('Forwarding (first byte delay / last byte delay)')
+    for baudrate in (2400, 9600):
+        byte_time = 10 / baudrate
+        for cut_through in (False, True):
+            master1, port1 = pty_pair()
+            master2, port2 = pty_pair()
+            log = tempfile.NamedTemporaryFile(suffix='.log')
+            heater = AutotermHeater(log.name, serial_port1=port1, serial_port2=port2, log_level=logging.WARNING,
+                                    cut_through=cut_through)
+            heater.wait_connected(2.0)
+            heater._status_delay = heater._settings_delay = 3600
+            heater.start_metrics()
+
+            first, last = [], []
+            end = time.perf_counter() + duration
+            while time.perf_counter() < end:
+                start = time.perf_counter()
+                received = b''
+                first_time = last_time = None
+                for index in range(len(frame)):
+                    sent = time.perf_counter()
+                    os.write(master1, frame[index:index + 1])
+                    deadline = start + (index + 1) * byte_time
+                    while len(received) < len(frame):
+                        remaining = deadline - time.perf_counter()
+                        if index == len(frame) - 1:
+                            remaining = 1.0
+                        if remaining <= 0 or not select.select([master2], [], [], remaining)[0]:
+                            break
+                        received += os.read(master2, 4096)
+                        last_time = time.perf_counter()
+                        if first_time is None:
+                            first_time = last_time
+                if received == frame:
+                    first.append(first_time - start)
+                    last.append(last_time - sent)
+                time.sleep(0.02)
+            histogram = heater._metrics.forward_latency['1 >> 2']
+            heater._stop_working()
+
+            print('  {:5} Bd {:<15} {:7.2f} ms / {:5.2f} ms, measured by the program {:.2f} ms ({} frames)'.format(
+                baudrate, 'cut-through' if cut_through else 'store-forward', statistics.median(first) * 1e3,
+                statistics.median(last) * 1e3, histogram.total / max(histogram.count, 1) * 1e3, len(first)))
+
+
+def bench_logging(duration):
+    # Message path at DEBUG level with a log file whose flush takes 2 ms, as on a slow SD card
+    messages = load_captures()
+    data = b''.join(message.raw for message in messages)
+    print('Logging at DEBUG level (flush 2 ms)')
+    for async_log in (False, True):
+        master1, port1 = pty_pair()
+        master2, port2 = pty_pair()
+        log = tempfile.NamedTemporaryFile(suffix='.log')
+        heater = AutotermHeater(log.name, serial_port1=port1, serial_port2=port2, log_level=logging.DEBUG,
+                                name='async' if async_log else 'sync', async_log=async_log)
+        heater.wait_connected(2.0)
+        heater._stop_working()
+        stream = heater.log_handler._stream if async_log else heater.log_handler.stream
+        flush = stream.flush
+
+        def slow_flush():
+            time.sleep(0.002)
+            flush()
+        stream.flush = slow_flush
+        link = heater._links[0]
+        heater._read_message = lambda ser_port: data
+
+        count = 0
+        start = time.perf_counter()
+        end = start + duration
+        while time.perf_counter() < end:
+            heater._process_link(*link)
+            os.read(master2, 65536)
+            count += len(messages)
+        elapsed = time.perf_counter() - start
+        stats = heater.get_log_stats()
+        heater.logger.removeHandler(heater.log_handler)
+        heater.log_handler.close()
+        print('  {:<6} {:10.0f} messages/s{}'.format('async' if async_log else 'sync', count / elapsed,
+                                                   ', {written} written, {suppressed} summarized, {dropped} dropped'
+                                                   .format(**stats) if stats else ''))
+
+
+def bench_gateway(duration):
+    # Status changes pushed to WebSocket clients, and polling of the telemetry with and without ETag
+    class Heater:
+        name = 'bench'
+        register_snapshot_callback = unregister_snapshot_callback = lambda self, callback: None
+        register_connection_callback = unregister_connection_callback = lambda self, callback: None
+        get_connection_state = lambda self: 'connected'
+        get_status_snapshot = get_settings_snapshot = get_diagnostic_snapshot = lambda self: None
+
+    heater = Heater()
+    gateway = Gateway([heater], port=0).start()
+    print('Gateway')
+    for count in (1, 100, 300):
+        clients = []
+        for i in range(count):
+            client = socket.create_connection(('127.0.0.1', gateway.port))
+            client.sendall('GET /stream HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                           'Sec-WebSocket-Key: {}\r\n\r\n'.format(base64.b64encode(os.urandom(16)).decode()).encode())
+            file = client.makefile('rb')
+            while file.readline() not in (b'\r\n', b''):
+                pass
+            read_websocket_frame(file)
+            clients.append((client, file))
+        latencies = []
+        cpu = time.process_time()
+        start = time.perf_counter()
+        end = start + duration
+        temperature = 0
+        while time.perf_counter() < end:
+            temperature += 1
+            sent = time.perf_counter()
+            gateway._on_snapshot(heater, StatusSnapshot(time.time(), 3, 0, 0, temperature % 100, 10, 12.5, 400))
+            for client, file in clients:
+                read_websocket_frame(file)
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        for client, file in clients:
+            client.close()
+        print('  {:3} WebSocket clients {:6.0f} changes/s, all clients received after {:.2f} ms (median)'.format(
+            count, len(latencies) / elapsed, statistics.median(latencies) * 1e3))
+
+    url = 'http://127.0.0.1:{}/telemetry'.format(gateway.port)
+    etag = urllib.request.urlopen(url).headers['ETag']
+    for mode in ('full', 'etag'):
+        count = 0
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            request = urllib.request.Request(url, headers={'If-None-Match': etag} if mode == 'etag' else {})
+            try:
+                urllib.request.urlopen(request).read()
+            except urllib.error.HTTPError:
+                pass
+            count += 1
+        print('  GET /telemetry {:<4} {:6.0f} requests/s'.format(mode, count / duration))
+    gateway.stop()
+
+
+def bench_timing(duration):
+    # Requests sent while a control panel polls a half-duplex heater, with and without gap-aware scheduling
+    print('Requests next to a control panel (half-duplex heater, 2400 Bd, panel message every 0.33 s)')
+    for gap_scheduling in (False, True):
+        simulator = SimulatedHeater()
+        simulator.half_duplex = True
+        simulator.response_delay = 0.03
+        panel = SimulatedPanel(speed=3)
+        simulator.start()
+        panel.start()
+        log = tempfile.NamedTemporaryFile(suffix='.log')
+        heater = AutotermHeater(log.name, serial_port1=simulator.port, serial_port2=panel.port,
+                                log_level=logging.WARNING)
+        heater.gap_scheduling = gap_scheduling
+        heater.wait_connected(2.0)
+        # Panel's timing is learned from its first messages
+        time.sleep(3)
+        collisions = simulator.collisions
+
+        completed = failed = 0
+        start = time.perf_counter()
+        end = start + max(duration, 5)
+        while time.perf_counter() < end:
+            try:
+                heater.ask_for_heater_software_version().result(5)
+                completed += 1
+            except TimeoutError:
+                failed += 1
+        elapsed = time.perf_counter() - start
+        stats = heater.get_timing_stats()
+        heater._stop_working()
+        panel.stop()
+        simulator.stop()
+        # Collisions are messages of the program or the panel lost by the heater
+        print('  {:<10} {:5.1f} requests/s, {} failed, {} collisions, {} retries, {} deferred'.format(
+            'gap-aware' if gap_scheduling else 'when idle', completed / elapsed, failed,
+            simulator.collisions - collisions, stats['retries'], stats['deferred']))
+
+
+def bench_store(duration):
+    # 30 days of status messages every 30 s written to the SQLite store, then a month of battery voltage is queried
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, 'telemetry.db')
+    store = TelemetryStore(path, flush_interval=3600)
+    now = time.time()
+    count = 30 * 86400 // 30
+    start = time.perf_counter()
+    for i in range(count):
+        timestamp = now - (count - i) * 30
+        store._queue.put(('heater', StatusSnapshot(timestamp, 3, 0, 0, 40 + i % 7, 10, 12.0 + i % 5 / 10, 400)))
+    store.flush(60.0)
+    elapsed = time.perf_counter() - start
+    stats = store.stats()
+    print('SQLite telemetry store')
+    print('  {} status messages in {:.2f} s ({:.0f}/s), {} raw rows, {} transactions, {:.1f} MB'.format(
+        count, elapsed, count / elapsed, len(store.range('battery_voltage', now - 30 * 86400)),
+        stats['transactions'], sum(os.path.getsize(name) for name in glob.glob(path + '*')) / 1e6))
+    for resolution in ('raw', '1m', '1h'):
+        start = time.perf_counter()
+        rows = store.range('battery_voltage', now - 30 * 86400, resolution=resolution)
+        print('  battery voltage of 30 days {:<3} {:6} rows in {:6.2f} ms'.format(
+            resolution, len(rows), (time.perf_counter() - start) * 1e3))
+    store.close()
+
+
+def bench_hub(duration):
+    # Captured messages processed by the worker with the link shared to pty clients, which are read by a thread
+    messages = load_captures()
+    data = b''.join(message.raw for message in messages)
+    print('Link hub (messages processed by the worker, bytes delivered to each client)')
+    for count in (None, 0, 1, 8):
+        master1, port1 = pty_pair()
+        log = tempfile.NamedTemporaryFile(suffix='.log')
+        heater = AutotermHeater(log.name, serial_port1=port1, log_level=logging.CRITICAL)
+        heater.wait_connected(2.0)
+        heater._stop_working()
+        link = heater._links[0]
+        heater._read_message = lambda ser_port: data
+        hub = None
+        clients = []
+        if count is not None:
+            hub = LinkHub(heater)
+            clients = [os.open(hub.add_pty(devices=None), os.O_RDWR | os.O_NOCTTY) for i in range(count)]
+        delivered = {fd: 0 for fd in clients}
+        reading = True
+
+        def reader():
+            while reading:
+                for fd in select.select(clients, [], [], 0.1)[0]:
+                    delivered[fd] += len(os.read(fd, 65536))
+        thread = threading.Thread(target=reader)
+        thread.start()
+
+        processed = 0
+        start = time.perf_counter()
+        end = start + duration
+        while time.perf_counter() < end:
+            heater._process_link(*link)
+            processed += len(messages)
+            # Keep the rate close to what the clients can take, lost frames are counted by the hub
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        time.sleep(0.2)
+        reading = False
+        thread.join()
+        stats = hub.stats() if hub else None
+        if hub:
+            hub.stop()
+        for fd in clients:
+            os.close(fd)
+        print('  {:<10} {:8.0f} messages/s{}'.format(
+            'no hub' if count is None else '{} clients'.format(count), processed / elapsed,
+            ', {:.0f} kB to each client, {} frames lost'.format(
+                min(delivered.values()) / 1e3, stats['lost']) if clients else ''))
+
+
+def bench_sniffer(duration):
+    # Stress test of the sniffer between two pseudo-terminals. Captured messages with garbage between them are
+    # written in random chunks to both ports at multiples of the 9600 Bd wire rate, or as fast as possible.
+    # The capture must contain every byte in order.
+    messages = load_captures()
+    print('Sniffer (bytes passed in both directions, lossless when the capture equals the sent bytes)')
+    for output, rate in (('capture.atc', 100), ('capture.txt', 100), ('capture.atc', 1000), ('capture.txt', 1000),
+                         ('capture.atc', None)):
+        master1, port1 = pty_pair()
+        master2, port2 = pty_pair()
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, output)
+        sniffer = Sniffer(path, interval=0.05)
+        sniffer.add_serial(port1, 115200)
+        sniffer.add_serial(port2, 115200)
+        runner = threading.Thread(target=sniffer.run)
+        runner.start()
+
+        sent = {master1: bytearray(), master2: bytearray()}
+        forwarded = {master1: 0, master2: 0}
+        writing = True
+
+        def writer(fd, seed):
+            generator = random.Random(seed)
+            begin = time.perf_counter()
+            while writing:
+                data = bytearray()
+                for i in range(generator.randint(1, 32)):
+                    data += generator.choice(messages).raw
+                    if generator.random() < 0.1:
+                        data += b'\x1b\x1b'
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view[:generator.randint(1, 512)]):]
+                sent[fd] += data
+                if rate:
+                    time.sleep(max(0.0, begin + len(sent[fd]) / (rate * 960) - time.perf_counter()))
+
+        def reader():
+            while writing or any(forwarded[fd] < len(sent[other]) for fd, other in ((master1, master2),
+                                                                                     (master2, master1))):
+                for fd in select.select([master1, master2], [], [], 0.1)[0]:
+                    forwarded[fd] += len(os.read(fd, 65536))
+        threads = [threading.Thread(target=writer, args=(master1, 1)),
+                   threading.Thread(target=writer, args=(master2, 2)), threading.Thread(target=reader)]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        time.sleep(duration)
+        writing = False
+        for thread in threads:
+            thread.join(5.0)
+        elapsed = time.perf_counter() - start
+        sniffer.stop()
+        runner.join()
+        sniffer.close()
+        stats = sniffer.stats()
+
+        if output.endswith('.atc'):
+            captured = {PORT1: bytearray(), PORT2: bytearray()}
+            with CaptureReader(path) as capture:
+                for timestamp, direction, data in capture.records():
+                    captured[direction] += data
+        else:
+            captured = {'1 >> 2': bytearray(), '2 >> 1': bytearray()}
+            with open(path) as file:
+                for line in file:
+                    direction, data = line.split(None, 1)[1].split(':', 1)
+                    captured[direction] += bytes.fromhex(data.rsplit('(', 1)[0])
+            captured = {PORT1: captured['1 >> 2'], PORT2: captured['2 >> 1']}
+        lossless = captured[PORT1] == sent[master1] and captured[PORT2] == sent[master2]
+        total = len(sent[master1]) + len(sent[master2])
+        forwarded_all = forwarded[master2] == len(sent[master1]) and forwarded[master1] == len(sent[master2])
+        print('  {:<4} {:>13} {:7.3f} MB/s, {} frames, forwarded {}, lossless {}, ring {} kB, {} batches, '
+              '{} lost'.format(output.split('.')[1], '{}x 9600 Bd'.format(rate) if rate else 'unlimited',
+                               total / elapsed / 1e6, stats['frames'], 'yes' if forwarded_all else 'no',
+                               'yes' if lossless else 'no', stats['ring_high_water'] // 1024, stats['batches'],
+                               stats['lost']))
+        for fd in (master1, master2):
+            os.close(fd)
+        directory.cleanup()
+
+
+def analytics(read, running):
+    # Pure Python work on the newest values, like a trend fit of a dashboard
+    while running():
+        snapshot = read()
+        total = 0.0
+        for i in range(20000):
+            total += (i % 7) * 0.5
+        if snapshot is None:
+            time.sleep(0.001)
+
+
+def shm_client(name, mode):
+    # Runs in its own interpreter like a real analytics program, until its stdin is closed.
+    # Every published status of the copy test has equal integer fields, a torn copy would mix two of them.
+    reader = SnapshotReader(name, subscribe=mode == 'copies')
+
+    def running():
+        return not select.select([sys.stdin], [], [], 0)[0]
+    if mode == 'analytics':
+        analytics(lambda: reader.read()[1]['status'], running)
+    torn = 0
+    while mode == 'copies' and running():
+        for i in range(1000):
+            status = reader.read()[1]['status']
+            if status and len(set((status.status1, status.status2, status.errors, status.heater_temperature))) != 1:
+                torn += 1
+    print(reader.reads, reader.retries, torn)
+    reader.close()
+
+
+def start_shm_client(name, mode):
+    code = 'import sys; sys.path.insert(0, {!r}); import benchmark; benchmark.shm_client({!r}, {!r})'.format(
+        os.path.dirname(os.path.abspath(__file__)), name, mode)
+    return subprocess.Popen([sys.executable, '-c', code], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+
+def bench_shm(duration):
+    # Cost of publishing, consistency of copies in another process, and forwarding latency of the worker with
+    # analytics in a thread of the same process or in another process reading the shared memory
+    print('Shared memory snapshots')
+    name = 'autoterm_benchmark_{}'.format(os.getpid())
+    publisher = SnapshotPublisher(name)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        publisher.publish(StatusSnapshot(time.time(), count % 100, count % 100, count % 100, count % 100, 0, 12.5, 0))
+        count += 1
+    print('  publish             {:.2f} us'.format((time.perf_counter() - start) / count * 1e6))
+
+    client = start_shm_client(name, 'copies')
+    time.sleep(0.5)
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        publisher.publish(StatusSnapshot(time.time(), count % 100, count % 100, count % 100, count % 100, 0, 12.5, 0))
+        count += 1
+    reads, retries, torn = (int(value) for value in client.communicate()[0].split())
+    print('  concurrent copies   {:.0f} reads/s, {} retries, {} torn, {} notifications dropped'.format(
+        reads / duration, retries, torn, publisher.dropped))
+    publisher.close()
+
+    for mode in ('none', 'thread', 'process'):
+        master1, port1 = pty_pair()
+        master2, port2 = pty_pair()
+        log = tempfile.NamedTemporaryFile(suffix='.log')
+        heater = AutotermHeater(log.name, serial_port1=port1, serial_port2=port2, log_level=logging.WARNING)
+        heater.wait_connected(2.0)
+        publisher = SnapshotPublisher(name)
+        publisher.add(heater)
+        running = True
+        worker = client = None
+        if mode == 'thread':
+            worker = threading.Thread(target=analytics, args=(heater.get_status_snapshot, lambda: running))
+            worker.start()
+        elif mode == 'process':
+            client = start_shm_client(name, 'analytics')
+        time.sleep(0.5)
+
+        latencies = []
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            sent = time.perf_counter()
+            os.write(master2, frames[2])
+            if wait_for(master1, frames[2]):
+                latencies.append(time.perf_counter() - sent)
+            time.sleep(0.01)
+        running = False
+        if worker:
+            worker.join()
+        if client:
+            client.communicate()
+        heater._stop_working()
+        publisher.close()
+        latencies.sort()
+        print('  analytics {:<8}  forward latency median {:.2f} ms, p99 {:.2f} ms ({} frames)'.format(
+            mode, statistics.median(latencies) * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3, len(latencies)))
+
+
+benchmarks = {'crc': bench_crc, 'loop': bench_loop, 'dispatch': bench_dispatch, 'requests': bench_requests,
+              'fleet': bench_fleet, 'metrics': bench_metrics,
+              'forward': bench_forward, 'logging': bench_logging,
+              'gateway': bench_gateway, 'timing': bench_timing,
+              'store': bench_store, 'hub': bench_hub, 'sniffer': bench_sniffer,
+              'shm': bench_shm}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the AutotermHeater hot paths')
+    parser.add_argument('names', nargs='*', help='benchmarks to run: {} (default: all)'.format(', '.join(benchmarks)))
+    parser.add_argument('-d', '--duration', type=float, default=1.0, help='seconds per measurement')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error('unknown benchmark {}'.format(name))
+
+    for name in args.names or benchmarks:
+        benchmarks[name](args.duration)
@@ -1,39 +1,341 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Sniffer of the bus between the controller and the heater.
+#   message_passthrough.py /dev/ttyUSB1 /dev/ttyUSB0 -o bus.atc     passthrough between two ports, binary capture
+#   message_passthrough.py /dev/pts/5 --device 4 --id 0x0f          only listens, e.g. to a pty of LinkHub
+#   message_passthrough.py --socket /tmp/heater.sock -o bus.txt      client of a LinkHub unix socket, text capture
+# Received bytes are forwarded unchanged as soon as they are read, also bytes outside of valid messages.
+# The reading thread only timestamps the chunks and copies them to a ring buffer, frames are decoded and written
+# to the capture in batches by another thread. Captures ending with .atc are binary (see autotermcapture),
+# others are text, the default is text on stdout. Bytes which did not fit to the ring buffer are counted as lost.
+
+import argparse
+import collections
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
 import serial
 
-# use this when connecting to a PC with diagnostic software
-# ser1 = serial.Serial('/dev/serial0', 2400, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import autotermcapture  # noqa: E402
+from autotermheater import FrameDecoder  # noqa: E402
+
+device_text = {0x00: 'pc', 0x02: 'diagnostic', 0x03: 'controller', 0x04: 'heater'}
+
+
+class ChunkRing:
+    # Chunks are read directly into the buffer and never split at its end, the rest of it is skipped.
+    # Positions are absolute byte counts, the reader owns head and the writer tail.
+    def __init__(self, size=1 << 20):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.chunks = collections.deque()  # (timestamp ns, direction, position, length)
+        self.head = 0
+        self.tail = 0
+        self.high_water = 0
+
+    def reserve(self, length):
+        # Position of free space for length bytes, None when the writer fell behind
+        position = self.head
+        offset = position % self.size
+        if offset + length > self.size:
+            position += self.size - offset
+        if position + length - self.tail > self.size:
+            return None
+        return position
+
+    def commit(self, timestamp, direction, position, length):
+        self.head = position + length
+        self.high_water = max(self.high_water, self.head - self.tail)
+        self.chunks.append((timestamp, direction, position, length))
+
+    def data(self, position, length):
+        offset = position % self.size
+        return self.view[offset:offset + length]
+
+
+class _Port:
+    __slots__ = ('fd', 'owner', 'direction', 'peer', 'output', 'received')
+
+    def __init__(self, fd, owner, direction):
+        self.fd = fd
+        self.owner = owner  # Serial port or socket which is closed with the port
+        self.direction = direction
+        self.peer = None  # Port where received bytes are forwarded
+        self.output = bytearray()  # Bytes waiting until the port can take them
+        self.received = 0
+
+
+class Sniffer:
+    def __init__(self, output=None, devices=None, commands=None, ring_size=1 << 20, interval=0.5, idle=0.1,
+                 chunk_size=4096):
+        self.devices = devices  # Sets of devices and command ids written to the capture, None for all
+        self.commands = commands
+        self.interval = interval  # Seconds between batches
+        self.idle = idle  # Incomplete frame after this pause is garbage
+        self.chunk_size = chunk_size
+        self.ring = ChunkRing(ring_size)
+        self._ports = {}  # File descriptor: _Port
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._running = True
+        self._capture = None
+        self._text = None
+        if output and output.endswith('.atc'):
+            self._capture = autotermcapture.CaptureWriter(output)
+            self._start_ns = self._capture.monotonic_ns
+        else:
+            self._text = open(output, 'a', encoding='utf-8') if output else sys.stdout
+            self._start_ns = time.monotonic_ns()
+        self._decoders = {}  # Direction: (FrameDecoder, garbage list)
+        self._last = {}  # Direction: timestamp of its last chunk
+
+        # Statistics
+        self.chunks = 0
+        self.received = 0
+        self.lost = 0
+        self.frames = 0
+        self.garbage = 0
+        self.written = 0
+        self.batches = 0
+
+        self._writer = threading.Thread(target=self._write_batches, daemon=True)
+        self._writer.start()
+
+    def add_serial(self, port, baudrate=2400):
+        ser = serial.Serial(port, baudrate, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                            stopbits=serial.STOPBITS_ONE, timeout=0)
+        ser.reset_input_buffer()
+        return self._add(ser.fileno(), ser)
+
+    def add_socket(self, path):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(path)
+        return self._add(connection.fileno(), connection)
+
+    def _add(self, fd, owner):
+        # First port is PORT1, the second PORT2, bytes of two ports are forwarded to each other
+        os.set_blocking(fd, False)
+        port = _Port(fd, owner, autotermcapture.PORT1 if not self._ports else autotermcapture.PORT2)
+        if self._ports:
+            other = next(iter(self._ports.values()))
+            port.peer, other.peer = other, port
+        self._ports[fd] = port
+        self._selector.register(fd, selectors.EVENT_READ, port)
+        return port
+
+    def run(self):
+        ring = self.ring
+        chunk_size = self.chunk_size
+        select = self._selector.select
+        while self._running:
+            for key, mask in select():
+                port = key.data
+                if port is None:
+                    os.read(self._wake_r, 4096)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush_output(port)
+                if not mask & selectors.EVENT_READ:
+                    continue
+                position = ring.reserve(chunk_size)
+                try:
+                    if position is None:
+                        data = os.read(port.fd, chunk_size)
+                        length = len(data)
+                    else:
+                        data = ring.data(position, chunk_size)
+                        length = os.readv(port.fd, [data])
+                        data = data[:length]
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    length = 0
+                if not length:
+                    # Closed socket or hung up pty
+                    self._running = False
+                    break
+                timestamp = time.monotonic_ns()
+                if port.peer:
+                    self._forward(port.peer, data)
+                if position is None:
+                    self.lost += length
+                else:
+                    ring.commit(timestamp, port.direction, position, length)
+                self.chunks += 1
+                self.received += length
+                port.received += length
+
+    def _forward(self, port, data):
+        if not port.output:
+            try:
+                written = os.write(port.fd, data)
+            except BlockingIOError:
+                written = 0
+            if written == len(data):
+                return
+            data = data[written:]
+            self._selector.modify(port.fd, selectors.EVENT_READ | selectors.EVENT_WRITE, port)
+        port.output += data
+
+    def _flush_output(self, port):
+        try:
+            written = os.write(port.fd, port.output)
+        except BlockingIOError:
+            return
+        del port.output[:written]
+        if not port.output:
+            self._selector.modify(port.fd, selectors.EVENT_READ, port)
+
+    def stop(self):
+        # Called from another thread or a signal handler, the capture is completed by close()
+        self._running = False
+        try:
+            os.write(self._wake_w, b'\x00')
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self._running = False
+        self._writer.join()
+        for port in self._ports.values():
+            port.owner.close()
+        self._ports.clear()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def stats(self):
+        return {'chunks': self.chunks, 'received': self.received, 'lost': self.lost, 'frames': self.frames,
+                'garbage': self.garbage, 'written': self.written, 'batches': self.batches,
+                'ring_high_water': self.ring.high_water}
+
+    def _decoder(self, direction):
+        entry = self._decoders.get(direction)
+        if entry is None:
+            garbage = []  # (frames decoded before, bytes)
+            decoder = FrameDecoder()
+            decoder.on_garbage = lambda data: garbage.append((decoder.frames, data))
+            entry = self._decoders[direction] = (decoder, garbage)
+        return entry
 
-ser1 = serial.Serial('/dev/ttyUSB1', 2400, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
-                     stopbits=serial.STOPBITS_ONE)
-ser2 = serial.Serial('/dev/ttyUSB0', 2400, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
-                     stopbits=serial.STOPBITS_ONE)
+    def _decode(self, timestamp, direction, data, records):
+        decoder, garbage = self._decoder(direction)
+        first = decoder.frames
+        messages = decoder.feed(data) if data is not None else decoder.flush()
+        # Garbage is put between the frames where it was found, the capture keeps the order of the bytes
+        items = []
+        index = 0
+        for frames, chunk in garbage:
+            items.extend(messages[index:frames - first])
+            index = max(index, frames - first)
+            if items and isinstance(items[-1], bytearray):
+                items[-1] += chunk
+            else:
+                items.append(bytearray(chunk))
+        items.extend(messages[index:])
+        garbage.clear()
+        for item in items:
+            if isinstance(item, bytearray):
+                self.garbage += len(item)
+                if self.devices is None and self.commands is None:
+                    records.append((timestamp, direction, bytes(item), None))
+                continue
+            self.frames += 1
+            if (self.devices is None or item.device in self.devices) and \
+                    (self.commands is None or item.msg_id2 in self.commands):
+                records.append((timestamp, direction, item.raw, item))
 
-ser1.flushInput()
-ser2.flushInput()
+    def _write_batches(self):
+        ring = self.ring
+        chunks = ring.chunks
+        while True:
+            running = self._running
+            if running:
+                time.sleep(self.interval)
+            records = []
+            # Chunks added meanwhile wait for the next batch
+            for i in range(len(chunks)):
+                timestamp, direction, position, length = chunks.popleft()
+                self._last[direction] = timestamp
+                self._decode(timestamp, direction, bytes(ring.data(position, length)), records)
+                ring.tail = position + length
+            # Incomplete frames after a pause, or at the end of the capture, are given up
+            now = time.monotonic_ns()
+            for direction, (decoder, garbage) in self._decoders.items():
+                while decoder.pending() and (not running or now - self._last[direction] > self.idle * 1e9):
+                    self._decode(self._last[direction], direction, None, records)
+            if records:
+                self._write_records(records)
+            if not running:
+                if self._capture:
+                    self._capture.close()
+                elif self._text is not sys.stdout:
+                    self._text.close()
+                return
 
-while True:
-    if ser1.inWaiting() > 0:
-        message = ser1.read(1)
-        if message != b'\xaa':
-            ser2.write(message)
-            print('1 >> 2: ERROR: ', message)
-            continue
-        message += ser1.read(2)
-        message += ser1.read(message[-1] + 4)
+    def _write_records(self, records):
+        self.batches += 1
+        self.written += len(records)
+        if self._capture:
+            write = self._capture.write
+            for timestamp, direction, data, message in records:
+                write(direction, data, timestamp)
+            self._capture.flush()
+            return
+        lines = []
+        start = self._start_ns
+        for timestamp, direction, data, message in records:
+            if message is None:
+                text = 'garbage'
+            else:
+                text = '{} {:02x}'.format(device_text.get(message.device, '{:02x}'.format(message.device)),
+                                          message.msg_id2)
+            lines.append('{:12.6f} {}: {} ({})\n'.format((timestamp - start) / 1e9,
+                                                         autotermcapture.direction_text[direction],
+                                                         data.hex(' '), text))
+        self._text.write(''.join(lines))
+        self._text.flush()
 
-        ser2.write(message)
 
-        print('1 >> 2: ', message.hex())
+def _main():
+    parser = argparse.ArgumentParser(description='Passthrough and capture of heater bus traffic')
+    parser.add_argument('ports', nargs='*', help='one port to listen to, or two ports to pass bytes between')
+    parser.add_argument('--socket', help='unix socket of a LinkHub instead of ports')
+    parser.add_argument('-b', '--baudrate', type=int, default=2400)
+    parser.add_argument('-o', '--output', help='capture file, binary if it ends with .atc (default: text on stdout)')
+    parser.add_argument('--device', type=lambda value: int(value, 0), action='append')
+    parser.add_argument('--id', dest='msg_id2', type=lambda value: int(value, 0), action='append')
+    parser.add_argument('--ring', type=int, default=1 << 20, help='ring buffer size in bytes')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between writes of the capture')
+    args = parser.parse_args()
+    if not args.socket and len(args.ports) not in (1, 2) or args.socket and args.ports:
+        parser.error('give one or two ports, or a socket')
 
-    if ser2.inWaiting() > 0:
-        message = ser2.read(1)
-        if message != b'\xaa':
-            ser1.write(message)
-            print('2 >> 1: ERROR: ', message)
-            continue
-        message += ser2.read(2)
-        message += ser2.read(message[-1] + 4)
+    sniffer = Sniffer(args.output, set(args.device) if args.device else None,
+                      set(args.msg_id2) if args.msg_id2 else None, args.ring, args.interval)
+    if args.socket:
+        sniffer.add_socket(args.socket)
+    for port in args.ports:
+        sniffer.add_serial(port, args.baudrate)
+    try:
+        sniffer.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sniffer.close()
+    print(', '.join('{} {}'.format(key, value) for key, value in sniffer.stats().items()), file=sys.stderr)
 
-        ser1.write(message)
 
-        print('2 >> 1: ', message.hex())
+if __name__ == '__main__':
+    _main()